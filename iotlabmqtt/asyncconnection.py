@@ -9,6 +9,7 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from builtins import *  # pylint:disable=W0401,W0614,W0622
 
+import time
 import socket
 import threading
 import asyncore
@@ -39,6 +40,9 @@ class NodeConnection(asyncore.dispatcher_with_send):
         self.event_handler = event_handler
         self.data_handler = data_handler
 
+        # Time of the last read, for data handlers that timestamp data
+        self.recv_time = None
+
     def _address(self, archi, num):  # pylint:disable=no-self-use
         """Return socket address for archi/num."""
         return archi, int(num)
@@ -79,6 +83,7 @@ class NodeConnection(asyncore.dispatcher_with_send):
     def handle_read(self):
         """Read bytes and run data handler."""
         data = self.recv(self.RECV_LEN)
+        self.recv_time = time.time()
         self.handle_data(data)
 
     def handle_error(self):
@@ -6,6 +6,7 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from builtins import *  # pylint:disable=W0401,W0614,W0622
 
+import struct
 import threading
 
 import iotlabmqtt.radiosniffer
@@ -23,10 +24,17 @@ class PcapFiles(object):
 
     Wraps a dict of pcap files with an interface to allow correct management
     and data integrity. It is Thread safe.
+
+    For pcapng files, nodes interfaces are numbered in the order they are
+    added and nodes packets blocks are written with their interface id.
     """
+    PCAPNG = iotlabmqtt.radiosniffer.ZepToPcapng
+    INTERFACE_ID = struct.Struct(b'<L')
+
     def __init__(self):
         super().__init__()
         self.files = {}
+        self.interfaces = {}
         self._lock = threading.Lock()
 
     def clear(self, pcaptype):
@@ -41,6 +49,7 @@ class PcapFiles(object):
             pass
         finally:
             self.files.pop(pcaptype, None)
+            self.interfaces.pop(pcaptype, None)
 
     def set(self, pcaptype, pcapfd, pcap_header):
         """Set pcap file as `pcaptype` and write its header."""
@@ -59,6 +68,44 @@ class PcapFiles(object):
         with self._lock:  # pylint:disable=not-context-manager
             self._write(pcaptype, data)
 
+    def add_interface(self, pcaptype, node, interface):
+        """Write ``node`` ``interface`` block to `pcaptype` file if its set.
+
+        Interface is only written once per file.
+        """
+        with self._lock:  # pylint:disable=not-context-manager
+            if pcaptype not in self.files:
+                return
+            interfaces = self.interfaces.setdefault(pcaptype, {})
+            if node in interfaces:
+                return
+            interfaces[node] = len(interfaces)
+            self._write(pcaptype, interface)
+
+    def write_block(self, pcaptype, node, blocks):
+        """Write ``node`` packets ``blocks`` to `pcaptype` file with its
+        interface id.
+
+        Blocks from nodes without interface are dropped.
+        """
+        with self._lock:  # pylint:disable=not-context-manager
+            try:
+                interface_id = self.interfaces[pcaptype][node]
+            except KeyError:
+                return
+            self._write(pcaptype, self._set_interface(blocks, interface_id))
+
+    def _set_interface(self, blocks, interface_id):
+        """Return ``blocks`` with ``interface_id``, there may be a batch."""
+        blocks = bytearray(blocks)
+        offset = 0
+        while offset < len(blocks):
+            self.INTERFACE_ID.pack_into(
+                blocks, offset + self.PCAPNG.INTERFACE_ID_OFFSET, interface_id)
+            # Block total length
+            offset += self.INTERFACE_ID.unpack_from(blocks, offset + 4)[0]
+        return blocks
+
     def _write(self, pcaptype, data):
         try:
             self.files[pcaptype].write(data)
@@ -85,6 +132,24 @@ class RadioSnifferShell(clientcommon.CmdShell):
     RAWPCAPCLOSE_USAGE = ('rawpcapclose\n'
                           '  Close the current rawpcap file\n')
 
+    ZEPSTART_USAGE = ('zepstart ARCHI NUM CHANNEL\n'
+                      '  ARCHI:   m3/a8\n'
+                      '  NUM:     node num\n'
+                      '  CHANNEL: sniffer channel\n')
+    ZEPPCAP_USAGE = ('zeppcap FILEPATH\n'
+                     '  FILEPATH: zeppcap output\n')
+    ZEPPCAPCLOSE_USAGE = ('zeppcapclose\n'
+                          '  Close the current zeppcap file\n')
+
+    PCAPNGSTART_USAGE = ('pcapngstart ARCHI NUM CHANNEL\n'
+                         '  ARCHI:   m3/a8\n'
+                         '  NUM:     node num\n'
+                         '  CHANNEL: sniffer channel\n')
+    PCAPNG_USAGE = ('pcapng FILEPATH\n'
+                    '  FILEPATH: pcapng output\n')
+    PCAPNGCLOSE_USAGE = ('pcapngclose\n'
+                         '  Close the current pcapng file\n')
+
     STOP_USAGE = ('stop ARCHI NUM\n'
                   '  ARCHI: m3/a8\n'
                   '  NUM:   node num\n')
@@ -92,6 +157,8 @@ class RadioSnifferShell(clientcommon.CmdShell):
     STOPALL_USAGE = 'stopall\n'
 
     SERVER = iotlabmqtt.radiosniffer.MQTTRadioSnifferAggregator
+    PCAPNG_IDB = PcapFiles.INTERFACE_ID.pack(
+        iotlabmqtt.radiosniffer.ZepToPcapng.IDB_TYPE)
 
     def __init__(self, client, prefix='', site=None):
         assert site is not None
@@ -106,6 +173,8 @@ class RadioSnifferShell(clientcommon.CmdShell):
         _print_wrapper = self.async_print_handle_readlinebuff()
         error_cb = _print_wrapper(self.error_cb)
         raw_cb = _print_wrapper(self.raw_handler)
+        zep_cb = _print_wrapper(self.zep_handler)
+        pcapng_cb = _print_wrapper(self.pcapng_handler)
         self.topics = {
             'raw': mqttcommon.ChannelClient(_topics['noderaw'], raw_cb),
             'rawheader': mqttcommon.RequestClient(
@@ -113,6 +182,21 @@ class RadioSnifferShell(clientcommon.CmdShell):
             'rawstart': mqttcommon.RequestClient(_topics['noderaw'], 'start',
                                                  clientid=clientid),
 
+            'zep': mqttcommon.ChannelClient(_topics['nodezep'], zep_cb),
+            'zepheader': mqttcommon.RequestClient(
+                _topics['zep'], 'zepheader', clientid=clientid),
+            'zepstart': mqttcommon.RequestClient(_topics['nodezep'], 'start',
+                                                 clientid=clientid),
+
+            'pcapng': mqttcommon.ChannelClient(_topics['nodepcapng'],
+                                               pcapng_cb),
+            'pcapngheader': mqttcommon.RequestClient(
+                _topics['pcapng'], 'pcapngheader', clientid=clientid),
+            'pcapngstart': mqttcommon.RequestClient(
+                _topics['nodepcapng'], 'start', clientid=clientid),
+            'pcapnginterface': mqttcommon.RequestClient(
+                _topics['nodepcapng'], 'interface', clientid=clientid),
+
             'stop': mqttcommon.RequestClient(
                 _topics['node'], 'stop', clientid=clientid),
 
@@ -140,20 +224,25 @@ class RadioSnifferShell(clientcommon.CmdShell):
 
     def do_rawpcap(self, arg):
         """Create pcap file and get RAW header."""
+        self._pcap_open('raw', arg)
+
+    def _pcap_open(self, pcaptype, arg):
+        """Create ``pcaptype`` pcap file and write its header."""
         try:
             pcapfd = open(arg, 'wb', buffering=0)
         except (IOError, OSError) as err:
             print('Could not open file: %s' % err)
             raise ValueError()
 
-        topic = self.topics['rawheader']
+        topic = self.topics['%sheader' % pcaptype]
         ret = topic.request(self.client, b'', timeout=5)
 
         # No error message
         header = ret
 
-        print('Writing RAW PCAP header: %u bytes' % len(header))
-        self.pcap_files.set('raw', pcapfd, header)
+        print('Writing %s PCAP header: %u bytes' %
+              (pcaptype.upper(), len(header)))
+        self.pcap_files.set(pcaptype, pcapfd, header)
 
     def help_rawpcap(self):
         """Help rawpcap command."""
@@ -184,25 +273,120 @@ class RadioSnifferShell(clientcommon.CmdShell):
 
     def do_rawstart(self, arg):
         """Start sniffer on CHANNEL for given node: ARCHI NUM."""
+        self._do_start('rawstart', arg)
+
+    def _do_start(self, command, arg):
         archi, num, channel = self.cmd_split(arg)
         num = int(num)
         channel = int(channel)
 
-        self._do_rawstart(archi, num, channel)
-
-    def _do_rawstart(self, archi, num, channel):
-        topic = self.topics['rawstart']
+        topic = self.topics[command]
         channel_str = str(channel).encode('utf-8')
 
         ret = topic.request(self.client, channel_str, timeout=5,
                             archi=archi, num=num)
         if ret:
             raise RuntimeError(ret.decode('utf-8'))
+        return archi, num
 
     def help_rawstart(self):
         """Help rawstart command."""
         print(self.RAWSTART_USAGE, end='')
 
+    # # # # # #
+    # zeppcap #
+    # # # # # #
+    def do_zeppcap(self, arg):
+        """Create pcap file and get ZEP header."""
+        self._pcap_open('zep', arg)
+
+    def help_zeppcap(self):
+        """Help zeppcap command."""
+        print(self.ZEPPCAP_USAGE, end='')
+
+    # # # # # # # # #
+    # zeppcapclose  #
+    # # # # # # # # #
+    def do_zeppcapclose(self, _):
+        """Close zeppcap file."""
+        self.pcap_files.clear('zep')
+
+    def help_zeppcapclose(self):
+        """Help zeppcapclose command."""
+        print(self.ZEPPCAPCLOSE_USAGE, end='')
+
+    # # # #
+    # zep #
+    # # # #
+    def zep_handler(self, message, archi, num):  # pylint:disable=no-self-use
+        """Handle zep packets received from sniffer."""
+        packet = message.payload
+
+        message = 'PKT: len(%u)' % len(packet)
+        print('zep_handler(%s-%s): %s' % (archi, num, message))
+
+        self.pcap_files.write('zep', packet)
+
+    def do_zepstart(self, arg):
+        """Start zep sniffer on CHANNEL for given node: ARCHI NUM."""
+        self._do_start('zepstart', arg)
+
+    def help_zepstart(self):
+        """Help zepstart command."""
+        print(self.ZEPSTART_USAGE, end='')
+
+    # # # # # #
+    # pcapng  #
+    # # # # # #
+    def do_pcapng(self, arg):
+        """Create pcapng file and get its section header."""
+        self._pcap_open('pcapng', arg)
+
+    def help_pcapng(self):
+        """Help pcapng command."""
+        print(self.PCAPNG_USAGE, end='')
+
+    # # # # # # # #
+    # pcapngclose #
+    # # # # # # # #
+    def do_pcapngclose(self, _):
+        """Close pcapng file."""
+        self.pcap_files.clear('pcapng')
+
+    def help_pcapngclose(self):
+        """Help pcapngclose command."""
+        print(self.PCAPNGCLOSE_USAGE, end='')
+
+    # # # # # # # #
+    # pcapngstart #
+    # # # # # # # #
+    def pcapng_handler(self, message, archi, num):
+        """Handle pcapng packets blocks received from sniffer."""
+        block = message.payload
+
+        message = 'PKT: len(%u)' % len(block)
+        print('pcapng_handler(%s-%s): %s' % (archi, num, message))
+
+        self.pcap_files.write_block('pcapng', (archi, num), block)
+
+    def do_pcapngstart(self, arg):
+        """Start pcapng sniffer on CHANNEL for given node: ARCHI NUM.
+
+        Node interface is added to current pcapng file.
+        """
+        archi, num = self._do_start('pcapngstart', arg)
+
+        topic = self.topics['pcapnginterface']
+        ret = topic.request(self.client, b'', timeout=5, archi=archi, num=num)
+        if not ret.startswith(self.PCAPNG_IDB):
+            raise RuntimeError(ret.decode('utf-8'))
+
+        self.pcap_files.add_interface('pcapng', (archi, num), ret)
+
+    def help_pcapngstart(self):
+        """Help pcapngstart command."""
+        print(self.PCAPNGSTART_USAGE, end='')
+
     # # # # #
     # stop  #
     # # # # #
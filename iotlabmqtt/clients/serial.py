@@ -6,6 +6,10 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from builtins import *  # pylint:disable=W0401,W0614,W0622
 
+import sys
+import json
+import threading
+
 import iotlabmqtt.serial
 from iotlabmqtt import common
 from iotlabmqtt import mqttcommon
@@ -15,6 +19,8 @@ from . import common as clientcommon
 
 PARSER = common.MQTTAgentArgumentParser()
 clientcommon.parser_add_site_arg(PARSER)
+PARSER.add_argument('--line-envelope', action='store_true', default=False,
+                    help='Agent lines are prefixed with an envelope header')
 
 
 class SerialShell(clientcommon.CmdShell):
@@ -23,26 +29,57 @@ class SerialShell(clientcommon.CmdShell):
     :param client: mqttclient instance
     :param prefix: topics prefix
     :param site: agent site
+    :param envelope: agent lines are prefixed with an envelope header
     """
     LINESTART_USAGE = ('linestart ARCHI NUM\n'
                        '  ARCHI: m3/a8\n'
                        '  NUM:   node num\n')
     LINEWRITE_USAGE = ('linewrite ARCHI NUM MESSAGE\n'
                        '  ARCHI: m3/a8\n'
-                       '  NUM:   node num\n'
+                       '  NUM:   node num, nodeset or all\n'
                        '  MESSAGE: Message line to send\n')
+    RAWSTART_USAGE = ('rawstart ARCHI NUM [SIZE [DELAY]]\n'
+                      '  ARCHI: m3/a8\n'
+                      '  NUM:   node num\n'
+                      '  SIZE:  send data by SIZE bytes\n'
+                      '  DELAY: send data after at most DELAY seconds\n')
+    RAWWRITE_USAGE = ('rawwrite ARCHI NUM MESSAGE\n'
+                      '  ARCHI: m3/a8\n'
+                      '  NUM:   node num\n'
+                      '  MESSAGE: Message sent without newline\n')
+    RAWFILE_USAGE = ('rawfile FILEPATH\n'
+                     '  FILEPATH: raw data output, instead of stdout\n')
+    RAWFILECLOSE_USAGE = ('rawfileclose\n'
+                          '  Close the current rawfile, back to stdout\n')
+    EXPECT_USAGE = ('expect ARCHI NUM SCRIPT\n'
+                    '  ARCHI:  m3/a8\n'
+                    '  NUM:    node num\n'
+                    '  SCRIPT: json list of send/expect/timeout steps\n')
     STOP_USAGE = ('stop ARCHI NUM\n'
                   '  ARCHI: m3/a8\n'
                   '  NUM:   node num\n')
 
+    STATS_USAGE = ('stats ARCHI NUM\n'
+                   '  ARCHI: m3/a8\n'
+                   '  NUM:   node num\n')
+
     STOPALL_USAGE = 'stopall\n'
 
+    BULKLINESTART_USAGE = ('bulklinestart ARCHI NODESET\n'
+                           '  ARCHI:   m3/a8\n'
+                           '  NODESET: nodes nums, ex: 1-5,7\n')
+    BULKLINESTOP_USAGE = ('bulklinestop ARCHI NODESET\n'
+                          '  ARCHI:   m3/a8\n'
+                          '  NODESET: nodes nums, ex: 1-5,7\n')
+
     SERVER = iotlabmqtt.serial.MQTTAggregator
 
-    def __init__(self, client, prefix, site=None):
+    def __init__(self, client, prefix, site=None, envelope=False):
         assert site is not None
         super().__init__()
 
+        self.envelope = envelope
+
         clientid = clientcommon.clientid('serialclient')
 
         staticfmt = {'site': site}
@@ -51,6 +88,7 @@ class SerialShell(clientcommon.CmdShell):
 
         _print_wrapper = self.async_print_handle_readlinebuff()
         line_cb = _print_wrapper(self.line_handler)
+        raw_cb = _print_wrapper(self.raw_handler)
         error_cb = _print_wrapper(self.error_cb)
 
         self.topics = {
@@ -59,17 +97,33 @@ class SerialShell(clientcommon.CmdShell):
                 _topics['line'], 'start', clientid=clientid),
             'linestop': mqttcommon.RequestClient(
                 _topics['line'], 'stop', clientid=clientid),
+            'lineexpect': mqttcommon.RequestClient(
+                _topics['line'], 'expect', clientid=clientid),
+
+            'raw': mqttcommon.ChannelClient(_topics['raw'], raw_cb),
+            'rawstart': mqttcommon.RequestClient(
+                _topics['raw'], 'start', clientid=clientid),
 
             'stop': mqttcommon.RequestClient(
                 _topics['node'], 'stop', clientid=clientid),
+            'stats': mqttcommon.RequestClient(
+                _topics['node'], 'stats', clientid=clientid),
 
             'stopall': mqttcommon.RequestClient(
                 _topics['agenttopic'], 'stopall', clientid=clientid),
+            'bulklinestart': mqttcommon.RequestClient(
+                _topics['agenttopic'], 'linestart', clientid=clientid),
+            'bulklinestop': mqttcommon.RequestClient(
+                _topics['agenttopic'], 'linestop', clientid=clientid),
 
             'error': mqttcommon.ErrorClient(_topics['agenttopic'],
                                             callback=error_cb),
         }
 
+        # Raw data output file, binary stdout if None
+        self.raw_file = None
+        self._raw_lock = threading.Lock()
+
         self.client = client
         self.client.topics = list(self.topics.values())
 
@@ -79,19 +133,32 @@ class SerialShell(clientcommon.CmdShell):
         print('SERIAL ERROR: %s: %s' % (relative_topic, msg))
 
     @classmethod
-    def from_opts_dict(cls, prefix, site, **kwargs):
+    def from_opts_dict(cls, prefix, site, line_envelope=False, **kwargs):
         """Create class from argparse entries."""
         client = mqttcommon.MQTTClient.from_opts_dict(**kwargs)
-        return cls(client, prefix=prefix, site=site)
+        return cls(client, prefix=prefix, site=site, envelope=line_envelope)
 
     # # # # #
     # line  #
     # # # # #
-    def line_handler(self, message, archi, num):  # pylint:disable=no-self-use
+    def line_handler(self, message, archi, num):
         """Handle line received from nodes."""
+        if self.envelope:
+            self._envelope_line_handler(message, archi, num)
+            return
+
         line = message.payload.decode('utf-8', 'replace')
         print('line_handler(%s-%s): %s' % (archi, num, line))
 
+    @staticmethod
+    def _envelope_line_handler(message, archi, num):
+        """Handle line with envelope header received from nodes."""
+        envelope = iotlabmqtt.serial.LineEnvelope
+        timestamp, seqno, line = envelope.decode(message.payload)
+        line = line.decode('utf-8', 'replace')
+        print('line_handler(%s-%s)[%.6f #%u]: %s' % (archi, num, timestamp,
+                                                     seqno, line))
+
     # # # # # # #
     # linestart #
     # # # # # # #
@@ -118,9 +185,14 @@ class SerialShell(clientcommon.CmdShell):
     # linewrite #
     # # # # # # #
     def do_linewrite(self, arg):
-        """Write line to given node: ARCHI NUM MESSAGE."""
+        """Write line to given node: ARCHI NUM MESSAGE.
+
+        NUM can also be a nodeset or 'all' to write to multiple nodes.
+        """
         archi, num, message = self.cmd_split(arg, 2)
-        num = int(num)
+        if num != self.SERVER.ALL_NODES:
+            # Only checked, the agent expands the nodeset
+            common.expand_nodeset(num)
 
         payload = message.encode('utf-8')
         self.topics['line'].send(self.client, payload, archi=archi, num=num)
@@ -129,6 +201,124 @@ class SerialShell(clientcommon.CmdShell):
         """Help linewrite command."""
         print(self.LINEWRITE_USAGE, end='')
 
+    # # # # # #
+    # expect  #
+    # # # # # #
+    def do_expect(self, arg):
+        """Run expect script on node: ARCHI NUM SCRIPT."""
+        archi, num, script = self.cmd_split(arg, 2)
+        num = int(num)
+
+        # Wait for all steps timeouts
+        steps = iotlabmqtt.serial.LineExpect.steps(script.encode('utf-8'))
+        default = iotlabmqtt.serial.LineExpect.STEP['timeout']
+        timeout = 5 + sum(step.get('timeout', default) for step in steps)
+
+        topic = self.topics['lineexpect']
+        ret = topic.request(self.client, script.encode('utf-8'),
+                            timeout=timeout, archi=archi, num=num)
+        print(ret.decode('utf-8'))
+
+    def help_expect(self):
+        """Help expect command."""
+        print(self.EXPECT_USAGE, end='')
+
+    # # # #
+    # raw #
+    # # # #
+    def raw_handler(self, message, archi, num):
+        """Handle raw data received from nodes.
+
+        Data is written as is to the raw file, or to binary stdout.
+        """
+        data = message.payload
+        with self._raw_lock:  # pylint:disable=not-context-manager
+            if self.raw_file is not None:
+                print('raw_handler(%s-%s): len(%u)' % (archi, num, len(data)))
+                self.raw_file.write(data)
+                self.raw_file.flush()
+                return
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        stdout.write(data)
+        stdout.flush()
+
+    # # # # # #
+    # rawfile #
+    # # # # # #
+    def do_rawfile(self, arg):
+        """Write raw data to FILEPATH instead of stdout."""
+        try:
+            raw_file = open(arg, 'wb')
+        except (IOError, OSError) as err:
+            print('Could not open file: %s' % err)
+            raise ValueError()
+        self._set_raw_file(raw_file)
+
+    def help_rawfile(self):
+        """Help rawfile command."""
+        print(self.RAWFILE_USAGE, end='')
+
+    def do_rawfileclose(self, _):
+        """Close raw data file, write raw data to stdout again."""
+        self._set_raw_file(None)
+
+    def help_rawfileclose(self):
+        """Help rawfileclose command."""
+        print(self.RAWFILECLOSE_USAGE, end='')
+
+    def _set_raw_file(self, raw_file):
+        """Replace raw data file, closing the previous one."""
+        with self._raw_lock:  # pylint:disable=not-context-manager
+            previous, self.raw_file = self.raw_file, raw_file
+        if previous is not None:
+            previous.close()
+
+    # # # # # # #
+    # rawstart  #
+    # # # # # # #
+    def do_rawstart(self, arg):
+        """Start raw mode to given node: ARCHI NUM [SIZE [DELAY]]"""
+        args = self.cmd_split(arg)
+        if not 2 <= len(args) <= 4:
+            raise ValueError()
+        archi, num, options = self._rawstart_args(*args)
+
+        topic = self.topics['rawstart']
+        payload = json.dumps(options).encode('utf-8') if options else b''
+        ret = topic.request(self.client, payload, timeout=5,
+                            archi=archi, num=num)
+        if ret:
+            raise RuntimeError(ret.decode('utf-8'))
+
+    @staticmethod
+    def _rawstart_args(archi, num, size=None, delay=None):
+        """Parse rawstart arguments, raise ValueError on errors."""
+        options = {}
+        if size is not None:
+            options['size'] = int(size)
+        if delay is not None:
+            options['delay'] = float(delay)
+        return archi, int(num), options
+
+    def help_rawstart(self):
+        """Help rawstart command."""
+        print(self.RAWSTART_USAGE, end='')
+
+    # # # # # # #
+    # rawwrite  #
+    # # # # # # #
+    def do_rawwrite(self, arg):
+        """Write raw data to given node: ARCHI NUM MESSAGE."""
+        archi, num, message = self.cmd_split(arg, 2)
+        num = int(num)
+
+        payload = message.encode('utf-8')
+        self.topics['raw'].send(self.client, payload, archi=archi, num=num)
+
+    def help_rawwrite(self):
+        """Help rawwrite command."""
+        print(self.RAWWRITE_USAGE, end='')
+
     # # # # #
     # stop  #
     # # # # #
@@ -147,6 +337,23 @@ class SerialShell(clientcommon.CmdShell):
         """Help stop command."""
         print(self.STOP_USAGE, end='')
 
+    # # # # #
+    # stats #
+    # # # # #
+    def do_stats(self, arg):
+        """Print node redirection statistics: ARCHI NUM."""
+        archi, num = self.cmd_split(arg)
+        num = int(num)
+
+        topic = self.topics['stats']
+        ret = topic.request(self.client, b'', timeout=5,
+                            archi=archi, num=num)
+        print(ret.decode('utf-8'))
+
+    def help_stats(self):
+        """Help stats command."""
+        print(self.STATS_USAGE, end='')
+
     # # # # # #
     # stopall #
     # # # # # #
@@ -161,6 +368,45 @@ class SerialShell(clientcommon.CmdShell):
         """Help stopall command."""
         print(self.STOPALL_USAGE, end='')
 
+    # # # # # # # # # #
+    # bulklinestart   #
+    # # # # # # # # # #
+    def do_bulklinestart(self, arg):
+        """Start line mode to given nodes: ARCHI NODESET"""
+        self._bulk_request('bulklinestart', arg, timeout=30)
+
+    def help_bulklinestart(self):
+        """Help bulklinestart command."""
+        print(self.BULKLINESTART_USAGE, end='')
+
+    # # # # # # # # # #
+    # bulklinestop    #
+    # # # # # # # # # #
+    def do_bulklinestop(self, arg):
+        """Stop given nodes redirection: ARCHI NODESET"""
+        self._bulk_request('bulklinestop', arg)
+
+    def help_bulklinestop(self):
+        """Help bulklinestop command."""
+        print(self.BULKLINESTOP_USAGE, end='')
+
+    def _bulk_request(self, name, arg, timeout=5):
+        """Do bulk request ``name`` and print failed nodes."""
+        archi, nodeset = self.cmd_split(arg)
+        common.expand_nodeset(nodeset)
+
+        topic = self.topics[name]
+        payload = ('%s %s' % (archi, nodeset)).encode('utf-8')
+        ret = topic.request(self.client, payload, timeout=timeout)
+        try:
+            result = json.loads(ret.decode('utf-8'))
+        except ValueError:
+            raise RuntimeError(ret.decode('utf-8'))
+
+        for num, error in sorted(result.items(), key=lambda x: int(x[0])):
+            if error:
+                print('%s-%s: %s' % (archi, num, error))
+
     def run(self):
         """Run client and shell."""
         self.start()
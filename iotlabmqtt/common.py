@@ -10,10 +10,16 @@ from builtins import *  # pylint:disable=W0401,W0614,W0622
 
 import os
 import sys
+import json
 import hashlib
 import signal
 import string
+import time
 import argparse
+import threading
+import itertools
+import functools
+import collections
 
 
 def topic_lazyformat(topic, **kwargs):
@@ -120,6 +126,70 @@ class MQTTAgentArgumentParser(argparse.ArgumentParser):
         self.add_argument('--agenttopic', help='Agent topic overwrite')
 
 
+NODESET_MAX = 1024
+
+
+def expand_nodeset(nodeset):
+    """Return nodes numbers list for ``nodeset`` ranges string.
+
+    Duplicate numbers are only returned once, ranges are limited to
+    ``NODESET_MAX`` nodes.
+
+    >>> expand_nodeset('1-3,5,8-9')
+    [1, 2, 3, 5, 8, 9]
+    >>> expand_nodeset('3')
+    [3]
+    >>> expand_nodeset('5,1-3,2')
+    [5, 1, 2, 3]
+
+    >>> expand_nodeset('1-a')
+    Traceback (most recent call last):
+    ValueError: Invalid nodeset '1-a'
+    >>> expand_nodeset('5-3')
+    Traceback (most recent call last):
+    ValueError: Invalid nodeset '5-3'
+    >>> expand_nodeset('1-100000000')
+    Traceback (most recent call last):
+    ValueError: Invalid nodeset '1-100000000', more than 1024 nodes
+    """
+    try:
+        ranges = [_nodes_range(nodes_range)
+                  for nodes_range in nodeset.split(',')]
+    except ValueError:
+        ranges = [None]
+
+    if not all(ranges):
+        raise ValueError('Invalid nodeset %r' % str(nodeset))
+    if sum(len(nodes_range) for nodes_range in ranges) > NODESET_MAX:
+        raise ValueError('Invalid nodeset %r, more than %u nodes' %
+                         (str(nodeset), NODESET_MAX))
+    nums = collections.OrderedDict.fromkeys(itertools.chain(*ranges))
+    return list(nums)
+
+
+def _nodes_range(nodes_range):
+    """Return range for ``'FIRST[-LAST]'`` string."""
+    first, _, last = nodes_range.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+def nodes_from_str(nodes_str):
+    """Return ``archi`` and nodes numbers from ``'ARCHI NODESET'`` string.
+
+    >>> nodes_from_str('m3 1-3,7') == ('m3', [1, 2, 3, 7])
+    True
+    >>> nodes_from_str('m3')
+    Traceback (most recent call last):
+    ValueError: Invalid nodes 'm3', should be 'ARCHI NODESET'
+    """
+    try:
+        archi, nodeset = nodes_str.split()
+        return archi, expand_nodeset(nodeset)
+    except ValueError:
+        raise ValueError("Invalid nodes %r, should be 'ARCHI NODESET'" %
+                         str(nodes_str))
+
+
 def hostname():
     """Return system 'hostname'.
 
@@ -167,6 +237,142 @@ def synchronized(lockname):
     return _wrapper
 
 
+def close_handler(handler):
+    """Close data ``handler`` if it supports it."""
+    close = getattr(handler, 'close', None)
+    if close is not None:
+        close()
+
+
+class BulkReply(object):
+    """Collect nodes requests replies and publish them once as json.
+
+    Reply is a json object with nodes ``num`` as keys and their reply as value.
+
+    :param reply_publisher: bulk request reply publisher
+    :param nums: nodes numbers
+    """
+
+    def __init__(self, reply_publisher, nums):
+        self.reply_publisher = reply_publisher
+        self.pending = set(str(num) for num in nums)
+        self.result = {}
+        self._lock = threading.Lock()
+
+    def publisher(self, num):
+        """Return reply publisher for node ``num`` request."""
+        return functools.partial(self.reply, str(num))
+
+    def reply(self, num, payload):
+        """Save node ``num`` reply, publish all replies on the last one."""
+        with self._lock:  # pylint:disable=not-context-manager
+            self.result[num] = payload.decode('utf-8')
+            self.pending.discard(num)
+            if self.pending:
+                return
+
+        result = json.dumps(self.result, sort_keys=True)
+        self.reply_publisher(result.encode('utf-8'))
+
+
+class DataBatcher(object):
+    """Concatenate data chunks and call ``handler`` on batches.
+
+    A batch is handled when it reaches ``size`` bytes or ``delay`` seconds
+    after its first chunk was received.
+    With both set to 0, chunks are handled as is.
+    With only ``size``, data is kept until enough has been received.
+
+    :param handler: callback for batched data
+    :param size: batch size in bytes, 0 to disable
+    :param delay: maximum time in seconds data is kept, 0 to disable
+    """
+
+    def __init__(self, handler, size=0, delay=0):
+        self.handler = handler
+        self.size = size
+        self.delay = delay
+
+        self.chunks = []
+        self.length = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __call__(self, data):
+        """Add ``data`` to current batch, handle it if full."""
+        if not (self.size or self.delay):
+            self.handler(data)
+            return
+
+        # Handler is called under lock to keep batches in order
+        with self._lock:  # pylint:disable=not-context-manager
+            self.chunks.append(data)
+            self.length += len(data)
+
+            if self.size and self.length >= self.size:
+                self._flush()
+            elif self.delay and self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Handle current batch if not empty."""
+        with self._lock:  # pylint:disable=not-context-manager
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self.chunks:
+            return
+
+        batch = b''.join(self.chunks)
+        self.chunks = []
+        self.length = 0
+        self.handler(batch)
+
+    def close(self):
+        """Handle remaining data and stop timer."""
+        self.flush()
+
+
+class TokenBucket(object):
+    """Token bucket refilled with ``rate`` tokens per second.
+
+    Bucket holds at most ``burst`` tokens, by default one second of ``rate``.
+
+    >>> bucket = TokenBucket(10, clock=lambda: 0.0)
+    >>> bucket.available(10), bucket.available(11)
+    (True, False)
+    >>> bucket.consume(10)
+    >>> bucket.available(1)
+    False
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = rate
+        self.burst = burst or rate
+        self.clock = clock
+
+        self.tokens = self.burst
+        self.last = clock()
+
+    def available(self, amount):
+        """Return if ``amount`` tokens are available."""
+        now = self.clock()
+        elapsed = max(0, now - self.last)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last = now
+        return self.tokens >= amount
+
+    def consume(self, amount):
+        """Remove ``amount`` tokens, check with ``available`` before."""
+        self.tokens -= amount
+
+
 def wait_sigint():
     """Pause until Ctrl+C."""
     try:
@@ -7,6 +7,8 @@ from __future__ import (absolute_import, division, print_function,
 from builtins import *  # pylint:disable=W0401,W0614,W0622
 
 import tempfile
+import functools
+import threading
 
 from . import common
 
@@ -20,6 +22,9 @@ def parser_add_iotlabapi_args(parser, group_help='IoT-LAB API configuration'):
                        help='IoT-LAB password')
     group.add_argument('--experiment-id', dest='experiment_id', type=int,
                        help='experiment id submission')
+    group.add_argument('--api-batch-window', type=float, default=0.1,
+                       help='Group same nodes commands received in this '
+                            'window in seconds in one API call, 0 disabled')
 
 
 class IoTLABAPI(object):
@@ -210,6 +215,214 @@ class IoTLABAPI(object):
         return result
 
 
+class CommandBatcher(object):
+    """Coalesce nodes commands with the same arguments in one API call.
+
+    ``batcher(*args, num)`` waits ``window`` seconds for other nodes with the
+    same ``args``, then ``command(*args, *nums)`` is called once for all.
+    Each caller gets the result dict for its ``num``.
+    If all nodes got the same error, it may be caused by only one of them, so
+    the batch is split in halves run again, down to the failing nodes.
+    When both halves get the same error, it is global (API down, experiment
+    ended, ...) and is not retried. At most ``MAX_RETRIES`` extra calls are
+    done for a batch.
+    Callers are blocked until the command returns, so call it from a thread,
+    or use ``submit`` to get the result in a callback.
+
+    Batches are run in the timer thread, or given to ``dispatch`` as
+    ``dispatch(run, fail, args, nums)`` that must later call ``run()`` to run
+    the batch, or ``fail(message)`` to reply ``message`` to all nodes.
+
+    :param command: function returning ``{str(num): result}`` like
+        ``IoTLABAPI.node_command``
+    :param window: time in seconds to wait for other nodes, 0 to disable
+    :param dispatch: function scheduling batches runs
+    """
+
+    NO_RESULT = 'Error: no result for node'
+    MAX_RETRIES = 16
+
+    def __init__(self, command, window=0.1, dispatch=None):
+        self.command = command
+        self.window = window
+        self.dispatch = dispatch
+        self.batches = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        """Run command for ``*args`` and node ``num`` as last argument."""
+        args, num = args[:-1], args[-1]
+        if not self.window:
+            return self.command(*(args + (num,)))
+
+        batch = self._add(args, num)
+        batch['done'].wait()
+        return self._result(batch, num)
+
+    def submit(self, callback, *args):
+        """Run command for ``*args`` and node ``num`` without blocking.
+
+        ``callback`` is called with the result dict for ``num`` from the
+        thread running the command.
+        """
+        args, num = args[:-1], args[-1]
+        if self.window:
+            self._add(args, num, callback)
+            return
+
+        batch = self._new_batch()
+        batch['nums'].append(num)
+        batch['callbacks'].append((callback, num))
+        if self.dispatch is None:
+            threading.Thread(target=self._run_batch,
+                             args=(args, batch)).start()
+        else:
+            self._dispatch(args, batch)
+
+    @staticmethod
+    def _new_batch():
+        return {'nums': [], 'result': {}, 'callbacks': [],
+                'done': threading.Event()}
+
+    @common.synchronized('_lock')
+    def _add(self, args, num, callback=None):
+        """Add ``num`` to the pending batch for ``args`` or start one.
+
+        ``callback`` is called with ``num`` result when the batch is run.
+        """
+        try:
+            batch = self.batches[args]
+        except KeyError:
+            batch = self._new_batch()
+            self.batches[args] = batch
+            timer = threading.Timer(self.window, self._run, (args,))
+            timer.daemon = True
+            timer.start()
+
+        if num not in batch['nums']:
+            batch['nums'].append(num)
+        if callback is not None:
+            batch['callbacks'].append((callback, num))
+        return batch
+
+    @classmethod
+    def _result(cls, batch, num):
+        """Result dict for ``num`` in ``batch``."""
+        return {str(num): batch['result'].get(str(num), cls.NO_RESULT)}
+
+    def _run(self, args):
+        """Run ``args`` batch at the end of the window."""
+        with self._lock:  # pylint:disable=not-context-manager
+            batch = self.batches.pop(args)
+        self._dispatch(args, batch)
+
+    def _dispatch(self, args, batch):
+        """Run ``batch`` now or with 'dispatch'."""
+        if self.dispatch is None:
+            self._run_batch(args, batch)
+            return
+
+        run = functools.partial(self._run_batch, args, batch)
+        fail = functools.partial(self._fail_batch, batch)
+        self.dispatch(run, fail, args, tuple(batch['nums']))
+
+    def _run_batch(self, args, batch):
+        """Run command for ``args`` batch and reply to callers."""
+        result = {}
+        try:
+            result = self._run_command(args, tuple(batch['nums']))
+        finally:
+            self._finish(batch, result)
+
+    def _fail_batch(self, batch, message):
+        """Reply ``message`` to batch callers."""
+        self._finish(batch, IoTLABAPI.retval(message, *batch['nums']))
+
+    def _finish(self, batch, result):
+        """Set batch ``result`` and wake up callers."""
+        batch['result'] = result
+        batch['done'].set()
+
+        for callback, num in batch['callbacks']:
+            self._callback(callback, batch, num)
+
+    def _callback(self, callback, batch, num):
+        """Call ``callback`` with ``num`` result.
+
+        A failing callback must not prevent replying to other nodes.
+        """
+        try:
+            callback(self._result(batch, num))
+        except Exception:  # pylint:disable=broad-except
+            pass
+
+    def _run_command(self, args, nums):
+        """Run command for ``nums``, bisect the batch if it failed."""
+        result = self._command(args, nums)
+        self._bisect(args, nums, result, [self.MAX_RETRIES])
+        return result
+
+    def _bisect(self, args, nums, result, retries):
+        """Run failed ``nums`` batch again in halves, updating ``result``.
+
+        ``retries`` is the list of the remaining calls count.
+        """
+        retry = len(nums) > 1 and retries[0] > 1
+        if not retry or not self._batch_failed(result, nums):
+            return
+        retries[0] -= 2
+
+        halves = (nums[:len(nums) // 2], nums[len(nums) // 2:])
+        results = [self._command(args, half) for half in halves]
+        if self._global_error(result, nums, results, halves):
+            return
+
+        for half, half_result in zip(halves, results):
+            for num in half:
+                result.pop(str(num), None)
+            result.update(half_result)
+            self._bisect(args, half, result, retries)
+
+    @classmethod
+    def _global_error(cls, result, nums, results, halves):
+        """Return if both ``halves`` failed with ``nums`` batch error.
+
+        >>> CommandBatcher._global_error(
+        ...     {'1': 'err', '2': 'err'}, (1, 2),
+        ...     [{'1': 'err'}, {'2': 'err'}], ((1,), (2,)))
+        True
+        >>> CommandBatcher._global_error(
+        ...     {'1': 'err', '2': 'err'}, (1, 2),
+        ...     [{'1': ''}, {'2': 'err'}], ((1,), (2,)))
+        False
+        """
+        error = result.get(str(nums[0]))
+        errors = [cls._batch_failed(res, half) and res.get(str(half[0]))
+                  for res, half in zip(results, halves)]
+        return errors == [error] * len(halves)
+
+    def _command(self, args, nums):
+        """Run command, exceptions are returned as nodes results."""
+        try:
+            return self.command(*(args + nums))
+        except Exception:  # pylint:disable=broad-except
+            return IoTLABAPI.retval(common.traceback_error(), *nums)
+
+    @staticmethod
+    def _batch_failed(result, nums):
+        """Return if all ``nums`` got the same error or no result.
+
+        >>> CommandBatcher._batch_failed({'1': 'err', '2': 'err'}, (1, 2))
+        True
+        >>> CommandBatcher._batch_failed({'1': 'err', '2': ''}, (1, 2))
+        False
+        >>> CommandBatcher._batch_failed({'1': ''}, (1, 2))
+        False
+        """
+        errors = set(result.get(str(num)) for num in nums)
+        return len(errors) == 1 and errors != {''}
+
+
 def node_from_infos(archi, num, site):  # pylint:disable=unused-argument
     """Node hostname from infos.
 
@@ -28,6 +28,7 @@ Topics Summary
 .. |reset|            replace:: |node|\ ``/ctl/reset``
 .. |poweron|          replace:: |node|\ ``/ctl/poweron``
 .. |poweroff|         replace:: |node|\ ``/ctl/poweroff``
+.. |stats|            replace::  ``{nodeagenttopic}/ctl/stats``
 .. |error_t|          replace::  ``{nodeagenttopic}/error/``
 
 
@@ -46,6 +47,8 @@ Topics Summary
 +-+---------------------------------------------------------------+-----------+
 | ||error_t|                                                      | |error|   |
 +-+---------------------------------------------------------------+-----------+
+| ||stats|                                                        ||request|  |
++-+---------------------------------------------------------------+-----------+
 |  **Node**                                                                   |
 +-+---------------------------------------------------------------+-----------+
 | ||update|                                                       ||request|  |
@@ -73,11 +76,45 @@ Failure on requests are not duplicated here.
 For format see: :ref:`ErrorTopic`
 
 
+Commands queue statistics
+-------------------------
+
+Nodes commands are run by ``--workers`` threads.
+Commands on the same node are run one at a time in the order they were
+received. Between different nodes, ``poweroff`` and ``reset`` are run
+first, then ``poweron`` and ``update``.
+At most ``--max-queued`` commands wait to be run, new commands get an
+error reply when the queue is full.
+Commands still queued when the agent stops get an error reply.
+
+This request returns the queue statistics as a ``json`` object with the
+number of ``queued`` and ``running`` commands, ``workers``, ``max_queued``,
+the number of ``rejected`` commands and for each command the ``wait``
+``count``, ``mean`` and ``max`` time in seconds before being run.
+
+
++-----------------------------------------------------------------------------+
+| ``stats`` request:                                                          |
++============+================================================================+
+| Topic:     |    |stats|                                                     |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
++------------+-----------------------------------------+----------------------+
+
+
 Node topics
 ===========
 
 Requests to interact with nodes.
 
+``reset``, ``poweron`` and ``poweroff`` requests for nodes with the same
+``archi`` received within ``--api-batch-window`` seconds are run with one
+IoT-LAB API call.
+
 
 .. |postnotespace| raw:: html
 
@@ -184,6 +221,9 @@ from __future__ import (absolute_import, division, print_function,
 from builtins import *  # pylint:disable=W0401,W0614,W0622
 
 import os
+import json
+import time
+import functools
 import threading
 import tempfile
 import contextlib
@@ -194,6 +234,10 @@ from . import mqttcommon
 
 PARSER = common.MQTTAgentArgumentParser()
 iotlabapi.parser_add_iotlabapi_args(PARSER)
+PARSER.add_argument('--workers', type=int, default=4,
+                    help='Number of nodes commands run at the same time')
+PARSER.add_argument('--max-queued', type=int, default=256,
+                    help='Maximum number of commands waiting to be run')
 
 
 @contextlib.contextmanager
@@ -208,6 +252,163 @@ def _firmware_file(data):
         yield tmpfile.name
 
 
+class CommandQueue(object):  # pylint:disable=too-many-instance-attributes
+    """Run nodes commands by priority with a bounded number of workers.
+
+    Commands are run by ``workers`` threads. A command can only be run when
+    no command queued before is running or waiting on one of its nodes, so
+    each node commands are run one at a time in submission order.
+    Between these runnable commands, lowest ``priorities`` are run first.
+
+    Commands reply by themselves, ``error_cb(message)`` is called instead
+    if the command raises an exception, the queue is full or the command is
+    dropped on ``stop``.
+
+    :param workers: number of worker threads
+    :param priorities: commands names priority, lowest first
+    :param clock: function returning current time
+    :param max_queued: maximum number of commands waiting to be run
+    """
+    FULL = 'Error: commands queue full'
+    STOPPED = 'Error: node agent stopped'
+
+    def __init__(self, workers, priorities, clock=time.time, max_queued=256):
+        self.workers = workers
+        self.priorities = priorities
+        self.clock = clock
+        self.max_queued = max_queued
+
+        # Jobs in submission order
+        self.queue = []
+        self.busy = set()
+        self.running = 0
+        self.rejected = 0
+        # Commands wait [count, sum, max]
+        self.waits = {}
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Start workers threads."""
+        self._closed = False
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop workers, queued commands get an error."""
+        with self._cond:
+            self._closed = True
+            jobs, self.queue = self.queue, []
+            self._cond.notify_all()
+
+        for job in jobs:
+            self._error(job, self.STOPPED)
+
+    def submit(  # pylint:disable=too-many-arguments
+            self, name, nodes, func, args=(), error_cb=None):
+        """Queue command ``name`` running ``func(*args)`` on ``nodes``."""
+        job = {'name': name, 'nodes': frozenset(nodes), 'call': (func, args),
+               'error_cb': error_cb, 'queued': self.clock()}
+        with self._cond:
+            error = self._queue_job(job)
+
+        if error is not None:
+            self._error(job, error)
+
+    def _queue_job(self, job):
+        """Add ``job`` to the queue, return an error if rejected."""
+        if self._closed:
+            return self.STOPPED
+        if len(self.queue) >= self.max_queued:
+            self.rejected += 1
+            return self.FULL
+        self.queue.append(job)
+        self._cond.notify()
+        return None
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self._run_job(job)
+
+    def _next_job(self):
+        """Wait for a job that can be run, None when stopped."""
+        with self._cond:
+            while not self._closed:
+                job = self._pop_runnable()
+                if job is not None:
+                    self.busy |= job['nodes']
+                    self.running += 1
+                    self._add_wait(job['name'], self.clock() - job['queued'])
+                    return job
+                self._cond.wait()
+            return None
+
+    def _pop_runnable(self):
+        """Pop highest priority job whose nodes are not used before it."""
+        blocked = set(self.busy)
+        best = None
+        for job in self.queue:
+            if job['nodes'].isdisjoint(blocked) and self._before(job, best):
+                best = job
+            blocked |= job['nodes']
+
+        if best is not None:
+            self.queue.remove(best)
+        return best
+
+    def _before(self, job, other):
+        """Return if ``job`` has higher priority than ``other``."""
+        if other is None:
+            return True
+        return self.priorities[job['name']] < self.priorities[other['name']]
+
+    def _add_wait(self, name, wait):
+        counters = self.waits.setdefault(name, [0, 0.0, 0.0])
+        counters[0] += 1
+        counters[1] += wait
+        counters[2] = max(counters[2], wait)
+
+    def _run_job(self, job):
+        func, args = job['call']
+        try:
+            func(*args)
+        except Exception:  # pylint:disable=broad-except
+            self._error(job, 'Error: %s' % common.traceback_error())
+        finally:
+            with self._cond:
+                self.busy -= job['nodes']
+                self.running -= 1
+                self._cond.notify_all()
+
+    @staticmethod
+    def _error(job, message):
+        """Call job 'error_cb' with ``message``."""
+        if job['error_cb'] is None:
+            return
+        try:
+            job['error_cb'](message)
+        except Exception:  # pylint:disable=broad-except
+            pass
+
+    def get_stats(self):
+        """Return queue depth, running commands and commands wait times."""
+        with self._cond:
+            return {
+                'queued': len(self.queue), 'running': self.running,
+                'workers': self.workers, 'max_queued': self.max_queued,
+                'rejected': self.rejected,
+                'wait': {name: {'count': count, 'mean': total / count,
+                                'max': maxwait}
+                         for name, (count, total, maxwait)
+                         in self.waits.items()},
+            }
+
+
 class MQTTNodeAgent(object):
     """Node Agent implementation for MQTT."""
     AGENTTOPIC = 'iot-lab/node/{site}'
@@ -215,8 +416,13 @@ class MQTTNodeAgent(object):
         'node': '{archi}/{num}',
     }
     HOSTNAME = common.hostname()
+    # Commands run for all nodes received in a batch window
+    BATCHED_COMMANDS = ('reset', 'poweron', 'poweroff')
+    PRIORITIES = {'poweroff': 0, 'reset': 1, 'poweron': 2, 'update': 3}
 
-    def __init__(self, client, prefix='', iotlab_api=None):
+    def __init__(self, client,  # pylint:disable=too-many-arguments
+                 prefix='', iotlab_api=None, api_batch_window=0.1, workers=4,
+                 max_queued=256):
         assert iotlab_api
         super().__init__()
 
@@ -234,35 +440,46 @@ class MQTTNodeAgent(object):
             'poweroff': mqttcommon.RequestServer(_topics['node'], 'poweroff',
                                                  callback=self.cb_poweroff),
 
+            'stats': mqttcommon.RequestServer(_topics['agenttopic'], 'stats',
+                                              callback=self.cb_stats),
+
             'error': mqttcommon.ErrorServer(_topics['agenttopic']),
         }
 
         self.iotlabapi = iotlab_api
+        self.queue = CommandQueue(workers, self.PRIORITIES,
+                                  max_queued=max_queued)
+        self.commands = {
+            name: iotlabapi.CommandBatcher(
+                functools.partial(self._api_command, name), api_batch_window,
+                dispatch=functools.partial(self._dispatch, name))
+            for name in self.BATCHED_COMMANDS
+        }
 
         self.client = client
         self.client.topics = list(self.topics.values())
 
     def cb_reset(self, message, archi, num):
         """Reset node cpu."""
-        args = (self.iotlabapi.reset, message.reply_publisher, archi, num)
-        threading.Thread(target=self._thread_command, args=args).start()
-        return None
+        return self._batched_command('reset', message, archi, num)
 
     def cb_update(self, message, archi, num):
         """Update node firmware."""
         args = (message.payload, message.reply_publisher, archi, num)
-        threading.Thread(target=self._thread_update, args=args).start()
+        error_cb = functools.partial(self._reply_error,
+                                     message.reply_publisher)
+        self.queue.submit('update', [(archi, num)], self._update, args,
+                          error_cb)
         return None
 
-    def _thread_update(self, firmware, reply_publisher, archi, num):
+    def _update(self, firmware, reply_publisher, archi, num):
         if not firmware:
             ret_dict = self.iotlabapi.update_idle(archi, num)
         else:
             with _firmware_file(firmware) as firmware_path:
                 ret_dict = self.iotlabapi.update(firmware_path, archi, num)
 
-        ret = ret_dict[str(num)]
-        reply_publisher(ret.encode('utf-8'))
+        self._reply_command(reply_publisher, num, ret_dict)
 
     @staticmethod
     def _idle_m3_firmware():
@@ -273,22 +490,44 @@ class MQTTNodeAgent(object):
 
     def cb_poweron(self, message, archi, num):
         """Power ON node."""
-        args = (self.iotlabapi.poweron, message.reply_publisher, archi, num)
-        threading.Thread(target=self._thread_command, args=args).start()
-        return None
+        return self._batched_command('poweron', message, archi, num)
 
     def cb_poweroff(self, message, archi, num):
         """Power OFF node."""
-        args = (self.iotlabapi.poweroff, message.reply_publisher, archi, num)
-        threading.Thread(target=self._thread_command, args=args).start()
+        return self._batched_command('poweroff', message, archi, num)
+
+    def _batched_command(self, command, message, archi, num):
+        """Run ``command`` in the batch of same archi nodes, reply async."""
+        reply = functools.partial(self._reply_command, message.reply_publisher,
+                                  num)
+        self.commands[command].submit(reply, archi, num)
         return None
 
+    def _dispatch(  # pylint:disable=too-many-arguments
+            self, command, run, fail, args, nums):
+        """Queue batch of ``command`` for ``args`` archi and ``nums``."""
+        archi = args[0]
+        nodes = [(archi, num) for num in nums]
+        self.queue.submit(command, nodes, run, error_cb=fail)
+
+    def _api_command(self, command, archi, *nums):
+        """Run IoT-LAB API ``command`` for nodes."""
+        return getattr(self.iotlabapi, command)(archi, *nums)
+
     @staticmethod
-    def _thread_command(func, reply_publisher, archi, num):
-        ret_dict = func(archi, num)
-        ret = ret_dict[str(num)]
+    def _reply_command(reply_publisher, num, ret_dict):
+        ret = ret_dict.get(str(num), iotlabapi.CommandBatcher.NO_RESULT)
         reply_publisher(ret.encode('utf-8'))
 
+    @staticmethod
+    def _reply_error(reply_publisher, message):
+        reply_publisher(message.encode('utf-8'))
+
+    def cb_stats(self, _):
+        """Return commands queue statistics."""
+        stats = self.queue.get_stats()
+        return json.dumps(stats, sort_keys=True).encode('utf-8')
+
     # Agent running
 
     def run(self):
@@ -301,18 +540,24 @@ class MQTTNodeAgent(object):
 
     def start(self):
         """Start Agent."""
+        self.queue.start()
         self.client.start()
 
     def stop(self):
         """Stop agent."""
         self.client.stop()
+        self.queue.stop()
 
     @classmethod
-    def from_opts_dict(cls, prefix, **kwargs):
+    def from_opts_dict(cls, prefix,  # pylint:disable=too-many-arguments
+                       api_batch_window=0.1, workers=4, max_queued=256,
+                       **kwargs):
         """Create class from argparse entries."""
         api = iotlabapi.IoTLABAPI.from_opts_dict(**kwargs)
         client = mqttcommon.MQTTClient.from_opts_dict(**kwargs)
-        return cls(client, prefix, iotlab_api=api)
+        return cls(client, prefix, iotlab_api=api,
+                   api_batch_window=api_batch_window, workers=workers,
+                   max_queued=max_queued)
 
 
 def main():
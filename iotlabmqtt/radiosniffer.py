@@ -27,7 +27,31 @@ Topics Summary
 .. |rawchannel|       replace::  |node|\ ``/raw/data``
 .. |rawstart|         replace::  |node|\ ``/raw/ctl/start``
 .. |rawstop|          replace::  |node|\ ``/raw/ctl/stop``
+.. |zepheader|        replace::  ``{snifferagenttopic}/zep/ctl/zepheader``
+.. |zep|              replace::  |node|\ ``/zep``
+.. |zepchannel|       replace::  |node|\ ``/zep/data``
+.. |zepstart|         replace::  |node|\ ``/zep/ctl/start``
+.. |zepstop|          replace::  |node|\ ``/zep/ctl/stop``
+.. |pcapngheader|     replace:: ``{snifferagenttopic}/pcapng/ctl/pcapngheader``
+.. |pcapng|           replace::  |node|\ ``/pcapng``
+.. |pcapngchannel|    replace::  |node|\ ``/pcapng/data``
+.. |pcapngstart|      replace::  |node|\ ``/pcapng/ctl/start``
+.. |pcapngstop|       replace::  |node|\ ``/pcapng/ctl/stop``
+.. |pcapngiface|      replace::  |node|\ ``/pcapng/ctl/interface``
+.. |mergedheader|     replace:: ``{snifferagenttopic}/merged/ctl/mergedheader``
+.. |mergedstats|      replace::  ``{snifferagenttopic}/merged/ctl/stats``
+.. |mergedchannel|    replace::  ``{snifferagenttopic}/merged/data``
+.. |mergedstart|      replace::  |node|\ ``/merged/ctl/start``
+.. |mergedbulkstart|  replace::  ``{snifferagenttopic}/merged/ctl/start``
+.. |mergedbulkstop|   replace::  ``{snifferagenttopic}/merged/ctl/stop``
+.. |mergedstop|       replace::  |node|\ ``/merged/ctl/stop``
+.. |statsstart|       replace::  |node|\ ``/stats/ctl/start``
+.. |statsstop|        replace::  |node|\ ``/stats/ctl/stop``
+.. |statschannel|     replace::  |node|\ ``/stats/data``
 .. |stop|             replace::  |node|\ ``/ctl/stop``
+.. |dump|             replace::  |node|\ ``/ctl/dump``
+.. |ringstart|        replace::  |node|\ ``/ring/ctl/start``
+.. |ringstop|         replace::  |node|\ ``/ring/ctl/stop``
 .. |stopall|          replace::  ``{snifferagenttopic}/ctl/stopall``
 .. |error_t|          replace::  ``{snifferagenttopic}/error/``
 
@@ -55,6 +79,12 @@ Topics Summary
 +-+---------------------------------------------------------------+-----------+
 | ||stop|                                                         ||request|  |
 +-+---------------------------------------------------------------+-----------+
+| ||dump|                                                         ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||ringstart|                                                    ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||ringstop|                                                     ||request|  |
++-+---------------------------------------------------------------+-----------+
 |  **Raw packet sniffer**                                                     |
 +-+---------------------------------------------------------------+-----------+
 | ||rawheader|                                                    ||request|  |
@@ -66,6 +96,56 @@ Topics Summary
 | ||rawchannel|                                                   || Output   |
 | |                                                               || |channel||
 +-+---------------------------------------------------------------+-----------+
+|  **ZEP packet sniffer**                                                     |
++-+---------------------------------------------------------------+-----------+
+| ||zepheader|                                                    ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||zepstart|                                                     ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||zepstop|                                                      ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||zepchannel|                                                   || Output   |
+| |                                                               || |channel||
++-+---------------------------------------------------------------+-----------+
+|  **Pcapng packet sniffer**                                                  |
++-+---------------------------------------------------------------+-----------+
+| ||pcapngheader|                                                 ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||pcapngstart|                                                  ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||pcapngstop|                                                   ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||pcapngiface|                                                  ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||pcapngchannel|                                                || Output   |
+| |                                                               || |channel||
++-+---------------------------------------------------------------+-----------+
+|  **Merged packet sniffer**                                                  |
++-+---------------------------------------------------------------+-----------+
+| ||mergedheader|                                                 ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||mergedstats|                                                  ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||mergedbulkstart|                                              ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||mergedbulkstop|                                               ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||mergedstart|                                                  ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||mergedstop|                                                   ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||mergedchannel|                                                || Output   |
+| |                                                               || |channel||
++-+---------------------------------------------------------------+-----------+
+|  **Radio statistics**                                                       |
++-+---------------------------------------------------------------+-----------+
+| ||statsstart|                                                   ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||statsstop|                                                    ||request|  |
++-+---------------------------------------------------------------+-----------+
+| ||statschannel|                                                 || Output   |
+| |                                                               || |channel||
++-+---------------------------------------------------------------+-----------+
 
 
 Radio sniffer Agent global topics
@@ -126,6 +206,72 @@ Stop given node sniffer.
 +------------+-----------------------------------------+----------------------+
 
 
+Dump ring buffer
+----------------
+
+With ``--ring-buffer-size`` bytes, each node sniffed packets are also kept
+in a ring buffer, whatever the started modes, the oldest packets being
+dropped when the node buffer is full. Each packet also counts for about
+100 bytes of bookkeeping in the buffer size.
+The buffer is kept after ``stop``, ``stopall`` removes all nodes buffers.
+To fill it without publishing packets, start the sniffer in ``ring`` mode.
+
+This request returns the packets received in the last ``seconds`` as a
+complete pcap file in ``raw`` mode, or ``zep`` mode if requested.
+
+:param seconds: dump duration in seconds
+:param mode: ``raw`` or ``zep``, ``raw`` if not provided
+
++-----------------------------------------------------------------------------+
+| ``dump`` request:                                                           |
++============+================================================================+
+| Topic:     |    |dump|                                                      |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``seconds [mode]``   |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | `Pcap file` or error |
++------------+-----------------------------------------+----------------------+
+
+
+Ring buffer only sniffer
+------------------------
+
+Start node sniffer on ``channel`` only to fill its ring buffer, without
+publishing packets, so ``dump`` works without a running output.
+It requires ``--ring-buffer-size``, and takes no frames filter as the ring
+keeps all sniffed packets.
+It is stopped like other modes, the node sniffer keeps running for the
+other started modes.
+
+:param channel: 802.15.4 channel between 11 and 26
+
++-----------------------------------------------------------------------------+
+| ``ring/start`` request:                                                     |
++============+================================================================+
+| Topic:     |    |ringstart|                                                 |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``Channel string``   |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
++-----------------------------------------------------------------------------+
+| ``ring/stop`` request:                                                      |
++============+================================================================+
+| Topic:     |    |ringstop|                                                  |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
 Raw packet sniffer
 ==================
 
@@ -134,6 +280,12 @@ Sniffer listen to all radio packets on a given ``channel``.
 
 It must first be started in ``raw`` mode to have the raw packet output.
 
+Nodes started on the same ``channel`` within ``--api-batch-window`` seconds
+get their sniffer profile loaded with one IoT-LAB API call.
+The profile is not loaded again when restarting a node on the same
+``channel``, until the node is reset, updated or powered off through the
+node agent.
+
 Global pcap header must be queried independently first.
 
 :param channel: 802.15.4 channel between 11 and 26
@@ -143,6 +295,20 @@ Start sniffer in *raw* mode
 
 Start one node sniffer in *raw* mode on given ``channel``.
 
+``channel`` can be followed by a space and a frames filter expression.
+Only the 802.15.4 frames matching it are sent, it is evaluated by the agent
+on the MAC header fields: ::
+
+   type == data and pan == 0xabcd and not (dst == 0xffff)
+
+Fields are ``type`` (``beacon``, ``data``, ``ack``, ``cmd`` or number),
+``len``, ``pan``, ``src_pan``, ``dst`` and ``src``. Addresses are short
+or extended, written as numbers or ``00:12:4b:00:01:02:03:04``.
+Comparisons are ``== != < <= > >=`` combined with ``and``, ``or``,
+``not`` and parentheses. Comparisons on a field not in the frame are false.
+
+Filter also applies to other modes start requests.
+
 +-----------------------------------------------------------------------------+
 | ``raw/start`` request:                                                      |
 +============+================================================================+
@@ -151,6 +317,7 @@ Start one node sniffer in *raw* mode on given ``channel``.
 |**Message** | **Topic**                               | **Payload**          |
 +------------+-----------------------------------------+----------------------+
 | Request    | |request_topic|                         | ``Channel string``   |
+|            |                                         | [filter expression]  |
 +------------+-----------------------------------------+----------------------+
 | Reply      | |reply_topic|                           | *empty* or error_msg |
 +------------+-----------------------------------------+----------------------+
@@ -159,67 +326,557 @@ Start one node sniffer in *raw* mode on given ``channel``.
 Stop raw sniffer
 ----------------
 
-Equivalent to :ref:`stop_sniffer` adde here for completeness
+Stop node *raw* output only, other started modes keep running.
+Node sniffer is stopped with its last output, like
+:ref:`stop_sniffer`.
+
++-----------------------------------------------------------------------------+
+| ``raw/stop`` request:                                                       |
++============+================================================================+
+| Topic:     |    |rawstop|                                                   |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+RAW packet sniffer PCAP global header
+-------------------------------------
+
+PCAP format consists of two main parts, a global header, then messages with a
+per message header: `wireshark:pcap`_
+
+This request returns the global header for ``raw`` mode.
+
+
++-----------------------------------------------------------------------------+
+| ``raw/header`` request:                                                     |
++============+================================================================+
+| Topic:     |    |rawheader|                                                 |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | `Global pcap header` |
++------------+-----------------------------------------+----------------------+
+
+
+Raw packet sniffer
+------------------
+
+Sniffer sends 802.15.4 raw radio frames encapsulated as ``pcap``.
+
+One sniffed packet is sent by message, unless batching is configured with
+``--batch-interval`` in seconds and optionally ``--batch-size`` in bytes.
+Then each message is a batch of concatenated packets, sent when it reaches
+the size or interval after its first packet. With only ``--batch-size``,
+the interval is one second. A batch can be appended as is
+to a pcap file. It also applies to `zep` and `pcapng` modes.
+
+PCAP payload format is::
+
+   Packet PCAP Header | Packet data
+
+PCAP Header contains: ::
+
+   :4 bytes: Timestamp seconds
+   :4 bytes: Timestamp microseconds
+   :4 bytes: Number of octet saved
+   :4 bytes: Actual lengt of packet
+
+
++-----------------------------------------------------------------------------+
+| **802.15.4 RAW sniffer channel**                                            |
++============+================================================================+
+| Topic:     |    |rawchannel|                                                |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | PCAP packet          |
++------------+-----------------------------------------+----------------------+
+
+
+ZEP packet sniffer
+==================
+
+Topics to access to the node sniffer in `zep` packet mode.
+Packets are kept ZEP encapsulated in Ethernet/IP/UDP to keep the per packet
+radio metadata: channel, LQI and RSSI.
+RSSI is written by the node sniffer in the first ZEP header reserved byte.
+
+It works the same way as the `raw` packet mode, with its own pcap global
+header.
+Both modes can be started at the same time on the same ``channel``, each
+sniffed packet is then published on both output channels.
+
+:param channel: 802.15.4 channel between 11 and 26
+
+Start sniffer in *zep* mode
+---------------------------
+
+Start one node sniffer in *zep* mode on given ``channel``.
+
++-----------------------------------------------------------------------------+
+| ``zep/start`` request:                                                      |
++============+================================================================+
+| Topic:     |    |zepstart|                                                  |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``Channel string``   |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
+Stop zep sniffer
+----------------
+
+Stop node *zep* output only, other started modes keep running.
+Node sniffer is stopped with its last output, like
+:ref:`stop_sniffer`.
+
++-----------------------------------------------------------------------------+
+| ``zep/stop`` request:                                                       |
++============+================================================================+
+| Topic:     |    |zepstop|                                                   |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+ZEP packet sniffer PCAP global header
+-------------------------------------
+
+This request returns the global header for ``zep`` mode, with ethernet
+link type.
+
+
++-----------------------------------------------------------------------------+
+| ``zep/header`` request:                                                     |
++============+================================================================+
+| Topic:     |    |zepheader|                                                 |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | `Global pcap header` |
++------------+-----------------------------------------+----------------------+
+
+
+ZEP packet sniffer
+------------------
+
+Sniffer sends ZEP packets encapsulated as ``pcap``. PCAP payload format is::
+
+   Packet PCAP Header | Ethernet | IPv4 | UDP | ZEP Header | Packet data
+
+ZEP packets are sent to UDP port ``17754``, the wireshark ZEP dissector
+decodes them.
+
+
++-----------------------------------------------------------------------------+
+| **802.15.4 ZEP sniffer channel**                                            |
++============+================================================================+
+| Topic:     |    |zepchannel|                                                |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | PCAP packet          |
++------------+-----------------------------------------+----------------------+
+
+
+Pcapng packet sniffer
+=====================
+
+Topics to access to the node sniffer in `pcapng` mode (`wireshark:pcapng`_).
+Packets are 802.15.4 raw radio frames with nanosecond timestamps.
+
+.. _wireshark\:pcapng: https://wiki.wireshark.org/Development/PcapNg
+
+A pcapng file is made of a Section Header Block, then one Interface
+Description Block per node, then the nodes packets blocks referencing their
+node interface. So one file can hold packets from all the nodes.
+
+It can be started at the same time as other modes on the same ``channel``.
+
+:param channel: 802.15.4 channel between 11 and 26
+
+Start sniffer in *pcapng* mode
+------------------------------
+
+Start one node sniffer in *pcapng* mode on given ``channel``.
+
++-----------------------------------------------------------------------------+
+| ``pcapng/start`` request:                                                   |
++============+================================================================+
+| Topic:     |    |pcapngstart|                                               |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``Channel string``   |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
+Stop pcapng sniffer
+-------------------
+
+Stop node *pcapng* output only, other started modes keep running.
+Node sniffer is stopped with its last output, like
+:ref:`stop_sniffer`.
+
++-----------------------------------------------------------------------------+
+| ``pcapng/stop`` request:                                                    |
++============+================================================================+
+| Topic:     |    |pcapngstop|                                                |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+Pcapng Section Header Block
+---------------------------
+
+This request returns the Section Header Block starting a pcapng file.
+
+
++-----------------------------------------------------------------------------+
+| ``pcapng/header`` request:                                                  |
++============+================================================================+
+| Topic:     |    |pcapngheader|                                              |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | `Section Header`     |
++------------+-----------------------------------------+----------------------+
+
+Pcapng node Interface Description Block
+---------------------------------------
+
+This request returns the node Interface Description Block.
+Interface name is ``{archi}-{num}`` and its description
+``channel {channel}``. Timestamps resolution is nanoseconds.
+
+The node must have been started in *pcapng* mode.
+
+
++-----------------------------------------------------------------------------+
+| ``pcapng/interface`` request:                                               |
++============+================================================================+
+| Topic:     |    |pcapngiface|                                               |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | `Interface` or error |
++------------+-----------------------------------------+----------------------+
+
+
+.. _pcapng_packets:
+
+Pcapng packet sniffer
+---------------------
+
+Sniffer sends one Enhanced Packet Block by message, as little endian.
+Its interface id is ``0``, it must be replaced by the node interface index
+when writing several nodes to one file. Its fields are: ::
+
+   :4 bytes: Block type 0x00000006
+   :4 bytes: Block total length
+   :4 bytes: Interface id, at offset 8
+   :4 bytes: Timestamp nanoseconds, high 32 bits
+   :4 bytes: Timestamp nanoseconds, low 32 bits
+   :4 bytes: Captured length
+   :4 bytes: Original length
+   :N bytes: Packet data, padded to 32 bits
+   :4 bytes: Block total length
+
+
++-----------------------------------------------------------------------------+
+| **802.15.4 pcapng sniffer channel**                                         |
++============+================================================================+
+| Topic:     |    |pcapngchannel|                                             |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | Packet block         |
++------------+-----------------------------------------+----------------------+
+
+
+Merged packet sniffer
+=====================
+
+All the nodes started in *merged* mode are sniffed to one agent ``pcapng``
+stream, ordered by the packets ZEP timestamp.
+
+Packets are kept up to a reorder window, configured with
+``--merged-window`` in seconds, after the newest packet timestamp. Packets
+older than the last published one are late, they are still published
+directly and counted by node.
+
+With a node first packets, its Interface Description Block is published in
+the stream. Packets blocks interface id is the node index in the stream.
+
+To get a stream of a given set of nodes, start them with one request with
+:ref:`merged_bulk_start`. Their Interface Description Blocks are added
+before the reply, so the header queried after it has all of them. Then
+subscribe to the stream, only nodes added later publish their Interface
+Description Block in it.
+
+With ``--merged-dedup-window`` in seconds, a frame received by several
+nodes within this window is only published once, by the first node.
+Its block comment lists the nodes that heard it and their RSSI:
+``heard by m3-1 (-70 dBm), m3-2 (-81 dBm)``.
+Duplicates received after the first packet was published are dropped.
+
+:param channel: 802.15.4 channel between 11 and 26
+
+Add node to merged stream
+-------------------------
+
+Start one node sniffer on given ``channel`` and add it to the merged stream.
+
++-----------------------------------------------------------------------------+
+| ``merged/start`` request:                                                   |
++============+================================================================+
+| Topic:     |    |mergedstart|                                               |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``Channel string``   |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
+.. _merged_bulk_start:
+
+Add nodes to merged stream
+--------------------------
+
+Start multiple nodes sniffers on ``channel`` with one request and add them
+to the merged stream.
+
+Nodes are given as ``ARCHI NODESET``, for example ``m3 1-120,200-250``,
+followed by the channel and optionally a frames filter expression.
+Nodes interfaces are added to the stream in nodeset order.
+
+Reply is sent when all nodes have replied. It is a ``json`` object with the
+reply for each node ``num``, for example
+``{"1": "", "2": "Connection failed: ..."}``.
+
++-----------------------------------------------------------------------------+
+| ``merged/start`` request:                                                   |
++============+================================================================+
+| Topic:     |    |mergedbulkstart|                                           |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``ARCHI NODESET``    |
+|            |                                         | ``Channel string``   |
+|            |                                         | [filter expression]  |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
+|            |                                         | or error_msg         |
++------------+-----------------------------------------+----------------------+
+
+
+Remove nodes from merged stream
+-------------------------------
+
+Stop multiple nodes *merged* output, like `Stop merged sniffer`_.
+
+Reply is a ``json`` object with the reply for each node ``num``.
+
++-----------------------------------------------------------------------------+
+| ``merged/stop`` request:                                                    |
++============+================================================================+
+| Topic:     |    |mergedbulkstop|                                            |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``ARCHI NODESET``    |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
+|            |                                         | or error_msg         |
++------------+-----------------------------------------+----------------------+
+
+
+Stop merged sniffer
+-------------------
+
+Stop node *merged* output only, other started modes keep running.
+Node sniffer is stopped with its last output, like
+:ref:`stop_sniffer`.
+
++-----------------------------------------------------------------------------+
+| ``merged/stop`` request:                                                    |
++============+================================================================+
+| Topic:     |    |mergedstop|                                                |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+Merged stream pcapng header
+---------------------------
+
+This request returns the Section Header Block followed by all the nodes
+Interface Description Blocks already in the stream.
+Query it after :ref:`merged_bulk_start` reply to get the nodes set
+interfaces, or before adding nodes one by one to the stream.
+
+
++-----------------------------------------------------------------------------+
+| ``merged/header`` request:                                                  |
++============+================================================================+
+| Topic:     |    |mergedheader|                                              |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | `Pcapng header`      |
++------------+-----------------------------------------+----------------------+
+
+Merged stream counters
+----------------------
+
+Get merged stream counters as a ``json`` object with the number of
+published ``packets``, ``pending`` packets in the reorder window and
+``late`` packets for each node.
+With duplicates suppression, the number of dropped ``duplicates`` is
+also given.
+
+
++-----------------------------------------------------------------------------+
+| ``merged/stats`` request:                                                   |
++============+================================================================+
+| Topic:     |    |mergedstats|                                               |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
++------------+-----------------------------------------+----------------------+
+
+
+Merged packet sniffer
+---------------------
+
+Stream sends the nodes Interface Description Blocks and Enhanced Packet
+Blocks described in :ref:`pcapng_packets`. Packets released together are
+sent in one message.
+
+
++-----------------------------------------------------------------------------+
+| **802.15.4 merged sniffer channel**                                         |
++============+================================================================+
+| Topic:     |    |mergedchannel|                                             |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | Pcapng blocks        |
++------------+-----------------------------------------+----------------------+
+
+
+Radio statistics
+================
+
+Node sniffer can only publish radio statistics instead of the packets.
+Packets ZEP header and 802.15.4 source address are parsed and counted over
+``--stats-window`` seconds windows, starting on the first packet.
+A summary is then published at the end of each window, also for windows
+without packets, until the sniffer is stopped.
+
+:param channel: 802.15.4 channel between 11 and 26
+
+Start radio statistics
+----------------------
+
+Start one node sniffer on given ``channel`` with statistics output.
+Like other modes, a frames filter can follow the channel.
 
 +-----------------------------------------------------------------------------+
-| ``raw/stop`` request:                                                       |
+| ``stats/start`` request:                                                    |
 +============+================================================================+
-| Topic:     |    |rawstop|                                                   |
+| Topic:     |    |statsstart|                                                |
 +------------+-----------------------------------------+----------------------+
 |**Message** | **Topic**                               | **Payload**          |
 +------------+-----------------------------------------+----------------------+
-| Request    | |request_topic|                         | *empty*              |
+| Request    | |request_topic|                         | ``Channel string``   |
 +------------+-----------------------------------------+----------------------+
 | Reply      | |reply_topic|                           | *empty* or error_msg |
 +------------+-----------------------------------------+----------------------+
 
-RAW packet sniffer PCAP global header
--------------------------------------
-
-PCAP format consists of two main parts, a global header, then messages with a
-per message header: `wireshark:pcap`_
 
-This request returns the global header for ``raw`` mode.
+Stop radio statistics
+---------------------
 
+Stop node *stats* output only, other started modes keep running.
+Node sniffer is stopped with its last output, like
+:ref:`stop_sniffer`.
+Current window summary is published.
 
 +-----------------------------------------------------------------------------+
-| ``raw/header`` request:                                                     |
+| ``stats/stop`` request:                                                     |
 +============+================================================================+
-| Topic:     |    |rawheader|                                                 |
+| Topic:     |    |statsstop|                                                 |
 +------------+-----------------------------------------+----------------------+
 |**Message** | **Topic**                               | **Payload**          |
 +------------+-----------------------------------------+----------------------+
 | Request    | |request_topic|                         | *empty*              |
 +------------+-----------------------------------------+----------------------+
-| Reply      | |reply_topic|                           | `Global pcap header` |
+| Reply      | |reply_topic|                           | *empty* or error_msg |
 +------------+-----------------------------------------+----------------------+
 
 
-Raw packet sniffer
-------------------
-
-Sniffer sends 802.15.4 raw radio frames encapsulated as ``pcap``.
-
-One sniffed packet is sent by message. PCAP payload format is::
+Radio statistics summaries
+--------------------------
 
-   Packet PCAP Header | Packet data
-
-PCAP Header contains: ::
+Summary is a ``json`` object with the window ``start`` time and ``window``
+duration, the ``channel``, number of ``packets`` and ``bytes``.
+``lqi``, ``rssi`` in dBm and frames ``length`` have ``min``, ``max``,
+``mean`` and a ``histogram`` of the values counts, they are ``null``
+without packets.
+RSSI is the one written by the node sniffer in the first ZEP header
+reserved byte.
+``sources`` gives by hexadecimal source address the number of ``packets``
+and ``lqi`` and ``rssi`` means. ::
 
-   :4 bytes: Timestamp seconds
-   :4 bytes: Timestamp microseconds
-   :4 bytes: Number of octet saved
-   :4 bytes: Actual lengt of packet
+   {"start": 1500000000.0, "window": 10, "channel": 11, "packets": 2,
+    "bytes": 24, "lqi": {"min": 255, "max": 255, "mean": 255.0,
+    "histogram": {"255": 2}}, "rssi": {...}, "length": {...},
+    "sources": {"0x1": {"packets": 2, "lqi": 255.0, "rssi": -70.0}}}
 
 
 +-----------------------------------------------------------------------------+
-| **802.15.4 RAW sniffer channel**                                            |
+| **Radio statistics channel**                                                |
 +============+================================================================+
-| Topic:     |    |rawchannel|                                                |
+| Topic:     |    |statschannel|                                              |
 +------------+-----------------------------------------+----------------------+
 |**Message** | **Topic**                               | **Payload**          |
 +------------+-----------------------------------------+----------------------+
-| Output     | |out_topic|                             | PCAP packet          |
+| Output     | |out_topic|                             | ``utf-8 json object``|
 +------------+-----------------------------------------+----------------------+
 """
 
@@ -227,26 +884,62 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from builtins import *  # pylint:disable=W0401,W0614,W0622
 
+import time
+import json
+import array
+import heapq
 import struct
+import itertools
+import hashlib
 import threading
+import collections
 
 from . import common
 from . import iotlabapi
 from . import mqttcommon
+from . import snifferfilter
+from . import node as nodeagent
 from . import asyncconnection
 
 PARSER = common.MQTTAgentArgumentParser()
 iotlabapi.parser_add_iotlabapi_args(PARSER)
-
-
-class ZepToPcap(object):  # pylint:disable=too-few-public-methods
+PARSER.add_argument('--merged-window', type=float, default=0.5,
+                    help='Merged stream packets reorder window in seconds')
+PARSER.add_argument('--merged-dedup-window', type=float, default=0,
+                    help='Publish frames heard by several nodes in this '
+                         'window in seconds once in merged stream, '
+                         '0 disabled')
+PARSER.add_argument('--batch-interval', type=float, default=0,
+                    help='Publish node packets in batches every interval '
+                         'seconds, 0 one packet per message')
+PARSER.add_argument('--batch-size', type=int, default=0,
+                    help='Node packets batches maximum size in bytes, '
+                         'with 1 second interval if not set')
+PARSER.add_argument('--stats-window', type=float, default=10,
+                    help='Radio statistics summaries window in seconds')
+PARSER.add_argument('--ring-buffer-size', type=int, default=0,
+                    help='Keep last sniffed packets up to this size in bytes '
+                         'per node for dump requests, 0 disabled')
+
+
+class ZepToPcap(object):
     """Zep to Pcap converter.
 
     On ``convert`` converts the message as a zep packet.
+    ``convert_many`` converts multiple packets to concatenated pcap records.
+
+    Headers structures are compiled once. IP header checksum is computed
+    from its constant fields precomputed sum.
+    'RAW' records are only a header joined with the payload, which is
+    faster than filling a buffer. 'ZEP' records headers are written with
+    ``pack_into`` in one output buffer for all packets.
     """
     ZEP_PORT = 17754
     ZEP_HDR_LEN = 32
     ZEP_TIME_IDX = 9
+    # Nodes sniffer writes the signed RSSI in dBm in the first ZEP v2
+    # reserved byte, after the sequence number
+    ZEP_RSSI_IDX = 21
     # http://www.tcpdump.org/linktypes.html
 
     LINKTYPE_ETHERNET = 1
@@ -256,12 +949,29 @@ class ZepToPcap(object):  # pylint:disable=too-few-public-methods
     NTP_JAN_1970 = 2208988800
     NTP_SECONDS_FRAC = 1 << 32
 
+    # PCAP headers as native endian
+    PCAP_MAIN_HDR = struct.Struct(b'=LHHLLLL')
+    PCAP_HDR = struct.Struct(b'=LLLL')
+
     # Network headers as network endian
+    NTP_TIME = struct.Struct(b'!LL')
+    UDP_HDR = struct.Struct(b'!HHHH')
+    IP_HDR = struct.Struct(b'!BBHHHBBHLL')
     ETH_HDR = struct.pack(b'!3H3HH',
                           0, 0, 0,  # dst mac addr
                           0, 0, 0,  # src mac addr
                           0x0800)   # Protocol: (0x0800 == IP)
 
+    # IP header fields except length and checksum
+    IP_LOCALHOST = 0x7F000001
+    IP_FIELDS = (0x45, 0, 0, 0, 0x4000, 0xff, 0x11, 0,
+                 IP_LOCALHOST, IP_LOCALHOST)
+    # Sum of IP header 16 bits words with length and checksum == 0
+    IP_CSUM_BASE = sum(struct.unpack(b'!10H', IP_HDR.pack(*IP_FIELDS)))
+
+    # Headers added before ZEP packet in 'ZEP' mode
+    ZEP_ENCAP_LEN = len(ETH_HDR) + IP_HDR.size + UDP_HDR.size
+
     LINKTYPES = {
         'RAW': LINKTYPE_IEEE802_15_4,
         'ZEP': LINKTYPE_ETHERNET,
@@ -274,20 +984,44 @@ class ZepToPcap(object):  # pylint:disable=too-few-public-methods
         link_type = self.LINKTYPES[mode]
         self.header = self._pcap_main_header(link_type)
 
-        _converter = {
-            'RAW': self._convert_raw,
-            'ZEP': self._convert_zep,
+        _encoder = {
+            'RAW': (self._record_len_raw, self._encode_raw),
+            'ZEP': (self._record_len_zep, self._encode_zep),
         }
-        self.convert = _converter[mode]
+        self._record_len, self._encode = _encoder[mode]
 
-    @staticmethod
-    def _pcap_main_header(link_type):
+    def convert(self, packet):
+        """Return pcap record for ZEP ``packet``."""
+        if self.mode == 'RAW':
+            return self._convert_raw(packet)
+        out = bytearray(self._record_len(packet))
+        self._encode(out, 0, packet)
+        return out
+
+    def convert_many(self, packets):
+        """Return concatenated pcap records for ZEP ``packets``.
+
+        'ZEP' records are written in one ``bytearray`` allocated for all
+        packets.
+        """
+        if self.mode == 'RAW':
+            return b''.join([self._convert_raw(pkt) for pkt in packets])
+
+        record_len, encode = self._record_len, self._encode
+        out = bytearray(sum([record_len(pkt) for pkt in packets]))
+
+        offset = 0
+        for packet in packets:
+            offset = encode(out, offset, packet)
+        return out
+
+    @classmethod
+    def _pcap_main_header(cls, link_type):
         """ Return the main pcap file header for `link_type`
 
         PCAP headers as native endian
         """
-        return struct.pack(
-            b'=LHHLLLL',
+        return cls.PCAP_MAIN_HDR.pack(
             0xa1b2c3d4,  # Pcap header Little Endian
             2,           # File format major revision (i.e. pcap <2>.4)
             4,           # File format minor revision (i.e. pcap 2.<4>)
@@ -299,218 +1033,799 @@ class ZepToPcap(object):  # pylint:disable=too-few-public-methods
 
     @classmethod
     def _convert_raw(cls, packet):
-        """ Only write the ZEP payload as pcap"""
-        timestamp = cls._timestamp(packet)
-
-        # extract payload from zep encapsulated data
+        """Return 'RAW' pcap record for ``packet`` as ``bytes``."""
         payload = packet[cls.ZEP_HDR_LEN:]
+        t_s, t_us = cls._pcap_time(packet)
+        pkt_len = len(payload)
+        return cls.PCAP_HDR.pack(t_s, t_us, pkt_len, pkt_len) + payload
 
-        # Only add pcap header
-        length = len(payload)
-        pcap_hdr = cls._pcap_header(length, timestamp[0], timestamp[1])
-        length += len(pcap_hdr)
+    @classmethod
+    def _record_len_raw(cls, packet):
+        """Pcap record length for ``packet`` in 'RAW' mode."""
+        return cls.PCAP_HDR.size + len(packet) - cls.ZEP_HDR_LEN
 
-        # Actually write the data
-        pcap = b''.join((pcap_hdr, payload))
-        return pcap
+    @classmethod
+    def _encode_raw(cls, out, offset, packet):
+        """ Only write the ZEP payload as pcap
+
+        Write record in ``out`` at ``offset``, return record end offset.
+        """
+        payload_len = len(packet) - cls.ZEP_HDR_LEN
+        cls._pcap_header_into(out, offset, packet, payload_len)
+
+        # extract payload from zep encapsulated data
+        offset += cls.PCAP_HDR.size
+        end = offset + payload_len
+        out[offset:end] = packet[cls.ZEP_HDR_LEN:]
+        return end
+
+    @classmethod
+    def _record_len_zep(cls, packet):
+        """Pcap record length for ``packet`` in 'ZEP' mode."""
+        return cls.PCAP_HDR.size + cls.ZEP_ENCAP_LEN + len(packet)
 
     @classmethod
-    def _convert_zep(cls, packet):
-        """ Encapsulate ZEP data in pcap outfile """
-        timestamp = cls._timestamp(packet)
+    def _encode_zep(cls, out, offset, packet):
+        """ Encapsulate ZEP data in pcap record
 
-        # Calculate all headers
-        length = len(packet)
+        Write record in ``out`` at ``offset``, return record end offset.
+        """
+        pkt_len = len(packet)
+        udp_len = cls.UDP_HDR.size + pkt_len
+        ip_len = cls.IP_HDR.size + udp_len
+        eth_len = len(cls.ETH_HDR) + ip_len
 
-        udp_hdr = cls._udp_header(length)
-        length += len(udp_hdr)
+        cls._pcap_header_into(out, offset, packet, eth_len)
+        offset += cls.PCAP_HDR.size
 
-        ip_hdr = cls._ip_header(length)
-        length += len(ip_hdr)
+        out[offset:offset + len(cls.ETH_HDR)] = cls.ETH_HDR
+        offset += len(cls.ETH_HDR)
 
-        eth_hdr = cls._eth_header(length)
-        length += len(eth_hdr)
+        cls.IP_HDR.pack_into(out, offset, 0x45, 0, ip_len, 0, 0x4000, 0xff,
+                             0x11, cls._ip_checksum(ip_len),
+                             cls.IP_LOCALHOST, cls.IP_LOCALHOST)
+        offset += cls.IP_HDR.size
 
-        pcap_hdr = cls._pcap_header(length, timestamp[0], timestamp[1])
-        length += len(pcap_hdr)
+        # UDP checksum disabled == 0
+        cls.UDP_HDR.pack_into(out, offset, cls.ZEP_PORT, cls.ZEP_PORT,
+                              udp_len, 0)
+        offset += cls.UDP_HDR.size
 
-        pcap = b''.join((pcap_hdr, eth_hdr, ip_hdr, udp_hdr, packet))
-        return pcap
+        out[offset:offset + pkt_len] = packet
+        return offset + pkt_len
 
     @classmethod
-    def _timestamp(cls, packet):
-        """ Extract packet timestamp as an unix time tuple (s, us)
-        Packet timestamp is in 'ntp' format.
+    def _pcap_header_into(cls, out, offset, packet, pkt_len):
+        """ Write the PCAP Header for ``packet`` record of ``pkt_len``
+
+        4B - Timestamp seconds:      packet timestamp
+        4B - Timestamp microseconds: packet timestamp
+        4B - Number of octet saved:  pkt_len
+        4B - Actual lengt of packet: pkt_len
 
+        Packet timestamp is in 'ntp' format.
         MSB are seconds stored since 1 january 1900
         LSB are fraction of seconds where 2**32 == 1 second
         """
-        ntp_t = struct.unpack_from(b'!LL', packet, cls.ZEP_TIME_IDX)
-
-        t_s = ntp_t[0] - cls.NTP_JAN_1970
-        t_us = (1000000 * ntp_t[1]) // cls.NTP_SECONDS_FRAC
+        t_s, t_us = cls._pcap_time(packet)
+        cls.PCAP_HDR.pack_into(out, offset, t_s, t_us, pkt_len, pkt_len)
 
+    @classmethod
+    def _pcap_time(cls, packet):
+        """Return ``packet`` ntp timestamp as unix seconds, microseconds."""
+        ntp_s, ntp_frac = cls.NTP_TIME.unpack_from(packet, cls.ZEP_TIME_IDX)
+        t_s = ntp_s - cls.NTP_JAN_1970
+        t_us = (1000000 * ntp_frac) // cls.NTP_SECONDS_FRAC
         return t_s, t_us
 
     @classmethod
-    def _udp_header(cls, pkt_len):
-        """ Get UDP Header
-
-        2B - src_port: ZEP_PORT also but not required
-        2B - dst_port: ZEP_PORT == 17754
-        2B - length:   header + packet length
-        2B - checksum: Disable == 0
+    def timestamp_ns(cls, packet):
+        """ Extract packet timestamp as unix time in nanoseconds
 
+        >>> ntp = struct.pack('!LL', ZepToPcap.NTP_JAN_1970 + 1, 1 << 31)
+        >>> ZepToPcap.timestamp_ns(bytes(bytearray(9)) + ntp)
+        1500000000
         """
-        hdr_struct = struct.Struct(b'!HHHH')
-        udp_len = hdr_struct.size + pkt_len
-        udp_hdr = hdr_struct.pack(cls.ZEP_PORT, cls.ZEP_PORT, udp_len, 0)
-        return udp_hdr
+        ntp_s, ntp_frac = cls.NTP_TIME.unpack_from(packet, cls.ZEP_TIME_IDX)
+        t_ns = (1000000000 * ntp_frac) // cls.NTP_SECONDS_FRAC
+        return (ntp_s - cls.NTP_JAN_1970) * 1000000000 + t_ns
 
     @classmethod
-    def _ip_header(cls, pkt_len):
-        """ Get the IP Header
-
-        1B - Version | IHL:           0x45: [4 | 5] : [4b | 4b]
-        1B - Type of Service:         0
-        2B - Length:                  pkt_len + Header length
-        2B - Identification:          0
-        2B - Flags | Fragment offset: 0x4000: [2 | 0] : [3b | 13b]
-        1B - TTL:                     0xff
-        1B - Protocol:                0x11 UDP
-        2B - Checksum:                calculated
-        4B - Source Address:          0x7F000001 (127.0.0.1)
-        4B - Destination Address:     0x7F000001 (127.0.0.1)
-
-        """
-        hdr_struct = struct.Struct(b'!BBHHHBBHLL')
-        ip_len = hdr_struct.size + pkt_len
-
-        # generate header with checksum == 0 to calculate checksum
-        checksum = 0
-        ip_hdr_csum = hdr_struct.pack(0x45, 0, ip_len, 0, 0x4000, 0xff, 0x11,
-                                      checksum, 0x7F000001, 0x7F000001)
-        checksum = cls._ip_checksum(ip_hdr_csum)
-
-        # Generate header with correct checksum
-        ip_hdr = hdr_struct.pack(0x45, 0, ip_len, 0, 0x4000, 0xff, 0x11,
-                                 checksum, 0x7F000001, 0x7F000001)
-        return ip_hdr
+    def _ip_checksum(cls, ip_len):
+        """ Calculate the ip checksum for header with ``ip_len``
 
-    @staticmethod
-    def _ip_checksum(hdr):
-        """ Calculate the ip checksum for given header """
-        assert (len(hdr) % 2) == 0  # hdr has even length
-        word_pack = struct.Struct(b'!H')
+        Only length changes, so add it to the constant fields sum.
 
-        # Sum all 16bits
-        hdr_split = (hdr[i:i + 2] for i in range(0, len(hdr), 2))
-        csum = sum((word_pack.unpack(word)[0] for word in hdr_split))
+        >>> ZepToPcap._ip_checksum(20 + 8 + 35) == 0x7dab
+        True
+        """
+        csum = cls.IP_CSUM_BASE + ip_len
 
         # Reduce to 16b and save the one complement
-        checksum = (csum + (csum >> 16)) & 0xFFFF ^ 0xFFFF
-        return checksum
+        csum = (csum & 0xFFFF) + (csum >> 16)
+        csum = (csum & 0xFFFF) + (csum >> 16)
+        return csum ^ 0xFFFF
+
+
+class ZepToPcapng(ZepToPcap):
+    """Zep to pcapng converter.
+
+    ``header`` is the Section Header Block, ``interface`` returns an
+    Interface Description Block for a node, with nanosecond resolution.
+    ``convert`` returns Enhanced Packet Blocks for ``interface_id``.
+
+    Blocks are little endian so interface ids can be updated by readers
+    merging several nodes.
+    """
+    SHB_TYPE = 0x0A0D0D0A
+    IDB_TYPE = 0x00000001
+    EPB_TYPE = 0x00000006
+    BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+    OPT_ENDOFOPT = 0
+    OPT_COMMENT = 1
+    IF_NAME = 2
+    IF_DESCRIPTION = 3
+    IF_TSRESOL = 9
+    TSRESOL_NS = b'\x09'  # 10^-9 seconds
+
+    BLOCK_HDR = struct.Struct(b'<LL')
+    BLOCK_LEN = struct.Struct(b'<L')
+    SHB_BODY = struct.Struct(b'<LHHq')
+    IDB_BODY = struct.Struct(b'<HHL')
+    OPTION = struct.Struct(b'<HH')
+    # Type, length, interface id, timestamp high and low, captured/orig len
+    EPB_HDR = struct.Struct(b'<LLLLLLL')
+    INTERFACE_ID_OFFSET = 8
+    # Padding to 32 bits by length modulo 4
+    PADDING = (b'', b'\0\0\0', b'\0\0', b'\0')
+
+    def __init__(self, mode='RAW'):
+        super().__init__(mode)
+        self.link_type = self.LINKTYPES[mode]
+        self.header = self._block(
+            self.SHB_TYPE,
+            # Version 1.0, unknown section length
+            self.SHB_BODY.pack(self.BYTE_ORDER_MAGIC, 1, 0, -1))
+        self._record_encode = self._encode
+
+    def interface(self, name, channel):
+        """Return Interface Description Block for node ``name``."""
+        options = b''.join((
+            self._option(self.IF_NAME, name.encode('utf-8')),
+            self._option(self.IF_DESCRIPTION,
+                         ('channel %u' % channel).encode('utf-8')),
+            self._option(self.IF_TSRESOL, self.TSRESOL_NS),
+            self.OPTION.pack(self.OPT_ENDOFOPT, 0),
+        ))
+        body = self.IDB_BODY.pack(self.link_type, 0, 0xffff) + options
+        return self._block(self.IDB_TYPE, body)
+
+    def convert(self, packet,  # pylint:disable=arguments-differ
+                interface_id=0, comment=None):
+        """Return Enhanced Packet Block for ZEP ``packet``.
+
+        ``comment`` is added as the block comment option.
+        """
+        block = self.convert_many((packet,), interface_id)
+        if comment is None:
+            return block
+        options = b''.join((
+            self._option(self.OPT_COMMENT, comment.encode('utf-8')),
+            self.OPTION.pack(self.OPT_ENDOFOPT, 0),
+        ))
+        return self._add_options(block, options)
+
+    def convert_many(self, packets,  # pylint:disable=arguments-differ
+                     interface_id=0):
+        """Return concatenated Enhanced Packet Blocks for ZEP ``packets``.
+
+        'RAW' blocks are joined, others are written in one ``bytearray``.
+        """
+        if self.mode == 'RAW':
+            return b''.join([self._convert_block_raw(pkt, interface_id)
+                             for pkt in packets])
+
+        lengths = [self._record_len(pkt) - self.PCAP_HDR.size
+                   for pkt in packets]
+        out = bytearray(sum([self._block_len(length) for length in lengths]))
+
+        offset = 0
+        for packet, length in zip(packets, lengths):
+            offset = self._encode_block(out, offset, packet, length,
+                                        interface_id)
+        return out
+
+    def _convert_block_raw(self, packet, interface_id):
+        """Return 'RAW' Enhanced Packet Block for ``packet``."""
+        payload = packet[self.ZEP_HDR_LEN:]
+        length = len(payload)
+        block_len = self._block_len(length)
+        t_high, t_low = divmod(self.timestamp_ns(packet), 1 << 32)
+        return b''.join((
+            self.EPB_HDR.pack(self.EPB_TYPE, block_len, interface_id,
+                              t_high, t_low, length, length),
+            payload, self.PADDING[length % 4],
+            self.BLOCK_LEN.pack(block_len)))
+
+    def _encode_block(self, out, offset,  # pylint:disable=too-many-arguments
+                      packet, length, interface_id):
+        """Write packet block in ``out`` at ``offset``, return end offset.
+
+        Packet data is encoded as a pcap record ending the block header,
+        the pcap record header is then overwritten by the block header.
+        """
+        block_len = self._block_len(length)
+        data_offset = offset + self.EPB_HDR.size
+        self._record_encode(out, data_offset - self.PCAP_HDR.size, packet)
+
+        t_high, t_low = divmod(self.timestamp_ns(packet), 1 << 32)
+        self.EPB_HDR.pack_into(out, offset, self.EPB_TYPE, block_len,
+                               interface_id, t_high, t_low, length, length)
+        # Padding is already zeroed
+        end = offset + block_len
+        self.BLOCK_LEN.pack_into(out, end - self.BLOCK_LEN.size, block_len)
+        return end
+
+    @classmethod
+    def _add_options(cls, block, options):
+        """Return ``block`` with ``options`` before its trailing length."""
+        block_len = len(block) + len(options)
+        block = bytearray(block[:-cls.BLOCK_LEN.size]) + options
+        block += cls.BLOCK_LEN.pack(block_len)
+        cls.BLOCK_LEN.pack_into(block, cls.BLOCK_LEN.size, block_len)
+        return block
 
     @classmethod
-    def _eth_header(cls, pkt_len):  # pylint:disable=unused-argument
-        """ Return a static empty ethernet header
+    def _block_len(cls, length):
+        """Enhanced Packet Block length for packet data ``length``."""
+        return cls.EPB_HDR.size + length + (-length % 4) + cls.BLOCK_LEN.size
+
+    @classmethod
+    def _block(cls, block_type, body):
+        """Return block with ``body``."""
+        block_len = cls.BLOCK_HDR.size + len(body) + cls.BLOCK_LEN.size
+        return b''.join((cls.BLOCK_HDR.pack(block_type, block_len), body,
+                         cls.BLOCK_LEN.pack(block_len)))
+
+    @classmethod
+    def _option(cls, code, value):
+        """Return option ``code`` with ``value`` padded to 32 bits."""
+        padding = b'\0' * (-len(value) % 4)
+        return b''.join((cls.OPTION.pack(code, len(value)), value, padding))
+
+
+class PacketsMerger(object):  # pylint:disable=too-many-instance-attributes
+    """Merge nodes packets in one pcapng stream ordered by ZEP timestamp.
+
+    Packets are kept in a heap until they are ``window`` seconds older than
+    the newest packet timestamp, advanced by the time elapsed since it was
+    received. Packets older than the last published one are late, they are
+    published directly and counted by node.
+
+    Each node ``name`` and ``channel`` is a pcapng interface, its
+    description block is published with the node first packets, so nodes
+    that fail to start do not add one, or when added with ``interface``.
+
+    With ``dedup``, a frame already received from other nodes less than
+    ``dedup`` seconds apart is not published again, it is added to the
+    first packet comment listing nodes that heard it with their RSSI.
+    Frames digests are kept in a bounded LRU.
+
+    :param publish: callback for pcapng blocks
+    :param window: reorder window in seconds
+    :param clock: function returning current time
+    :param dedup: duplicates window in seconds, 0 to disable
+    """
+    NS = 1000000000
+    DEDUP_FRAMES = 4096
+    ZEP_HDR_LEN = ZepToPcap.ZEP_HDR_LEN
+    ZEP_RSSI = struct.Struct(b'!%dxb' % ZepToPcap.ZEP_RSSI_IDX)
+
+    def __init__(self, publish, window=0.5, clock=time.time, dedup=0):
+        self.publish = publish
+        self.window = int(window * self.NS)
+        self.clock = clock
+        self.dedup = int(dedup * self.NS)
+        self.encoder = ZepToPcapng(mode='RAW')
+        self.frames = collections.OrderedDict()
+
+        self.interfaces = {}
+        self.blocks = []
+        self.heap = []
+        self._seqno = itertools.count()
+        # Newest packet timestamp and its receive time
+        self.newest = (None, 0)
+        self.last = None
+
+        self.stats = {'packets': 0, 'late': {}}
+        if self.dedup:
+            self.stats['duplicates'] = 0
+        self._timer = None
+        self._deadline = None
+        self._lock = threading.RLock()
+
+    @property
+    def header(self):
+        """Section header followed by current interfaces blocks."""
+        with self._lock:  # pylint:disable=not-context-manager
+            return b''.join([self.encoder.header] + self.blocks)
+
+    def output(self, name, channel):
+        """Return packets handler for node ``name`` on ``channel``."""
+        def _push(packets):
+            self.push(name, self.interface(name, channel), packets)
+        return _push
+
+    @common.synchronized('_lock')
+    def interface(self, name, channel):
+        """Return ``name`` and ``channel`` interface id, publish new ones."""
+        try:
+            return self.interfaces[(name, channel)]
+        except KeyError:
+            interface_id = len(self.blocks)
+            self.interfaces[(name, channel)] = interface_id
+            self.blocks.append(self.encoder.interface(name, channel))
+            self.publish(self.blocks[-1])
+            return interface_id
+
+    @common.synchronized('_lock')
+    def push(self, name, interface_id, packets):
+        """Add node ``packets`` and publish the ones out of the window."""
+        late = []
+        for packet in packets:
+            timestamp = self.encoder.timestamp_ns(packet)
+            heard = self._heard(name, timestamp, packet)
+            if heard is False:
+                continue
+            entry = (timestamp, next(self._seqno), interface_id,
+                     bytes(packet), heard)
+            if self.last is not None and timestamp < self.last:
+                late.append(entry)
+            else:
+                self._add(entry)
+
+        if late:
+            node_late = self.stats['late']
+            node_late[name] = node_late.get(name, 0) + len(late)
+            self._publish(late)
+        self._release()
+
+    def _add(self, entry):
+        """Add packet ``entry`` to the window."""
+        heapq.heappush(self.heap, entry)
+        if self.newest[0] is None or entry[0] > self.newest[0]:
+            self.newest = (entry[0], self.clock())
+
+    def _heard(self, name, timestamp, packet):
+        """Return list of nodes that heard ``packet`` frame, with dedup.
+
+        Return False for a duplicate, added to the first packet list,
+        and None without dedup.
+        """
+        if not self.dedup:
+            return None
+        rssi = self.ZEP_RSSI.unpack_from(packet)[0]
+        digest = hashlib.sha1(packet[self.ZEP_HDR_LEN:]).digest()
+
+        entry = self.frames.pop(digest, None)
+        if entry is not None and self._is_duplicate(name, timestamp, entry):
+            entry[1].append((name, rssi))
+            self.frames[digest] = entry
+            self.stats['duplicates'] += 1
+            return False
+
+        entry = (timestamp, [(name, rssi)])
+        self.frames[digest] = entry
+        while len(self.frames) > self.DEDUP_FRAMES:
+            self.frames.popitem(last=False)
+        return entry[1]
+
+    def _is_duplicate(self, name, timestamp, entry):
+        """Frame heard by another node in the dedup window.
+
+        Same frame from the same node is a retransmission.
+        """
+        first, heard = entry
+        in_window = abs(timestamp - first) <= self.dedup
+        return in_window and name not in [node for node, _ in heard]
+
+    def flush(self):
+        """Publish packets out of the window."""
+        with self._lock:  # pylint:disable=not-context-manager
+            self._timer = None
+            self._deadline = None
+            self._release()
+
+    def _release(self):
+        """Publish packets before the window and schedule next release."""
+        newest, received = self.newest
+        if newest is None:
+            return
+        elapsed = int((self.clock() - received) * self.NS)
+        watermark = newest + elapsed - self.window
+
+        released = []
+        while self.heap and self.heap[0][0] <= watermark:
+            released.append(heapq.heappop(self.heap))
+        if released:
+            self.last = released[-1][0]
+            self._publish(released)
+
+        if self.heap:
+            self._schedule((self.heap[0][0] - watermark) / self.NS)
+
+    def _schedule(self, delay):
+        """Flush in ``delay`` seconds, unless already planned before."""
+        deadline = self.clock() + delay
+        if self._timer is not None:
+            if deadline >= self._deadline:
+                return
+            self._timer.cancel()
+
+        self._deadline = deadline
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _publish(self, packets):
+        """Publish ``packets`` as one message of pcapng blocks."""
+        self.stats['packets'] += len(packets)
+        self.publish(b''.join(
+            self.encoder.convert(packet, interface_id, self._comment(heard))
+            for _, _, interface_id, packet, heard in packets))
+
+    @staticmethod
+    def _comment(heard):
+        """Packet comment with nodes that heard it, None without dedup.
 
-        6B - dst mac addr: 0
-        6B - src mac addr: 0
-        2B - protocol:     0x0800 (IP)
+        >>> print(PacketsMerger._comment([('m3-1', -70), ('m3-2', -81)]))
+        heard by m3-1 (-70 dBm), m3-2 (-81 dBm)
         """
-        return cls.ETH_HDR
+        if heard is None:
+            return None
+        return 'heard by ' + ', '.join('%s (%d dBm)' % node for node in heard)
+
+    def get_stats(self):
+        """Return counters and number of pending packets."""
+        with self._lock:  # pylint:disable=not-context-manager
+            stats = dict(self.stats, pending=len(self.heap))
+            stats['late'] = dict(stats['late'])
+            return stats
+
+    def close(self):
+        """Stop timer and publish all pending packets."""
+        with self._lock:  # pylint:disable=not-context-manager
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.heap:
+                released, self.heap = sorted(self.heap), []
+                self.last = released[-1][0]
+                self._publish(released)
+
+
+class PacketsOutput(object):
+    """Publish packets encoded with ``encoder``.
+
+    By default each packet record is published as its own message.
+    With ``size`` or ``delay``, records are concatenated and published when
+    they reach ``size`` bytes or ``delay`` seconds after the first one.
+    With only ``size``, ``DEFAULT_DELAY`` is used so packets are not kept
+    indefinitely. Batches can be appended as is to a pcap file.
+
+    :param publish: callback for encoded records
+    :param encoder: ``ZepToPcap`` like encoder
+    :param size: batch size in bytes, 0 to disable
+    :param delay: batch maximum delay in seconds, 0 to disable
+    """
+    DEFAULT_DELAY = 1.0
+
+    def __init__(self, publish, encoder, size=0, delay=0):
+        self.publish = publish
+        self.encoder = encoder
+        self.batcher = None
+        if size or delay:
+            delay = delay or self.DEFAULT_DELAY
+            self.batcher = common.DataBatcher(publish, size, delay)
+
+    def __call__(self, packets):
+        """Publish ``packets`` records or add them to current batch."""
+        if self.batcher is not None:
+            self.batcher(self.encoder.convert_many(packets))
+            return
+
+        for packet in packets:
+            self.publish(self.encoder.convert(packet))
+
+    def close(self):
+        """Publish current batch."""
+        common.close_handler(self.batcher)
+
+
+class PacketsStats(object):  # pylint:disable=too-many-instance-attributes
+    """Count packets radio statistics and publish windows summaries.
+
+    Packets are not forwarded, only their ZEP header and 802.15.4 source
+    address are parsed. LQI, RSSI and length values are counted in
+    histograms arrays, summaries are computed when publishing.
+    The first window starts on the first packet, then each window is
+    published as json ``window`` seconds after its start, even without
+    packets, and the next one is started until ``close``.
+
+    :param publish: callback for summaries json
+    :param window: summaries window in seconds
+    """
+    ZEP_HDR_LEN = ZepToPcap.ZEP_HDR_LEN
+    # channel, LQI, RSSI (signed, at ZepToPcap.ZEP_RSSI_IDX) and length
+    ZEP_FIELDS = struct.Struct(b'!4xB3xB12xb9xB')
+    RSSI_OFFSET = 128
+    # Sources counters indexes
+    PACKETS, LQI_SUM, RSSI_SUM = range(3)
+
+    def __init__(self, publish, window=10):
+        self.publish = publish
+        self.window = window
+
+        self.start = None
+        self.channel = None
+        self.lqi = self.rssi = self.length = self.sources = None
+        self._reset()
+        self.closed = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        """Clear counters for a new window."""
+        self.lqi = array.array('L', [0]) * 256
+        self.rssi = array.array('L', [0]) * 256
+        self.length = array.array('L', [0]) * 256
+        self.sources = {}
+
+    def __call__(self, packets):
+        """Count ``packets`` in current window."""
+        if not packets:
+            return
+        with self._lock:  # pylint:disable=not-context-manager
+            for packet in packets:
+                self._add(packet)
+
+            if self._timer is None and not self.closed:
+                self._start_window()
+
+    def _start_window(self):
+        """Start a new window and its summary timer."""
+        self.start = time.time()
+        self._timer = threading.Timer(self.window, self.summary)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _add(self, packet):
+        """Update counters with ``packet``."""
+        self.channel, lqi, rssi, length = self.ZEP_FIELDS.unpack_from(packet)
+        self.lqi[lqi] += 1
+        self.rssi[rssi + self.RSSI_OFFSET] += 1
+        self.length[length] += 1
+
+        src = snifferfilter.decode(packet[self.ZEP_HDR_LEN:]).get('src')
+        if src is None:
+            return
+        counters = self.sources.get(src)
+        if counters is None:
+            counters = self.sources[src] = array.array('l', [0, 0, 0])
+        counters[self.PACKETS] += 1
+        counters[self.LQI_SUM] += lqi
+        counters[self.RSSI_SUM] += rssi
+
+    def summary(self):
+        """Publish current window summary and start a new window."""
+        with self._lock:  # pylint:disable=not-context-manager
+            if self._timer is None:
+                return
+            self._timer.cancel()
+            self._timer = None
+            result = self._summary()
+            self._reset()
+            if not self.closed:
+                self._start_window()
+        self.publish(json.dumps(result, sort_keys=True).encode('utf-8'))
+
+    def _summary(self):
+        """Current window summary dict."""
+        return {
+            'start': self.start, 'window': self.window,
+            'channel': self.channel,
+            'packets': sum(self.length),
+            'bytes': sum(i * count for i, count in enumerate(self.length)),
+            'lqi': self._histogram(self.lqi),
+            'rssi': self._histogram(self.rssi, -self.RSSI_OFFSET),
+            'length': self._histogram(self.length),
+            'sources': {
+                '0x%x' % src: {
+                    'packets': counters[self.PACKETS],
+                    'lqi': counters[self.LQI_SUM] / counters[self.PACKETS],
+                    'rssi': counters[self.RSSI_SUM] / counters[self.PACKETS]}
+                for src, counters in self.sources.items()},
+        }
 
     @staticmethod
-    def _pcap_header(pkt_len, t_s, t_us):
-        """ Get the PCAP Header
+    def _histogram(counts, offset=0):
+        """Return min, max, mean and non empty bins of ``counts`` histogram.
 
-        4B - Timestamp seconds:      current time
-        4B - Timestamp microseconds: current time
-        4B - Number of octet saved:  pkt_len
-        4B - Actual lengt of packet: pkt_len
+        Bins values are their index plus ``offset``.
+        Return None for an empty histogram.
+
+        >>> hist = PacketsStats._histogram(array.array('L', [0, 2, 0, 1]))
+        >>> sorted(hist.items()) == [('histogram', {'1': 2, '3': 1}),
+        ...                          ('max', 3), ('mean', 5 / 3), ('min', 1)]
+        True
+        >>> print(PacketsStats._histogram(array.array('L', [0, 0])))
+        None
         """
+        values = [(index + offset, count)
+                  for index, count in enumerate(counts) if count]
+        if not values:
+            return None
+        total = sum(count for _, count in values)
+        return {
+            'min': values[0][0], 'max': values[-1][0],
+            'mean': sum(value * count for value, count in values) / total,
+            'histogram': {str(value): count for value, count in values},
+        }
+
+    def close(self):
+        """Publish current window summary and stop windows."""
+        with self._lock:  # pylint:disable=not-context-manager
+            self.closed = True
+        self.summary()
+
+
+class PacketsRing(object):
+    """Keep last received packets up to ``size`` bytes.
+
+    Packets are stored with their reception time, oldest packets are
+    dropped when ``size`` is exceeded. Each entry counts for its packet
+    length plus ``ENTRY_OVERHEAD``, the approximate memory used by the entry
+    tuple, timestamp and bytes objects.
+
+    :param size: maximum packets size in bytes
+    :param clock: reception time function
+    """
+    ENTRY_OVERHEAD = 100
+
+    def __init__(self, size, clock=time.time):
+        self.size = size
+        self.clock = clock
+
+        self.packets = collections.deque()
+        self.length = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, packets):
+        """Store copies of ``packets``, dropping the oldest ones."""
+        now = self.clock()
+        with self._lock:  # pylint:disable=not-context-manager
+            for packet in packets:
+                packet = bytes(packet)
+                self.packets.append((now, packet))
+                self.length += len(packet) + self.ENTRY_OVERHEAD
+
+            while self.length > self.size:
+                packet = self.packets.popleft()[1]
+                self.length -= len(packet) + self.ENTRY_OVERHEAD
+
+    def last(self, seconds):
+        """Return packets received in the last ``seconds``, oldest first."""
+        start = self.clock() - seconds
+        with self._lock:  # pylint:disable=not-context-manager
+            packets = [pkt for _, pkt in itertools.takewhile(
+                lambda entry: entry[0] >= start, reversed(self.packets))]
+        packets.reverse()
+        return packets
+
+
+class PacketsFilter(object):
+    """Give ``handler`` only packets with a frame matching ``match``.
+
+    :param handler: callback for packets list
+    :param match: function matching 802.15.4 frame from
+        ``snifferfilter.compile_filter``
+    """
+    ZEP_HDR_LEN = ZepToPcap.ZEP_HDR_LEN
+
+    def __init__(self, handler, match):
+        self.handler = handler
+        self.match = match
 
-        hdr_struct = struct.Struct(b'=LLLL')
-        pcap_len = pkt_len
-        pcap_hdr = hdr_struct.pack(t_s, t_us, pcap_len, pcap_len)
-        return pcap_hdr
+    def __call__(self, packets):
+        """Call 'handler' with matching packets if any."""
+        packets = [pkt for pkt in packets
+                   if self.match(pkt[self.ZEP_HDR_LEN:])]
+        if packets:
+            self.handler(packets)
+
+    def close(self):
+        """Close handler."""
+        common.close_handler(self.handler)
 
 
 class ZEPHandler(object):  # pylint:disable=too-few-public-methods
+    """ZEP data handler.
 
-    """ZEP data handler."""
+    Received data is appended to a buffer parsed with an offset cursor,
+    the buffer is only compacted once per read.
+
+    Packets found in one read are given to ``handler`` as a list of
+    ``memoryview`` on the buffer, they are only valid during the call.
+    """
     ZEP_HDR_LEN = 32  # zeptopcap.ZepPcap.ZEP_HDR_LEN
     ZEP_START = b'EX\2'
+    # Payload length byte index
+    ZEP_LEN_IDX = ZEP_HDR_LEN - 1
 
     def __init__(self, handler):
-        self.data = b''
+        self.buffer = bytearray()
         self.handler = handler
 
     def __call__(self, input_data):
-        """Call 'handler' on received data packet per packet."""
-        data = self.data + input_data
+        """Call 'handler' on packets in received data."""
+        self.buffer += input_data
+        offset = self._handle_packets()
+        self._compact(offset)
 
-        while True:
-            data = self._strip_until_pkt_start(data)
-            if (not data.startswith(self.ZEP_START) or
-                    len(data) < self.ZEP_HDR_LEN):
-                break
-
-            # length = header length + data['len_byte']
-            full_len = self.ZEP_HDR_LEN + self._payload_len(data)
-            if len(data) < full_len:
-                break
-
-            # Extract packet
-            pkt, data = data[:full_len], data[full_len:]
-            self.handler(pkt)
+    def _handle_packets(self):
+        """Call 'handler' with buffer packets views.
 
-        self.data = data
-
-    def _payload_len(self, data):
-        """Read 'length' byte from data.
-
-        Length byte is byte at index ZEP_HDR_LEN -1.
-        Use bytearray to be python2 and python3 compatible.
-        `ord` does not work in python3.
+        Return offset of the remaining data.
         """
-        return bytearray(data[self.ZEP_HDR_LEN - 1:self.ZEP_HDR_LEN])[0]
+        spans, offset = self.packets_spans(self.buffer)
+        if spans:
+            view = memoryview(self.buffer)
+            self.handler([view[start:end] for start, end in spans])
+        return offset
+
+    def _compact(self, offset):
+        """Remove handled data from buffer."""
+        try:
+            del self.buffer[:offset]
+        except BufferError:
+            # A packet view is still referenced, leave it on the old buffer
+            self.buffer = self.buffer[offset:]
 
     @classmethod
-    def _strip_until_pkt_start(cls, msg):
-        """
-        >>> msg = b'abcdEEEEEEEEEX\2'
-        >>> b'EX\2' == ZEPHandler._strip_until_pkt_start(msg)
-        True
-
-        >>> msg = b'abcdEEEEEEEEEX\2' b'12345'
-        >>> b'EX\2' b'12345' == ZEPHandler._strip_until_pkt_start(msg)
-        True
-
-        >>> msg = b'abcdEEE'
-        >>> b'EE' == ZEPHandler._strip_until_pkt_start(msg)
-        True
+    def packets_spans(cls, data):
+        """Return packets (start, end) in ``data`` and remaining data offset.
 
-        >>> msg = b'abcdEEEa'
-        >>> b'Ea' == ZEPHandler._strip_until_pkt_start(msg)
-        True
+        >>> pkt = b'EX\2' + bytes(bytearray(28)) + b'\3' + b'abc'
+        >>> ZEPHandler.packets_spans(b'ab' + pkt + pkt[:20])
+        ([(2, 37)], 37)
 
-        >>> msg = b'a'
-        >>> b'a' == ZEPHandler._strip_until_pkt_start(msg)
-        True
+        Data that cannot start a packet is skipped, keeping a possible
+        start of packet.
 
+        >>> ZEPHandler.packets_spans(b'abcdEEEa')
+        ([], 6)
+        >>> ZEPHandler.packets_spans(b'a')
+        ([], 0)
         """
-        whole_index = msg.find(cls.ZEP_START)
-        if whole_index == 0:   # is stripped
-            return msg
-        if whole_index != -1:  # found, strip first lines
-            return msg[whole_index:]
+        spans = []
+        offset = 0
+        while True:
+            start = data.find(cls.ZEP_START, offset)
+            if start == -1:
+                # At most 2 bytes required to start a packet
+                return spans, max(offset, len(data) - 2)
 
-        # not found but remove some chars from the buffer
-        # at max 2 required in this case
-        # might be invalid packet but keeps buffer small anymay
-        return msg[-2:]
+            # length = header length + data['len_byte']
+            end = start + cls.ZEP_HDR_LEN
+            if len(data) < end:
+                return spans, start
+            end += data[start + cls.ZEP_LEN_IDX]
+            if len(data) < end:
+                return spans, start
+
+            spans.append((start, end))
+            offset = end
 
 
 class SnifferConnection(asyncconnection.NodeConnection):
@@ -541,19 +1856,25 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
     :type closed_cb: Callable[[Node], None]
     :param error_cb: callback for asynchronous errors
     :type error_cb: Callable[[Node, str], None]
+    :param sniffer_channel: set sniffer channel like
+        ``IoTLABAPI.set_sniffer_channel``
+    :param recorder: callback for all packets, not closed with the node
     """
 
-    STATES = ('closed', 'startingsniffer', 'rawstarting', 'raw')
+    STATES = ('closed', 'startingsniffer', 'connecting', 'sniffing')
     CHANNELS = list(range(11, 26 + 1))
 
     def __init__(self, archi, num,  # pylint:disable=too-many-arguments
-                 closed_cb, error_cb, iotlab_api, asyncoreservice=None):
+                 closed_cb, error_cb, sniffer_channel, asyncoreservice=None,
+                 recorder=None):
         self.host = self.hostname(archi, num)
         self.closed_cb = closed_cb
         self.error_cb = error_cb
 
         self.channel = None
-        self.iotlabapi = iotlab_api
+        self.outputs = {}
+        self.recorder = recorder
+        self.sniffer_channel = sniffer_channel
 
         self.state = 'closed'
         self.reply_publisher = None
@@ -606,8 +1927,8 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
         return event_handler[event]()
 
     def _event_connect(self):
-        if self.state == 'rawstarting':
-            self._reply_request('', newstate='raw')
+        if self.state == 'connecting':
+            self._reply_request('', newstate='sniffing')
             return
 
         raise Exception('Got connect event in invalid state %s' % self.state)
@@ -617,7 +1938,7 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
         error = common.traceback_error()
         previous_state = self._close()
 
-        if previous_state == 'rawstarting':
+        if previous_state == 'connecting':
             self._reply_request('Connection failed: %s' % error)
             return
 
@@ -635,34 +1956,73 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
         previous_state = self.state
         self.connection.close()
         self.connection.data_handler = None
+        self._close_outputs()
         self.state = 'closed'
         self.closed_cb(self)
         return previous_state
 
     @common.synchronized('_rlock')
-    def req_rawstart(self, reply_publisher, zep_handler, channel):
-        """Request to start sniffer redirection on ``channel``."""
-        if self.state == 'raw':
-            ret = 'Already started, stop before start to change channel'
-            return ret.encode('utf-8')
+    def req_start(self, reply_publisher, mode, output, channel):
+        """Request to start sniffer ``mode`` redirection on ``channel``.
+
+        ``output`` is called with the list of packets of each read.
+        If sniffer is already running on ``channel``, only add ``output``.
+        """
+        if self.state == 'sniffing':
+            return self._add_output(mode, output, channel)
 
         if self.state != 'closed':
-            err = "Error: 'rawstarting' in mode %s. Wait or stop it first"
+            err = "Error: 'starting' in mode %s. Wait or stop it first"
             return (err % self.state).encode('utf-8')
 
         self.state = 'startingsniffer'
 
-        self.connection.data_handler = zep_handler
+        self.channel = channel
+        self.outputs[mode] = output
+        self.connection.data_handler = ZEPHandler(self._handle_packets)
         self.reply_publisher = reply_publisher
 
         threading.Thread(target=self._thr_sniff_and_connect,
                          args=(channel,)).start()
         return None
 
+    def _add_output(self, mode, output, channel):
+        """Add ``mode`` output to running sniffer."""
+        if mode in self.outputs or channel != self.channel:
+            ret = 'Already started, stop before start to change channel'
+            return ret.encode('utf-8')
+
+        self.outputs[mode] = output
+        return b''
+
+    @common.synchronized('_rlock')
+    def req_stop(self, mode):
+        """Request to stop sniffer ``mode`` output.
+
+        Node is closed when it was the last output.
+        """
+        common.close_handler(self.outputs.pop(mode, None))
+        if not self.outputs:
+            self._close()
+        return b''
+
+    def _close_outputs(self):
+        """Close outputs, publishing their pending packets."""
+        outputs, self.outputs = self.outputs, {}
+        for output in outputs.values():
+            common.close_handler(output)
+
+    def _handle_packets(self, packets):
+        """Give packets from one read to all outputs and recorder."""
+        for output in list(self.outputs.values()):
+            output(packets)
+        if self.recorder is not None:
+            self.recorder(packets)
+
     def _thr_sniff_and_connect(self, channel):
         # Should be run in a thread and not paho loop
         archi, num = self.host
-        ret_dict = self.iotlabapi.set_sniffer_channel(channel, archi, num)
+        ret_dict = self.sniffer_channel(channel, archi, num)
 
         profile_ret = ret_dict[str(num)]
 
@@ -673,21 +2033,84 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
                 self._close()
         else:
             with self._rlock:
-                self.state = 'rawstarting'
+                self.state = 'connecting'
                 self.connection.start()
 
 
+class SnifferProfiles(object):
+    """Track nodes loaded sniffer channel to skip redundant profile loads.
+
+    ``profiles(channel, archi, num)`` calls ``sniffer_channel`` only if node
+    has not already successfully loaded sniffer profile for ``channel``.
+    Loaded profile is forgotten with ``invalidate`` when node is reset,
+    updated or powered off.
+
+    :param sniffer_channel: set sniffer channel like
+        ``IoTLABAPI.set_sniffer_channel``
+    """
+
+    def __init__(self, sniffer_channel):
+        self.sniffer_channel = sniffer_channel
+        self.loaded = {}
+        self.loading = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, channel, archi, num):
+        """Set node sniffer ``channel`` if not already loaded."""
+        if not self._start_loading(channel, archi, num):
+            return {str(num): ''}
+
+        ret_dict = self.sniffer_channel(channel, archi, num)
+        self._loaded(channel, archi, num, not ret_dict[str(num)])
+        return ret_dict
+
+    @common.synchronized('_lock')
+    def _start_loading(self, channel, archi, num):
+        """Return if profile must be loaded for node."""
+        key = (archi, num)
+        if self.loaded.get(key) == channel:
+            return False
+        self.loaded.pop(key, None)
+        self.loading[key] = channel
+        return True
+
+    @common.synchronized('_lock')
+    def _loaded(self, channel, archi, num, success):
+        """Save node profile if not invalidated while loading."""
+        if self.loading.pop((archi, num), None) == channel and success:
+            self.loaded[(archi, num)] = channel
+
+    @common.synchronized('_lock')
+    def invalidate(self, archi, num):
+        """Forget node loaded sniffer profile."""
+        self.loaded.pop((archi, num), None)
+        self.loading.pop((archi, num), None)
+
+
 class MQTTRadioSnifferAggregator(object):
     """Radio Sniffer Aggregator implementation for MQTT."""
     AGENTTOPIC = 'iot-lab/radiosniffer/{site}'
     TOPICS = {
         'raw': 'raw',
+        'zep': 'zep',
+        'pcapng': 'pcapng',
+        'merged': 'merged',
         'node': '{archi}/{num}',
         'noderaw': '{archi}/{num}/raw',
+        'nodezep': '{archi}/{num}/zep',
+        'nodepcapng': '{archi}/{num}/pcapng',
+        'nodemerged': '{archi}/{num}/merged',
+        'nodestats': '{archi}/{num}/stats',
+        'nodering': '{archi}/{num}/ring',
     }
     HOSTNAME = common.hostname()
+    # Node agent commands that unload the node sniffer profile
+    PROFILE_RESET_COMMANDS = ('reset', 'update', 'poweroff')
 
-    def __init__(self, client, prefix='', iotlab_api=None):
+    def __init__(self, client,  # pylint:disable=too-many-arguments
+                 prefix='', iotlab_api=None, merged_window=0.5, batch=None,
+                 api_batch_window=0.1, stats_window=10, ring_buffer_size=0,
+                 merged_dedup_window=0):
         assert iotlab_api
         super().__init__()
 
@@ -695,6 +2118,9 @@ class MQTTRadioSnifferAggregator(object):
         _topics = mqttcommon.generate_topics_dict(self.TOPICS,
                                                   prefix, self.AGENTTOPIC,
                                                   staticfmt)
+        nodeagent_topic = mqttcommon.generate_topics_dict(
+            nodeagent.MQTTNodeAgent.TOPICS, prefix,
+            nodeagent.MQTTNodeAgent.AGENTTOPIC, staticfmt)['node']
 
         self.topics = {
             'node': mqttcommon.NullTopic(_topics['node']),
@@ -704,26 +2130,94 @@ class MQTTRadioSnifferAggregator(object):
             'rawstart': mqttcommon.RequestServer(_topics['noderaw'], 'start',
                                                  callback=self.cb_rawstart),
             'rawstop': mqttcommon.RequestServer(_topics['noderaw'], 'stop',
-                                                callback=self.cb_stop),
+                                                callback=self.cb_rawstop),
             'raw': mqttcommon.OutputChannelServer(_topics['noderaw']),
 
+            'zepheader': mqttcommon.RequestServer(
+                _topics['zep'], 'zepheader', callback=self.cb_zepheader),
+
+            'zepstart': mqttcommon.RequestServer(_topics['nodezep'], 'start',
+                                                 callback=self.cb_zepstart),
+            'zepstop': mqttcommon.RequestServer(_topics['nodezep'], 'stop',
+                                                callback=self.cb_zepstop),
+            'zep': mqttcommon.OutputChannelServer(_topics['nodezep']),
+
+            'pcapngheader': mqttcommon.RequestServer(
+                _topics['pcapng'], 'pcapngheader',
+                callback=self.cb_pcapngheader),
+
+            'pcapngstart': mqttcommon.RequestServer(
+                _topics['nodepcapng'], 'start', callback=self.cb_pcapngstart),
+            'pcapngstop': mqttcommon.RequestServer(
+                _topics['nodepcapng'], 'stop', callback=self.cb_pcapngstop),
+            'pcapnginterface': mqttcommon.RequestServer(
+                _topics['nodepcapng'], 'interface',
+                callback=self.cb_pcapnginterface),
+            'pcapng': mqttcommon.OutputChannelServer(_topics['nodepcapng']),
+
+            'mergedheader': mqttcommon.RequestServer(
+                _topics['merged'], 'mergedheader',
+                callback=self.cb_mergedheader),
+            'mergedstats': mqttcommon.RequestServer(
+                _topics['merged'], 'stats', callback=self.cb_mergedstats),
+            'merged': mqttcommon.OutputChannelServer(_topics['merged']),
+            'mergedbulkstart': mqttcommon.RequestServer(
+                _topics['merged'], 'start', callback=self.cb_mergedbulkstart),
+            'mergedbulkstop': mqttcommon.RequestServer(
+                _topics['merged'], 'stop', callback=self.cb_mergedbulkstop),
+
+            'mergedstart': mqttcommon.RequestServer(
+                _topics['nodemerged'], 'start', callback=self.cb_mergedstart),
+            'mergedstop': mqttcommon.RequestServer(
+                _topics['nodemerged'], 'stop', callback=self.cb_mergedstop),
+
+            'statsstart': mqttcommon.RequestServer(
+                _topics['nodestats'], 'start', callback=self.cb_statsstart),
+            'statsstop': mqttcommon.RequestServer(
+                _topics['nodestats'], 'stop', callback=self.cb_statsstop),
+            'stats': mqttcommon.OutputChannelServer(_topics['nodestats']),
+
+            'ringstart': mqttcommon.RequestServer(
+                _topics['nodering'], 'start', callback=self.cb_ringstart),
+            'ringstop': mqttcommon.RequestServer(
+                _topics['nodering'], 'stop', callback=self.cb_ringstop),
+
             'stop': mqttcommon.RequestServer(_topics['node'], 'stop',
                                              callback=self.cb_stop),
+            'dump': mqttcommon.RequestServer(_topics['node'], 'dump',
+                                             callback=self.cb_dump),
 
             'stopall': mqttcommon.RequestServer(_topics['agenttopic'],
                                                 'stopall',
                                                 callback=self.cb_stopall),
 
             'error': mqttcommon.ErrorServer(_topics['agenttopic']),
+
+            'nodeagentcommand': mqttcommon.Topic(
+                mqttcommon.RequestTopic.request_topic(nodeagent_topic,
+                                                      '{command}'),
+                callback=self.cb_nodeagentcommand),
         }
 
         self.iotlabapi = iotlab_api
+        # Nodes started together on the same channel load profile at once
+        # and nodes already sniffing on the channel do not reload it
+        self.sniffer_channel = SnifferProfiles(iotlabapi.CommandBatcher(
+            self._set_sniffer_channel, api_batch_window))
+        self.batch = batch or {}
+        self.stats_window = stats_window
+        self.ring_buffer_size = ring_buffer_size
+        self.rings = {}
         self.nodes = {}
         self.asyncore = asyncconnection.AsyncoreService()
 
         self.client = client
         self.client.topics = list(self.topics.values())
 
+        merged = self.topics['merged'].output_publisher(self.client)
+        self.merger = PacketsMerger(merged, merged_window,
+                                    dedup=merged_dedup_window)
+
     def error(self, topic, message):
         """Publish error that happend on topic."""
         self.topics['error'].publish_error(self.client, topic,
@@ -739,17 +2233,146 @@ class MQTTRadioSnifferAggregator(object):
 
         Create a new node if it does not currently exists.
         """
+        return self._start(message, archi, num, 'RAW')
+
+    def cb_zepstart(self, message, archi, num):
+        """Start node sniffer in 'zep' mode.
+
+        Create a new node if it does not currently exists.
+        """
+        return self._start(message, archi, num, 'ZEP')
+
+    def cb_pcapngstart(self, message, archi, num):
+        """Start node sniffer in 'pcapng' mode.
+
+        Create a new node if it does not currently exists.
+        """
+        return self._start(message, archi, num, 'PCAPNG')
+
+    def cb_mergedstart(self, message, archi, num):
+        """Start node sniffer and add it to the merged stream.
+
+        Create a new node if it does not currently exists.
+        """
+        return self._start(message, archi, num, 'MERGED')
+
+    def cb_statsstart(self, message, archi, num):
+        """Start node sniffer with radio statistics output.
+
+        Create a new node if it does not currently exists.
+        """
+        return self._start(message, archi, num, 'STATS')
+
+    def cb_ringstart(self, message, archi, num):
+        """Start node sniffer only recording packets in its ring buffer.
+
+        Create a new node if it does not currently exists.
+        """
+        if not self.ring_buffer_size:
+            return b'Error: ring buffer disabled'
+        if b' ' in message.payload.strip():
+            return b'Error: ring mode has no frames filter'
+        return self._start(message, archi, num, 'RING')
+
+    def _start(self, message, archi, num, mode):
+        """Start node sniffer ``mode`` output."""
         try:
-            channel = self._channel_from_payload(message.payload)
+            channel, match = self._start_from_payload(message.payload)
         except ValueError as err:
             return str(err).encode('utf-8')
+        return self._start_node(message.reply_publisher, archi, num, mode,
+                                channel, match)
 
+    def _start_node(  # pylint:disable=too-many-arguments
+            self, reply_publisher, archi, num, mode, channel, match):
+        """Start node sniffer ``mode`` output on ``channel``."""
         new_node = Node(archi, num, self._node_closed_cb, self._node_error,
-                        self.iotlabapi, asyncoreservice=self.asyncore)
+                        self.sniffer_channel, asyncoreservice=self.asyncore,
+                        recorder=self._ring(archi, num))
         node = self.nodes.setdefault(Node.hostname(archi, num), new_node)
 
-        handler = self._raw_handler(archi, num)
-        return node.req_rawstart(message.reply_publisher, handler, channel)
+        output = self._output(mode, archi, num, channel)
+        if match is not None:
+            output = PacketsFilter(output, match)
+        return node.req_start(reply_publisher, mode, output, channel)
+
+    def cb_mergedbulkstart(self, message):
+        """Start nodes sniffers and add them to the merged stream.
+
+        Payload is 'ARCHI NODESET' followed by the channel and optional
+        filter. Nodes interfaces are added before the reply, sent when all
+        nodes have replied.
+        """
+        try:
+            archi, nums, payload = self._bulk_payload(message.payload)
+            channel, match = self._start_from_payload(payload)
+        except (UnicodeError, ValueError) as err:
+            return str(err).encode('utf-8')
+
+        for num in nums:
+            self.merger.interface('%s-%s' % (archi, num), channel)
+
+        bulk_reply = common.BulkReply(message.reply_publisher, nums)
+        for num in nums:
+            self._bulk_start_node(bulk_reply.publisher(num), archi, str(num),
+                                  channel, match)
+        return None
+
+    def _bulk_start_node(  # pylint:disable=too-many-arguments
+            self, reply_publisher, archi, num, channel, match):
+        """Start node 'merged' output, reply directly if not started."""
+        ret = self._start_node(reply_publisher, archi, num, 'MERGED',
+                               channel, match)
+        if ret is not None:
+            reply_publisher(ret)
+
+    def cb_mergedbulkstop(self, message):
+        """Remove nodes sniffers from the merged stream.
+
+        Payload is 'ARCHI NODESET'.
+        """
+        try:
+            archi, nums, _ = self._bulk_payload(message.payload)
+        except (UnicodeError, ValueError) as err:
+            return str(err).encode('utf-8')
+
+        result = {str(num): self._stop(archi, str(num), 'MERGED')
+                  for num in nums}
+        result = {num: ret.decode('utf-8') for num, ret in result.items()}
+        return json.dumps(result, sort_keys=True).encode('utf-8')
+
+    @staticmethod
+    def _bulk_payload(payload):
+        """Return archi, nums and remaining payload from bulk ``payload``."""
+        parts = payload.decode('utf-8').split(None, 2)
+        archi, nums = common.nodes_from_str(' '.join(parts[:2]))
+        remaining = parts[2] if len(parts) > 2 else ''
+        return archi, nums, remaining.encode('utf-8')
+
+    def _ring(self, archi, num):
+        """Node packets ring buffer, None if disabled."""
+        if not self.ring_buffer_size:
+            return None
+        new_ring = PacketsRing(self.ring_buffer_size)
+        return self.rings.setdefault(Node.hostname(archi, num), new_ring)
+
+    def _set_sniffer_channel(self, channel, archi, *nums):
+        """Set nodes sniffer ``channel`` with IoT-LAB API."""
+        return self.iotlabapi.set_sniffer_channel(channel, archi, *nums)
+
+    @classmethod
+    def _start_from_payload(cls, payload):
+        """Return channel and compiled frames filter from start ``payload``.
+
+        Payload is the channel optionally followed by a filter expression.
+        """
+        channel, _, expression = payload.partition(b' ')
+        channel = cls._channel_from_payload(channel)
+
+        match = None
+        if expression.strip():
+            match = snifferfilter.compile_filter(expression.decode('utf-8'))
+        return channel, match
 
     @staticmethod
     def _channel_from_payload(payload):
@@ -762,21 +2385,74 @@ class MQTTRadioSnifferAggregator(object):
                              (Node.CHANNELS[0], Node.CHANNELS[-1]))
         return channel
 
-    def _raw_handler(self, archi, num):
-        # """Raw handler for node ``archi``, ``num``.
+    def _output(self, mode, archi, num, channel):
+        """Packets output for ``mode`` and node ``archi``, ``num``.
+
+        Publish packets as ``mode`` pcap to the correct topic.
+        'MERGED' mode packets go to the agent merged stream.
+        'STATS' mode publishes radio statistics summaries.
+        'RING' mode publishes nothing, node recorder fills the ring buffer.
+        """
+        if mode == 'RING':
+            return self._ring_only
+        if mode == 'MERGED':
+            return self.merger.output('%s-%s' % (archi, num), channel)
+
+        topic = self.topics[mode.lower()]
+        publisher = topic.output_publisher(self.client, archi=archi, num=num)
+        if mode == 'STATS':
+            return PacketsStats(publisher, self.stats_window)
+        return PacketsOutput(publisher, self._encoder(mode), **self.batch)
+
+    @staticmethod
+    def _ring_only(_):
+        """'RING' mode output, packets are only kept by the node recorder."""
 
-        # Publish the message to the correct topic for ``archi``, ``num``.
-        # """
-        channel = self.topics['raw']
-        publisher = channel.output_publisher(self.client, archi=archi, num=num)
-        raw_encoder = ZepToPcap(mode='RAW').convert
+    @staticmethod
+    def _encoder(mode):
+        """Packets encoder for output ``mode``.
 
-        return ZEPHandler(lambda msg: publisher(raw_encoder(msg)))
+        'PCAPNG' mode encodes 802.15.4 frames in pcapng blocks.
+        """
+        if mode == 'PCAPNG':
+            return ZepToPcapng(mode='RAW')
+        return ZepToPcap(mode=mode)
 
     def _node_closed_cb(self, node):
         """Remove closed node."""
         self.nodes.pop(node.host, None)
 
+    def cb_rawstop(self, message, archi, num):
+        """Stop node sniffer 'raw' output."""
+        return self._stop(archi, num, 'RAW')
+
+    def cb_zepstop(self, message, archi, num):
+        """Stop node sniffer 'zep' output."""
+        return self._stop(archi, num, 'ZEP')
+
+    def cb_pcapngstop(self, message, archi, num):
+        """Stop node sniffer 'pcapng' output."""
+        return self._stop(archi, num, 'PCAPNG')
+
+    def cb_mergedstop(self, message, archi, num):
+        """Remove node sniffer from the merged stream."""
+        return self._stop(archi, num, 'MERGED')
+
+    def cb_statsstop(self, message, archi, num):
+        """Stop node sniffer radio statistics output."""
+        return self._stop(archi, num, 'STATS')
+
+    def cb_ringstop(self, message, archi, num):
+        """Stop node sniffer ring buffer only recording."""
+        return self._stop(archi, num, 'RING')
+
+    def _stop(self, archi, num, mode):
+        """Stop node sniffer ``mode`` output, other outputs are kept."""
+        node = self.nodes.get(Node.hostname(archi, num))
+        if node is None:
+            return b''
+        return node.req_stop(mode)
+
     def cb_stop(self, message, archi, num):
         """Stop node redirection.
 
@@ -793,12 +2469,72 @@ class MQTTRadioSnifferAggregator(object):
         """Return header for 'RAW' header."""
         return ZepToPcap(mode='RAW').header
 
+    @staticmethod
+    def cb_zepheader(_):
+        """Return header for 'ZEP' header."""
+        return ZepToPcap(mode='ZEP').header
+
+    def cb_pcapngheader(self, _):
+        """Return pcapng Section Header Block."""
+        return self._encoder('PCAPNG').header
+
+    def cb_mergedheader(self, _):
+        """Return merged stream section header and interfaces blocks."""
+        return self.merger.header
+
+    def cb_mergedstats(self, _):
+        """Return merged stream counters."""
+        return json.dumps(self.merger.get_stats()).encode('utf-8')
+
+    def cb_pcapnginterface(self, message, archi, num):
+        """Return node pcapng Interface Description Block."""
+        node = self.nodes.get(Node.hostname(archi, num))
+        if node is None or 'PCAPNG' not in node.outputs:
+            return b'Error: pcapng sniffer not started'
+
+        name = '%s-%s' % (archi, num)
+        return self._encoder('PCAPNG').interface(name, node.channel)
+
+    def cb_dump(self, message, archi, num):
+        """Return node ring buffer last seconds packets as a pcap file."""
+        try:
+            seconds, mode = self._dump_from_payload(message.payload)
+        except ValueError as err:
+            return str(err).encode('utf-8')
+
+        ring = self.rings.get(Node.hostname(archi, num))
+        if ring is None:
+            return b'Error: no ring buffer for node'
+
+        encoder = ZepToPcap(mode=mode)
+        return encoder.header + encoder.convert_many(ring.last(seconds))
+
+    @staticmethod
+    def _dump_from_payload(payload):
+        """Return seconds and pcap mode from dump ``payload``."""
+        try:
+            words = payload.decode('utf-8').split()
+            seconds = float(words[0])
+            mode = (words[1:] or ['raw'])[0]
+            if seconds <= 0 or mode not in ('raw', 'zep') or len(words) > 2:
+                raise ValueError()
+        except (IndexError, TypeError, ValueError):
+            raise ValueError('Invalid dump value, should be '
+                             '"SECONDS [raw|zep]"')
+        return seconds, mode.upper()
+
+    def cb_nodeagentcommand(self, message, archi, num, command, **_):
+        """Forget node sniffer profile on node agent reset/update/poweroff."""
+        if command in self.PROFILE_RESET_COMMANDS:
+            self.sniffer_channel.invalidate(archi, num)
+
     def cb_stopall(self, message):
         """Stop nodes sniffer redirection.
 
         In practice do not stop sniffer profile.
         """
         self._stop_all_nodes()
+        self.rings.clear()
         return b''
 
     # Agent running
@@ -821,6 +2557,7 @@ class MQTTRadioSnifferAggregator(object):
         self.client.stop()
         self._stop_all_nodes()
         self.asyncore.stop()
+        self.merger.close()
 
     def _stop_all_nodes(self):
         """Close all nodes connections."""
@@ -828,11 +2565,25 @@ class MQTTRadioSnifferAggregator(object):
             node.close()
 
     @classmethod
-    def from_opts_dict(cls, prefix, **kwargs):
+    def from_opts_dict(cls, prefix,  # pylint:disable=too-many-arguments
+                       merged_window=0.5, api_batch_window=0.1,
+                       stats_window=10, ring_buffer_size=0,
+                       merged_dedup_window=0, **kwargs):
         """Create class from argparse entries."""
         api = iotlabapi.IoTLABAPI.from_opts_dict(**kwargs)
         client = mqttcommon.MQTTClient.from_opts_dict(**kwargs)
-        return cls(client, prefix, iotlab_api=api)
+        return cls(client, prefix, iotlab_api=api,
+                   merged_window=merged_window,
+                   batch=cls._batch_from_opts(**kwargs),
+                   api_batch_window=api_batch_window,
+                   stats_window=stats_window,
+                   ring_buffer_size=ring_buffer_size,
+                   merged_dedup_window=merged_dedup_window)
+
+    @staticmethod
+    def _batch_from_opts(batch_interval=0, batch_size=0, **_):
+        """Return packets batch options from argparse entries."""
+        return {'delay': batch_interval, 'size': batch_size}
 
 
 def main():
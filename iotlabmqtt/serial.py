@@ -8,12 +8,21 @@ r"""IoT-LAB MQTT Serial agent
 .. |linechannel|      replace::  |node|\ ``/line/data``
 .. |linestart|        replace::  |node|\ ``/line/ctl/start``
 .. |linestop|         replace::  |node|\ ``/line/ctl/stop``
+.. |linecapture|      replace::  |node|\ ``/line/ctl/capture``
+.. |metricschannel|   replace::  |node|\ ``/line/metrics/data``
+.. |lineexpect|       replace::  |node|\ ``/line/ctl/expect``
+.. |linereplay|       replace::  |node|\ ``/line/ctl/replay``
+.. |replaychannel|    replace::  |node|\ ``/line/replay/data``
 .. |raw|              replace::  |node|\ ``/raw``
 .. |rawchannel|       replace::  |node|\ ``/raw/data``
 .. |rawstart|         replace::  |node|\ ``/raw/ctl/start``
 .. |rawstop|          replace::  |node|\ ``/raw/ctl/stop``
 .. |stop|             replace::  |node|\ ``/ctl/stop``
+.. |stats|            replace::  |node|\ ``/ctl/stats``
 .. |stopall|          replace::  ``{serialagenttopic}/ctl/stopall``
+.. |bulklinestart|    replace::  ``{serialagenttopic}/ctl/linestart``
+.. |bulklinestop|     replace::  ``{serialagenttopic}/ctl/linestop``
+.. |merged|           replace::  ``{serialagenttopic}/line/data``
 .. |error_t|          replace::  ``{serialagenttopic}/error/``
 
 .. |channel|          replace::  :ref:`Channel <ChannelTopic>`
@@ -53,10 +62,18 @@ Topics Summary
 +-+----------------------------------------------------------------+----------+
 | ||stopall|                                                       ||request| |
 +-+----------------------------------------------------------------+----------+
+| ||bulklinestart|                                                 ||request| |
++-+----------------------------------------------------------------+----------+
+| ||bulklinestop|                                                  ||request| |
++-+----------------------------------------------------------------+----------+
+| ||merged|                                                        ||channel| |
++-+----------------------------------------------------------------+----------+
 |  **Node**                                                                   |
 +-+----------------------------------------------------------------+----------+
 | ||stop|                                                          ||request| |
 +-+----------------------------------------------------------------+----------+
+| ||stats|                                                         ||request| |
++-+----------------------------------------------------------------+----------+
 |  **Line redirection**                                                       |
 +-+----------------------------------------------------------------+----------+
 | ||linestart|                                                     ||request| |
@@ -65,7 +82,23 @@ Topics Summary
 +-+----------------------------------------------------------------+----------+
 | ||linechannel|                                                   ||channel| |
 +-+----------------------------------------------------------------+----------+
-|  **Raw redirection** *(not implemented for the moment)*                     |
+| ||metricschannel|                                                ||channel| |
++-+----------------------------------------------------------------+----------+
+| ||lineexpect|                                                    ||request| |
++-+----------------------------------------------------------------+----------+
+| ||linecapture|                                                   ||request| |
++-+----------------------------------------------------------------+----------+
+| ||linereplay|                                                    ||request| |
++-+----------------------------------------------------------------+----------+
+| ||replaychannel|                                                 ||channel| |
++-+----------------------------------------------------------------+----------+
+|  **Raw redirection**                                                        |
++-+----------------------------------------------------------------+----------+
+| ||rawstart|                                                      ||request| |
++-+----------------------------------------------------------------+----------+
+| ||rawstop|                                                       ||request| |
++-+----------------------------------------------------------------+----------+
+| ||rawchannel|                                                    ||channel| |
 +-+----------------------------------------------------------------+----------+
 
 
@@ -103,6 +136,82 @@ Stop all started serial redirections.
 +------------+-----------------------------------------+----------------------+
 
 
+Start nodes redirections in *line* mode
+---------------------------------------
+
+Start multiple nodes serial redirection in *line* mode with one request.
+
+Nodes are given as ``ARCHI NODESET``, for example ``m3 1-120,200-250``,
+optionally followed by the json options described in :ref:`line_start`.
+
+Nodes are connected concurrently, the reply is sent when all nodes have
+replied. It is a ``json`` object with the reply for each node ``num``, for
+example ``{"1": "", "2": "Connection failed: ..."}``.
+
++-----------------------------------------------------------------------------+
+| ``linestart`` request:                                                      |
++============+================================================================+
+| Topic:     |    |bulklinestart|                                             |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``ARCHI NODESET``    |
+|            |                                         | [``json`` options]   |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
+|            |                                         | or error_msg         |
++------------+-----------------------------------------+----------------------+
+
+
+Stop nodes redirections
+-----------------------
+
+Stop multiple nodes serial redirection whatever the mode was.
+
+Reply is a ``json`` object with the reply for each node ``num``.
+
++-----------------------------------------------------------------------------+
+| ``linestop`` request:                                                       |
++============+================================================================+
+| Topic:     |    |bulklinestop|                                              |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``ARCHI NODESET``    |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
+|            |                                         | or error_msg         |
++------------+-----------------------------------------+----------------------+
+
+
+Merged lines output
+-------------------
+
+When the agent is run with ``--merged-interval``, lines published by all
+nodes are also merged in batches, every ``--merged-interval`` seconds or
+when reaching ``--merged-size`` bytes.
+
+A batch is a list of lines, joined with newlines, in reception order: ::
+
+   TIMESTAMP;ARCHI-NUM;LINE
+
+``TIMESTAMP`` is the time the line was received by the agent.
+``MergedLines.decode`` returns the list of ``(timestamp, node, line)``.
+
+This gives one ordered stream for all the site nodes with less messages than
+subscribing to all nodes |linechannel|.
+
++-----------------------------------------------------------------------------+
+| **Merged lines output**                                                     |
++============+================================================================+
+| Topic:     |    |merged|                                                    |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | Merged lines batch   |
++------------+-----------------------------------------+----------------------+
+
+
 Node topics
 ===========
 
@@ -127,6 +236,33 @@ Stop given node serial redirection whatever the mode was.
 +------------+-----------------------------------------+----------------------+
 
 
+Node statistics
+---------------
+
+Get given node redirection state and counters as a ``json`` object.
+
+Counters depend on the redirection options:
+
+:filter_matched: lines matching the line filter
+:filter_dropped: lines not matching the line filter
+:ratelimit_dropped: lines dropped by rate limits
+:input_queue: paced input lines waiting to be sent
+
+
++-----------------------------------------------------------------------------+
+| ``stats`` request:                                                          |
++============+================================================================+
+| Topic:     |    |stats|                                                     |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
+|            |                                         | or error_msg         |
++------------+-----------------------------------------+----------------------+
+
+
 Line redirection topics
 =======================
 
@@ -134,117 +270,1204 @@ Topics to access to the node serial port redirection in 'line' mode.
 The redirection must first be started in ``line`` mode to have the line output.
 
 
-Data received from the node is split on newlines characters with newlines
-stripped.
+Data received from the node is split on newlines characters with newlines
+stripped.
+
+As newlines characters are not used in multibytes ``utf-8`` characters,
+each line remains, if it was, a valid ``utf-8`` string.
+On invalid ``utf-8`` strings sent by the node,
+the data will also be invalid in the topic.
+
+
+.. _line_start:
+
+Start redirection in *line* mode
+--------------------------------
+
+Start one node serial redirection in *line* mode.
+
+It is configured with an optional ``json`` object payload:
+
+:filter: only publish lines matching the filter, evaluated by the agent.
+         It is an object with ``prefix``, a list of lines prefixes,
+         and/or ``regex``, a regular expression searched in lines.
+         A line is published if it matches any of them.
+:ratelimit: limit published ``lines`` and/or ``bytes`` per second,
+            0 for no limit. Defaults to the agent ``--rate-limit-lines``
+            and ``--rate-limit-bytes`` values, that are also maximum
+            values: higher ones are lowered and 0 is refused.
+:metrics: parse numeric fields and publish their aggregates instead of
+          lines, see `Line metrics`_.
+:pace: pace line input with ``rate`` bytes per second and ``delay``
+       seconds between lines, 0 for no limit. Defaults to the agent
+       ``--input-rate`` and ``--input-line-delay`` values.
+
+Example: ``{"filter": {"prefix": ["RESULT:"]}, "ratelimit": {"lines": 100}}``
+
+Published lines are also limited for all nodes by the agent
+``--agent-rate-limit-lines`` and ``--agent-rate-limit-bytes`` values.
+Limits allow bursts of one second of traffic. Lines over limits are dropped
+and summarized on the error topic, for example ``dropped 12034 lines in 5s``.
+
+Options are only used when starting the redirection, if already started in
+*line* mode they are ignored.
+
++-----------------------------------------------------------------------------+
+| ``line/start`` request:                                                     |
++============+================================================================+
+| Topic:     |    |linestart|                                                 |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty* or           |
+|            |                                         | ``json`` options     |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
+Stop line redirection
+---------------------
+
+Equivalent to :ref:`stop_redirection` added here for completeness.
+
++-----------------------------------------------------------------------------+
+| ``line/stop`` request:                                                      |
++============+================================================================+
+| Topic:     |    |linestop|                                                  |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
+Line redirection
+----------------
+
+Serial redirection sends text lines with newline characters removed (``\n``).
+
+One message is received per line, and when sending a message, the newline
+character is automatically added.
+
+With paced input, see ``pace`` in :ref:`line_start`, input messages can
+contain multiple lines. They are queued and sent one line at a time, to not
+overrun the node serial buffer.
+Queued lines are dropped on 'line' stop. If sending fails, remaining lines
+are dropped and the error is published on the error topic.
+
++-----------------------------------------------------------------------------+
+| **Text line serial redirection**                                            |
++============+================================================================+
+| Topic:     |    |linechannel|                                               |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | UTF-8 text line      |
++------------+-----------------------------------------+----------------------+
+| Input      | |in_topic|                              | UTF-8 text line      |
++------------+-----------------------------------------+----------------------+
+
+
+Line envelope
+-------------
+
+When the agent is run with ``--line-envelope``, output lines are prefixed with
+a binary header giving the time the line was received by the agent, so it is
+not affected by broker and client delays.
+Input lines are not changed.
+
+Header format is, as network endian: ::
+
+   :8 bytes: Receive time, seconds since epoch as a double
+   :4 bytes: Sequence number, per node, starting at 0 on line start
+
+``LineEnvelope.decode`` returns the ``(timestamp, seqno, line)`` tuple.
+
+Sequence numbers are given to lines when received, before the line filter,
+metrics and rate limits. Lines not published still use a number, they are
+counted in the node ``filter_dropped`` and ``ratelimit_dropped``
+`Node statistics`_. Other gaps are messages lost in transport.
+
+
+Group line input
+----------------
+
+Input lines can be sent to multiple nodes with one message by replacing
+``{num}`` in |linechannel| input topic by:
+
+* ``all``: all ``{archi}`` nodes currently in *line* mode
+* a nodeset, for example ``1-120,200-250``
+
+Example: ``{serialagenttopic}/m3/all/line/data/in``
+
+Nodes that could not be written are published on the error topic as a
+``json`` object with each node ``num`` error message.
+
+
+Line metrics
+------------
+
+With the ``metrics`` *line* start option, numeric fields are parsed from
+lines and only their aggregates are published, every ``window`` seconds,
+on |metricschannel| output.
+
+Fields are parsed after filtering. ``metrics`` is an object with:
+
+:keys: list of ``key=value`` fields to parse, empty list for all fields.
+:regex: regular expression, its named groups give fields names and values.
+:window: aggregation window in seconds, greater than 0, default 10.
+:lines: also publish lines on |linechannel|, default false.
+
+Infinite and NaN values are ignored.
+
+Example: ``{"metrics": {"keys": ["temp", "rssi"], "window": 60}}``
+
+Aggregates are published as a ``json`` object with the window ``start``
+time, ``window`` duration and for each field in ``fields``: ``count``,
+``min``, ``max``, ``mean`` and ``last`` values.
+
++-----------------------------------------------------------------------------+
+| **Line metrics output**                                                     |
++============+================================================================+
+| Topic:     |    |metricschannel|                                            |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | ``utf-8 json object``|
++------------+-----------------------------------------+----------------------+
+
+
+Expect script
+-------------
+
+Run a send/expect script on a node in *line* mode directly in the agent,
+instead of doing one broker round trip per step.
+
+The script is a ``json`` list of steps, each step being an object with:
+
+:send: line to send to the node, newline is added.
+:expect: regular expression searched in the node lines.
+:timeout: maximum time in seconds waiting for ``expect``, default 10,
+          at most 300.
+
+Example: ``[{"send": "help"}, {"expect": "^>", "timeout": 2},
+{"send": "get_temp"}, {"expect": "temp=([0-9.]+)"}]``
+
+Lines are matched from the request reception, in order, so lines received
+before a step are matched by its ``expect``.
+The script stops on the first timeout.
+At most 4 scripts are run at the same time on a node.
+
+Reply is sent at the script end as a ``json`` object with:
+
+:steps: list of steps results with ``send`` line, matched ``line`` and
+        regular expression ``groups`` or ``timeout``, and step ``time``
+        in seconds.
+:error: error message if a line could not be sent, else ``null``.
+
++-----------------------------------------------------------------------------+
+| ``line/expect`` request:                                                    |
++============+================================================================+
+| Topic:     |    |lineexpect|                                                |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | ``json`` script      |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | ``utf-8 json object``|
+|            |                                         | or error_msg         |
++------------+-----------------------------------------+----------------------+
+
+
+Line capture and replay
+-----------------------
+
+When the agent is run with ``--capture-dir``, all lines received in *line*
+mode are recorded, before filtering, to per node rolling segment files.
+Oldest segments are removed according to ``--capture-max-size`` and
+``--capture-max-age``, also for nodes not sending lines anymore.
+
+The |linecapture| request connects the node to only record its lines from
+the connection, for example its boot output before a client starts *line*
+mode. A *line* start then publishes lines without reconnecting, and *line*
+stop goes back to only recording. Node |stop| ends the capture.
+
++-----------------------------------------------------------------------------+
+| ``line/capture`` request:                                                   |
++============+================================================================+
+| Topic:     |    |linecapture|                                               |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+Captured lines for a time range are replayed on |replaychannel| output with
+the `Line envelope`_ header giving their original receive time and sequence
+number. An empty message marks the end of the replay, also when it failed,
+the error is then published on the error topic.
+
+Replay is configured with an optional ``json`` object payload:
+
+:start: replay lines received after ``start``, seconds since epoch.
+:end: replay lines received before ``end``, 0 for up to now.
+:rate: maximum lines per second published, 0 for no limit.
+
+Example: ``{"start": 1490000000, "end": 1490000060, "rate": 100}``
+
+Only nodes with captured lines can be replayed, and the agent runs at most
+4 replays at the same time.
+
++-----------------------------------------------------------------------------+
+| ``line/replay`` request:                                                    |
++============+================================================================+
+| Topic:     |    |linereplay|                                                |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty* or           |
+|            |                                         | ``json`` options     |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
++-----------------------------------------------------------------------------+
+| **Captured lines replay**                                                   |
++============+================================================================+
+| Topic:     |    |replaychannel|                                             |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | Enveloped line or    |
+|            |                                         | *empty* at the end   |
++------------+-----------------------------------------+----------------------+
+
+
+Raw redirection topics
+======================
+
+Topics to access to the node serial port redirection in 'raw' mode.
+The redirection must first be started in ``raw`` mode to have the raw output.
+
+Data is forwarded unchanged in both directions, so it can be used for binary
+protocols (SLIP, CBOR, HDLC frames...).
+
+
+Start redirection in *raw* mode
+-------------------------------
+
+Start one node serial redirection in *raw* mode.
+
+Received data can be coalesced to send less messages, it is configured with an
+optional ``json`` object payload:
+
+:size: send data when at least ``size`` bytes have been received.
+:delay: send data at most ``delay`` seconds after it was received.
+
+With no options, data is sent as received from the node.
+With only ``size``, ``delay`` is one second, so data is not kept
+indefinitely, like the radio sniffer batches.
+
++-----------------------------------------------------------------------------+
+| ``raw/start`` request:                                                      |
++============+================================================================+
+| Topic:     |    |rawstart|                                                  |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty* or           |
+|            |                                         | ``json`` options     |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
+Stop raw redirection
+--------------------
+
+Equivalent to :ref:`stop_redirection` added here for completeness.
+
++-----------------------------------------------------------------------------+
+| ``raw/stop`` request:                                                       |
++============+================================================================+
+| Topic:     |    |rawstop|                                                   |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Request    | |request_topic|                         | *empty*              |
++------------+-----------------------------------------+----------------------+
+| Reply      | |reply_topic|                           | *empty* or error_msg |
++------------+-----------------------------------------+----------------------+
+
+
+Raw redirection
+---------------
+
+Serial redirection sends received bytes unchanged.
+
+No newline character is added when sending a message.
+
++-----------------------------------------------------------------------------+
+| **Raw serial redirection**                                                  |
++============+================================================================+
+| Topic:     |    |rawchannel|                                                |
++------------+-----------------------------------------+----------------------+
+|**Message** | **Topic**                               | **Payload**          |
++------------+-----------------------------------------+----------------------+
+| Output     | |out_topic|                             | Raw bytes            |
++------------+-----------------------------------------+----------------------+
+| Input      | |in_topic|                              | Raw bytes            |
++------------+-----------------------------------------+----------------------+
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+try:
+    import Queue as queue
+except ImportError:  # pragma: no cover
+    import queue
+import re
+import math
+import time
+import json
+import struct
+import threading
+import functools
+
+from . import common
+from . import mqttcommon
+from . import asyncconnection
+from . import serialcapture
+
+PARSER = common.MQTTAgentArgumentParser()
+PARSER.add_argument('--line-envelope', action='store_true', default=False,
+                    help='Prefix lines with receive time and seqno header')
+PARSER.add_argument('--rate-limit-lines', type=float, default=0,
+                    help='Per node published lines per second, 0 no limit')
+PARSER.add_argument('--rate-limit-bytes', type=float, default=0,
+                    help='Per node published bytes per second, 0 no limit')
+PARSER.add_argument('--agent-rate-limit-lines', type=float, default=0,
+                    help='Agent published lines per second, 0 no limit')
+PARSER.add_argument('--agent-rate-limit-bytes', type=float, default=0,
+                    help='Agent published bytes per second, 0 no limit')
+PARSER.add_argument('--input-rate', type=float, default=0,
+                    help='Line input bytes per second per node, 0 no limit')
+PARSER.add_argument('--input-line-delay', type=float, default=0,
+                    help='Line input delay in seconds between lines')
+PARSER.add_argument('--merged-interval', type=float, default=0,
+                    help='Publish all nodes lines merged every interval '
+                         'seconds on agent line topic, 0 disabled')
+PARSER.add_argument('--merged-size', type=int, default=0,
+                    help='Merged lines maximum batch size in bytes')
+PARSER.add_argument('--capture-dir', default=None,
+                    help='Record nodes lines to this directory for replay')
+PARSER.add_argument('--capture-segment-size', type=int, default=1 << 22,
+                    help='Capture segment file size in bytes')
+PARSER.add_argument('--capture-max-size', type=int, default=0,
+                    help='Node capture maximum size in bytes, 0 no limit')
+PARSER.add_argument('--capture-max-age', type=float, default=0,
+                    help='Capture maximum age in seconds, 0 no limit')
+
+
+class LineHandler(object):
+    """Line data handler."""
+    def __init__(self, handler):
+        self.data = b''
+        self.handler = handler
+
+    def __call__(self, data):
+        """Call 'handler' on received data line by line."""
+
+        # 'newline' byte never appear in multibyte unicode char
+        # so it can be split without decoding
+        self.data += data
+        lines = self.data.splitlines(True)
+
+        for full_line in lines:
+            # strip newline using splitlines
+            line = full_line.splitlines()[0]
+
+            # last incomplete line
+            if line == full_line:
+                self.data = line
+                return
+
+            self.handler(line)
+
+        self.data = b''
+
+    def close(self):
+        """Close 'handler'."""
+        common.close_handler(self.handler)
+
+
+def options_from_payload(payload, defaults):
+    """Return options dict from json ``payload`` updating ``defaults``.
+
+    Empty payload returns ``defaults``.
+    Only options from ``defaults`` are accepted and numbers must be positive.
+
+    >>> options_from_payload(b'', {'size': 0}) == {'size': 0}
+    True
+    >>> options_from_payload(b'{"size": 3}', {'size': 0}) == {'size': 3}
+    True
+
+    >>> options_from_payload(b'{"length": 3}', {'size': 0})
+    Traceback (most recent call last):
+    ValueError: Invalid options, unknown option 'length'
+
+    >>> options_from_payload(b'{"size": -1}', {'size': 0})
+    Traceback (most recent call last):
+    ValueError: Invalid options, 'size' should be a positive number
+
+    >>> options_from_payload(b'[1, 2]', {'size': 0})
+    Traceback (most recent call last):
+    ValueError: Invalid options, should be a json object
+    """
+    options = dict(defaults)
+    if not payload:
+        return options
+
+    for name, value in _json_object(payload).items():
+        _check_option(name, value, defaults)
+        options[name] = value
+    return options
+
+
+def _json_object(payload):
+    """Decode ``payload`` as a json object."""
+    try:
+        values = json.loads(payload.decode('utf-8'))
+    except ValueError:
+        values = None
+
+    if not isinstance(values, dict):
+        raise ValueError('Invalid options, should be a json object')
+    return values
+
+
+def _check_option(name, value, defaults):
+    """Check option ``name`` is known and ``value`` has default type."""
+    if name not in defaults:
+        raise ValueError('Invalid options, unknown option %r' % str(name))
+
+    # Numbers options should be positive numbers
+    if isinstance(defaults[name], (int, float)):
+        if not isinstance(value, (int, float)) or value < 0:
+            raise ValueError("Invalid options, '%s' should be a "
+                             "positive number" % name)
+
+
+def _dict_option(value, defaults, error):
+    """Return option ``value`` json object updating ``defaults`` dict.
+
+    :raises ValueError: with ``error`` message if ``value`` is not an object
+    """
+    values = dict(defaults)
+    if value is None:
+        return values
+
+    if not isinstance(value, dict):
+        raise ValueError(error)
+    for name, val in value.items():
+        _check_option(name, val, defaults)
+        values[name] = val
+    return values
+
+
+class LineFilter(object):
+    """Only call ``handler`` on lines matching filter.
+
+    :param handler: callback for matching lines
+    :param match: match function from ``LineFilter.matcher``
+    :param stats: counters dict updated with matched and dropped lines
+    """
+    SPEC_ERROR = ("Invalid filter, should be "
+                  "{'prefix': [prefix, ...], 'regex': regex}")
+
+    def __init__(self, handler, match, stats):
+        self.handler = handler
+        self.match = match
+        self.stats = stats
+        self.stats.update({'filter_matched': 0, 'filter_dropped': 0})
+
+    def __call__(self, line):
+        """Call 'handler' if line matches."""
+        if self.match(line):
+            self.stats['filter_matched'] += 1
+            self.handler(line)
+        else:
+            self.stats['filter_dropped'] += 1
+
+    def close(self):
+        """Close 'handler'."""
+        common.close_handler(self.handler)
+
+    @classmethod
+    def matcher(cls, spec):
+        """Return a match function for filter ``spec``.
+
+        Lines match if they start with one of ``prefix`` values
+        or if ``regex`` matches.
+
+        >>> match = LineFilter.matcher({'prefix': ['RESULT:', 'ERR']})
+        >>> match(b'RESULT: 42'), match(b'ERROR'), match(b'Other')
+        (True, True, False)
+
+        >>> match = LineFilter.matcher({'prefix': [], 'regex': 'temp=[0-9]'})
+        >>> bool(match(b'temp=24 rssi=-71')), bool(match(b'temp=NaN'))
+        (True, False)
+        """
+        try:
+            matchers = [getattr(cls, '_%s_matcher' % name)(value)
+                        for name, value in spec.items()]
+        except (AttributeError, TypeError, re.error):
+            raise ValueError(cls.SPEC_ERROR)
+
+        if not matchers:
+            raise ValueError(cls.SPEC_ERROR)
+        return lambda line: any(match(line) for match in matchers)
+
+    @staticmethod
+    def _prefix_matcher(prefixes):
+        """Match lines starting by one of ``prefixes``."""
+        if not isinstance(prefixes, list):
+            raise TypeError()
+        prefixes = tuple(prefix.encode('utf-8') for prefix in prefixes)
+        return lambda line: line.startswith(prefixes)
+
+    @staticmethod
+    def _regex_matcher(regex):
+        """Match lines where ``regex`` is found."""
+        return re.compile(regex.encode('utf-8')).search
+
+
+class LineCounter(object):
+    """Number received lines before calling ``handler``.
+
+    ``seqno`` is the sequence number of the line being handled.
+    ``handler`` can be set after creation.
+
+    :param handler: callback for lines
+    """
+    SEQNO_MASK = 0xffffffff
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        # First line is 0
+        self.seqno = self.SEQNO_MASK
+
+    def __call__(self, line):
+        """Number line and call 'handler'."""
+        self.seqno = (self.seqno + 1) & self.SEQNO_MASK
+        self.handler(line)
+
+    def close(self):
+        """Close 'handler'."""
+        common.close_handler(self.handler)
+
+
+class LineEnvelope(object):
+    """Prepend lines with a header with receive time and sequence number.
+
+    Without ``counter``, published lines are numbered.
+
+    :param handler: callback for enveloped lines
+    :param clock: function returning line receive time
+    :param counter: ``LineCounter`` numbering received lines
+    """
+    # receive time as seconds since epoch, sequence number
+    HEADER = struct.Struct(b'!dL')
+    SEQNO_MASK = LineCounter.SEQNO_MASK
+
+    def __init__(self, handler, clock, counter=None):
+        self.handler = handler
+        self.clock = clock
+        self.counter = counter
+        self.seqno = 0
+
+    def __call__(self, line):
+        """Call 'handler' with enveloped line."""
+        seqno = self.seqno if self.counter is None else self.counter.seqno
+        payload = self.encode(self.clock(), seqno, line)
+        self.seqno = (seqno + 1) & self.SEQNO_MASK
+        self.handler(payload)
+
+    def close(self):
+        """Close 'handler'."""
+        common.close_handler(self.handler)
+
+    @classmethod
+    def encode(cls, timestamp, seqno, line):
+        """Return enveloped ``line``."""
+        return cls.HEADER.pack(timestamp, seqno) + line
+
+    @classmethod
+    def decode(cls, payload):
+        """Return (timestamp, seqno, line) from enveloped ``payload``.
+
+        >>> payload = LineEnvelope.encode(1490000000.5, 42, b'line')
+        >>> len(payload) == LineEnvelope.HEADER.size + len(b'line')
+        True
+        >>> LineEnvelope.decode(payload) == (1490000000.5, 42, b'line')
+        True
+        """
+        timestamp, seqno = cls.HEADER.unpack_from(payload)
+        return timestamp, seqno, payload[cls.HEADER.size:]
+
+
+class LineRateLimiter(object):  # pylint:disable=too-many-instance-attributes
+    """Drop lines over rate limits and notify dropped lines count.
+
+    Dropped lines are summarized in one notification ``interval`` seconds
+    after the first drop.
+
+    :param handler: callback for lines within limits
+    :param limits: list of (TokenBucket, cost) with ``cost(line)`` the tokens
+        used by a line, from ``LineRateLimiter.limits``
+    :param notify: callback for dropped lines summary message
+    :param stats: counters dict updated with dropped lines
+    :param interval: summary interval in seconds
+    """
+
+    def __init__(self,  # pylint:disable=too-many-arguments
+                 handler, limits, notify, stats, interval=5.0):
+        self.handler = handler
+        self._limits = limits
+        self.notify = notify
+        self.stats = stats
+        self.stats.update({'ratelimit_dropped': 0})
+        self.interval = interval
+
+        self.dropped = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __call__(self, line):
+        """Call 'handler' if ``line`` is within limits."""
+        costs = [(bucket, cost(line)) for bucket, cost in self._limits]
+        if all(bucket.available(amount) for bucket, amount in costs):
+            for bucket, amount in costs:
+                bucket.consume(amount)
+            self.handler(line)
+            return
+
+        self.stats['ratelimit_dropped'] += 1
+        with self._lock:  # pylint:disable=not-context-manager
+            self.dropped += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self.summary)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def summary(self):
+        """Notify dropped lines since last summary."""
+        with self._lock:  # pylint:disable=not-context-manager
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            self.notify('dropped %u lines in %gs' % (dropped, self.interval))
+
+    def close(self):
+        """Notify remaining dropped lines and close 'handler'."""
+        self.summary()
+        common.close_handler(self.handler)
+
+    @staticmethod
+    def limits(lines=0, bytes=0):  # pylint:disable=W0622
+        """Return limits for ``lines`` and ``bytes`` per second, 0 disables.
+
+        >>> [cost(b'abc') for _, cost in LineRateLimiter.limits(10, 100)]
+        [1, 3]
+        >>> LineRateLimiter.limits()
+        []
+        """
+        limits = [(lines, lambda line: 1), (bytes, len)]
+        return [(common.TokenBucket(rate), cost)
+                for rate, cost in limits if rate]
+
+
+class MergedLines(object):
+    """Merge nodes lines in batches of time ordered tagged lines.
+
+    Each line is formatted as ``TIMESTAMP;ARCHI-NUM;LINE``, batches are lines
+    joined with newlines and handled every ``interval`` seconds or when
+    reaching ``size`` bytes.
+
+    Nodes lines are all received in the asyncore thread, so adding them in
+    reception order keeps batches time ordered.
+
+    :param handler: callback for batches
+    :param interval: maximum time in seconds lines are kept
+    :param size: batch size in bytes, 0 to disable
+    """
+    LINE_FMT = b'%.6f;%s;%s\n'
+
+    def __init__(self, handler, interval, size=0):
+        self.handler = handler
+        self.batcher = common.DataBatcher(self._handle_batch, size=size,
+                                          delay=interval)
+
+    def add(self, host, clock, line):
+        """Add ``line`` received from ``host`` at ``clock()``."""
+        self.batcher(self.LINE_FMT % (clock(), host.encode('utf-8'), line))
+
+    def _handle_batch(self, batch):
+        """Call 'handler' with batch without last newline."""
+        self.handler(batch[:-1])
+
+    def close(self):
+        """Handle remaining lines."""
+        self.batcher.close()
+
+    @classmethod
+    def decode(cls, batch):
+        """Return list of (timestamp, host, line) from ``batch``.
+
+        >>> batch = b'10.500000;m3-1;a;b\\n10.750000;m3-2;c'
+        >>> MergedLines.decode(batch) == [(10.5, 'm3-1', b'a;b'),
+        ...                               (10.75, 'm3-2', b'c')]
+        True
+        """
+        lines = (line.split(b';', 2) for line in batch.split(b'\n'))
+        return [(float(timestamp), host.decode('utf-8'), line)
+                for timestamp, host, line in lines]
+
+
+class LineTee(object):
+    """Call ``tee`` and ``handler`` on each line.
+
+    :param handler: callback for lines
+    :param tee: other callback for lines
+    """
+
+    def __init__(self, handler, tee):
+        self.handler = handler
+        self.tee = tee
+
+    def __call__(self, line):
+        """Call 'tee' and 'handler' with ``line``."""
+        self.tee(line)
+        self.handler(line)
+
+    def close(self):
+        """Close 'handler'."""
+        common.close_handler(self.handler)
+
+
+class LineMetrics(object):  # pylint:disable=too-many-instance-attributes
+    """Aggregate numeric fields parsed from lines over time windows.
+
+    Fields aggregates are published as json ``window`` seconds after the
+    first value of the window.
+
+    :param handler: callback for lines, only called if ``lines``
+    :param publish: callback for aggregates json
+    :param parse: function returning list of (name, value) from a line,
+        from ``LineMetrics.parser``
+    :param window: aggregation window in seconds
+    :param lines: also call ``handler`` on lines
+    """
+    # 'metrics' line option values and default values
+    SPEC = {'keys': None, 'regex': None, 'window': 10, 'lines': False}
+    SPEC_ERROR = ("Invalid metrics, should be {'keys': [key, ...], "
+                  "'regex': regex_with_named_groups, 'window': seconds, "
+                  "'lines': publish_lines}")
+
+    KEY_VALUE_RE = re.compile(br'([A-Za-z_][\w.]*)='
+                              br'([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)'
+                              br'(?:[eE][-+]?[0-9]+)?)')
+    # Aggregate values list indexes
+    COUNT, MIN, MAX, SUM, LAST = range(5)
+
+    def __init__(self,  # pylint:disable=too-many-arguments
+                 handler, publish, parse, window=10, lines=False):
+        self.handler = handler
+        self.publish = publish
+        self.parse = parse
+        self.window = window
+        self.lines = lines
+
+        self.fields = {}
+        self.start = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __call__(self, line):
+        """Aggregate ``line`` fields, call 'handler' if 'lines'."""
+        values = self.parse(line)
+        if values:
+            self._add(values)
+        if self.lines:
+            self.handler(line)
+
+    def _add(self, values):
+        """Add (name, value) ``values`` to current window."""
+        with self._lock:  # pylint:disable=not-context-manager
+            for name, value in values:
+                self._add_value(name, value)
+
+            if self._timer is None:
+                self.start = time.time()
+                self._timer = threading.Timer(self.window, self.summary)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _add_value(self, name, value):
+        """Update field ``name`` aggregate with ``value``."""
+        agg = self.fields.get(name)
+        if agg is None:
+            self.fields[name] = [1, value, value, value, value]
+            return
+
+        agg[self.COUNT] += 1
+        agg[self.MIN] = min(agg[self.MIN], value)
+        agg[self.MAX] = max(agg[self.MAX], value)
+        agg[self.SUM] += value
+        agg[self.LAST] = value
+
+    def summary(self):
+        """Publish current window aggregates and start a new window."""
+        with self._lock:  # pylint:disable=not-context-manager
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            fields, self.fields = self.fields, {}
+
+        if not fields:
+            return
+
+        result = {'start': self.start, 'window': self.window, 'fields': {
+            name: {'count': agg[self.COUNT], 'min': agg[self.MIN],
+                   'max': agg[self.MAX], 'last': agg[self.LAST],
+                   'mean': self._finite(agg[self.SUM] / agg[self.COUNT])}
+            for name, agg in fields.items()}}
+        self.publish(json.dumps(result, sort_keys=True).encode('utf-8'))
+
+    def close(self):
+        """Publish remaining aggregates and close 'handler'."""
+        self.summary()
+        common.close_handler(self.handler)
+
+    @classmethod
+    def options(cls, spec):
+        """Return LineMetrics parse, window and lines options from ``spec``.
+
+        ``keys`` parses ``key=value`` fields, all keys if empty.
+        ``regex`` named groups give fields names.
 
-As newlines characters are not used in multibytes ``utf-8`` characters,
-each line remains, if it was, a valid ``utf-8`` string.
-On invalid ``utf-8`` strings sent by the node,
-the data will also be invalid in the topic.
+        >>> parse = LineMetrics.options({'keys': ['temp', 'rssi']})['parse']
+        >>> parse(b'temp=23.4 rssi=-71 lqi=255') == [('temp', 23.4),
+        ...                                           ('rssi', -71.0)]
+        True
 
+        >>> opts = LineMetrics.options({'regex': 'T:(?P<temp>[^ ]+)'})
+        >>> opts['parse'](b'T:23.4'), opts['parse'](b'T:NaN!')
+        ([('temp', 23.4)], [])
+        """
+        try:
+            opts = dict(cls.SPEC, **spec)
+            for name, value in spec.items():
+                _check_option(name, value, cls.SPEC)
+            parsers = cls._parsers(opts['keys'], opts['regex'])
+            cls._check_window(opts['window'])
+        except (AttributeError, TypeError, ValueError, re.error):
+            raise ValueError(cls.SPEC_ERROR)
+
+        def _parse(line):
+            return [value for parse in parsers for value in parse(line)]
+        return {'parse': _parse, 'window': opts['window'],
+                'lines': opts['lines']}
 
-Start redirection in *line* mode
---------------------------------
+    @staticmethod
+    def _check_window(window):
+        """Window should be greater than 0."""
+        if not window > 0:
+            raise ValueError()
 
-Start one node serial redirection in *line* mode.
+    @classmethod
+    def _parsers(cls, keys, regex):
+        """Return 'keys' and 'regex' parsers."""
+        parsers = []
+        if keys is not None:
+            parsers.append(cls._keys_parser(keys))
+        if regex is not None:
+            parsers.append(cls._regex_parser(regex))
+        if not parsers:
+            raise ValueError()
+        return parsers
 
-+-----------------------------------------------------------------------------+
-| ``line/start`` request:                                                     |
-+============+================================================================+
-| Topic:     |    |linestart|                                                 |
-+------------+-----------------------------------------+----------------------+
-|**Message** | **Topic**                               | **Payload**          |
-+------------+-----------------------------------------+----------------------+
-| Request    | |request_topic|                         | *empty*              |
-+------------+-----------------------------------------+----------------------+
-| Reply      | |reply_topic|                           | *empty* or error_msg |
-+------------+-----------------------------------------+----------------------+
+    @classmethod
+    def _keys_parser(cls, keys):
+        """Parse ``key=value`` fields for ``keys``, all if empty."""
+        if not isinstance(keys, list):
+            raise TypeError()
+        keys = set(key.encode('utf-8') for key in keys)
+
+        def _parse(line):
+            return cls._numbers((key, value) for key, value
+                                in cls.KEY_VALUE_RE.findall(line)
+                                if not keys or key in keys)
+        return _parse
 
+    @classmethod
+    def _regex_parser(cls, regex):
+        """Parse ``regex`` named groups."""
+        regex = re.compile(regex.encode('utf-8'))
+        if not regex.groupindex:
+            raise ValueError()
+
+        def _parse(line):
+            match = regex.search(line)
+            if match is None:
+                return []
+            return cls._numbers((name.encode('utf-8'), value) for name, value
+                                in match.groupdict().items()
+                                if value is not None)
+        return _parse
 
-Stop line redirection
----------------------
+    @classmethod
+    def _numbers(cls, fields):
+        """Return (name, value) for finite numeric ``fields`` values."""
+        values = []
+        for name, value in fields:
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            if cls._finite(value) is not None:
+                values.append((name.decode('utf-8'), value))
+        return values
 
-Equivalent to :ref:`stop_redirection` added here for completeness.
+    @staticmethod
+    def _finite(value):
+        """Return ``value`` if finite, else None.
 
-+-----------------------------------------------------------------------------+
-| ``line/stop`` request:                                                      |
-+============+================================================================+
-| Topic:     |    |linestop|                                                  |
-+------------+-----------------------------------------+----------------------+
-|**Message** | **Topic**                               | **Payload**          |
-+------------+-----------------------------------------+----------------------+
-| Request    | |request_topic|                         | *empty*              |
-+------------+-----------------------------------------+----------------------+
-| Reply      | |reply_topic|                           | *empty* or error_msg |
-+------------+-----------------------------------------+----------------------+
+        >>> LineMetrics._finite(1.5), LineMetrics._finite(float('inf'))
+        (1.5, None)
+        """
+        if math.isinf(value) or math.isnan(value):
+            return None
+        return value
 
 
-Line redirection
-----------------
+class LineWatcher(object):
+    """Put lines in watching ``queues`` before calling ``handler``.
 
-Serial redirection sends text lines with newline characters removed (``\n``).
+    :param handler: callback for lines
+    :param queues: list of queues, updated by watchers
+    """
 
-One message is received per line, and when sending a message, the newline
-character is automatically added.
+    def __init__(self, handler, queues):
+        self.handler = handler
+        self.queues = queues
 
-+-----------------------------------------------------------------------------+
-| **Text line serial redirection**                                            |
-+============+================================================================+
-| Topic:     |    |linechannel|                                               |
-+------------+-----------------------------------------+----------------------+
-|**Message** | **Topic**                               | **Payload**          |
-+------------+-----------------------------------------+----------------------+
-| Output     | |out_topic|                             | UTF-8 text line      |
-+------------+-----------------------------------------+----------------------+
-| Input      | |in_topic|                              | UTF-8 text line      |
-+------------+-----------------------------------------+----------------------+
+    def __call__(self, line):
+        """Put line in queues and call 'handler'."""
+        for line_queue in list(self.queues):
+            line_queue.put(line)
+        self.handler(line)
 
+    def close(self):
+        """Close 'handler'."""
+        common.close_handler(self.handler)
 
-Raw redirection topics
-======================
 
-.. Note:: RAW redirection not implemented for the moment
-"""
+class LineExpect(object):
+    """Run send/expect ``steps`` on node lines.
 
-from __future__ import (absolute_import, division, print_function,
-                        unicode_literals)
-from builtins import *  # pylint:disable=W0401,W0614,W0622
+    Lines are watched from creation, so lines received between steps are
+    matched by the next 'expect'.
 
-import threading
+    :param steps: script steps from ``LineExpect.steps``
+    :param send: function sending a line to the node
+    :param queues: node lines watching queues
+    """
+    # Step options and default values, 'expect' is a regex
+    STEP = {'send': None, 'expect': None, 'timeout': 10}
+    MAX_TIMEOUT = 300
+    STEPS_ERROR = ("Invalid script, should be a list of "
+                   "{'send': line, 'expect': regex, 'timeout': seconds}, "
+                   "timeout at most %u" % MAX_TIMEOUT)
+
+    def __init__(self, steps, send, queues):
+        self.script = steps
+        self.send = send
+        self.queues = queues
+        self.line_queue = queue.Queue()
+        self.queues.append(self.line_queue)
 
-from . import common
-from . import mqttcommon
-from . import asyncconnection
+    def run(self):
+        """Run steps until the end, a timeout or an error.
 
-PARSER = common.MQTTAgentArgumentParser()
+        Return result as a json object with each step ``send`` line, matched
+        ``line`` and ``groups`` or ``timeout``, and step ``time``.
+        """
+        results = []
+        error = None
+        try:
+            for step in self.script:
+                results.append(self._step(**step))
+                if results[-1].get('timeout'):
+                    break
+        except ValueError as err:
+            error = '%s' % err
+        finally:
+            self.queues.remove(self.line_queue)
+
+        result = {'steps': results, 'error': error}
+        return json.dumps(result, sort_keys=True).encode('utf-8')
+
+    def _step(self, send=None, expect=None, timeout=10):
+        """Run one step, return its result dict."""
+        start = time.time()
+        result = {}
+        if send is not None:
+            self.send(send.encode('utf-8'))
+            result['send'] = send
+        if expect is not None:
+            result.update(self._expect(expect, start + timeout))
+        result['time'] = time.time() - start
+        return result
+
+    def _expect(self, regex, deadline):
+        """Wait for a line matching ``regex`` until ``deadline``."""
+        while True:
+            try:
+                line = self.line_queue.get(timeout=deadline - time.time())
+            except (queue.Empty, ValueError):
+                # Negative timeout raises ValueError
+                return {'timeout': True}
+
+            match = regex.search(line)
+            if match:
+                groups = [self._decode(group) for group in match.groups()]
+                return {'line': self._decode(line), 'groups': groups}
 
+    @staticmethod
+    def _decode(line):
+        """Decode ``line`` for json result."""
+        return None if line is None else line.decode('utf-8', 'replace')
 
-class LineHandler(object):  # pylint:disable=too-few-public-methods
-    """Line data handler."""
-    def __init__(self, handler):
-        self.data = b''
-        self.handler = handler
+    @classmethod
+    def steps(cls, payload):
+        """Return script steps from json ``payload``, 'expect' compiled.
 
-    def __call__(self, data):
-        """Call 'handler' on received data line by line."""
+        >>> steps = LineExpect.steps(b'[{"send": "help"}, {"expect": ">"}]')
+        >>> [sorted(step) for step in steps]
+        [['send'], ['expect']]
+        """
+        try:
+            steps = json.loads(payload.decode('utf-8'))
+            if not isinstance(steps, list):
+                raise TypeError()
+            return [cls._step_options(step) for step in steps]
+        except (TypeError, AttributeError, re.error, ValueError):
+            raise ValueError(cls.STEPS_ERROR)
 
-        # 'newline' byte never appear in multibyte unicode char
-        # so it can be split without decoding
-        self.data += data
-        lines = self.data.splitlines(True)
+    @classmethod
+    def _step_options(cls, step):
+        """Check ``step`` options and compile 'expect' regex."""
+        for name, value in step.items():
+            _check_option(name, value, cls.STEP)
+        if not isinstance(step.get('send', ''), str):
+            raise TypeError()
+        if step.get('timeout', 0) > cls.MAX_TIMEOUT:
+            raise ValueError()
+        if 'expect' in step:
+            step['expect'] = re.compile(step['expect'].encode('utf-8'))
+        return step
+
+
+class PacedWriter(object):
+    """Send queued lines one at a time in a thread.
+
+    After each line, wait its transmission time at ``rate`` bytes per second
+    and ``delay`` seconds, to not overrun the node UART buffer.
+    Once ``close`` returned, only a line already being sent can still be sent.
+
+    ``send`` is called without holding the writer lock, it may close the
+    writer. On ``send`` failure, the error is reported to ``error_cb`` and
+    the writer is closed.
+
+    :param send: function sending data to the node
+    :param rate: bytes per second, 0 for no limit
+    :param delay: delay in seconds between lines
+    :param error_cb: callback for send errors
+    :type error_cb: Callable[[str], None]
+    """
 
-        for full_line in lines:
-            # strip newline using splitlines
-            line = full_line.splitlines()[0]
+    def __init__(self, send, rate=0, delay=0, error_cb=None):
+        self.send = send
+        self.rate = rate
+        self.delay = delay
+        self.error_cb = error_cb
 
-            # last incomplete line
-            if line == full_line:
-                self.data = line
+        self.queue = queue.Queue()
+        self.closed = threading.Event()
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._thr_write)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start writer thread."""
+        self.thread.start()
+
+    def write(self, line):
+        """Queue ``line`` to be sent."""
+        self.queue.put(line)
+
+    def depth(self):
+        """Number of queued lines."""
+        return self.queue.qsize()
+
+    def _thr_write(self):
+        """Send queued lines until 'None', closed or send error."""
+        for line in iter(self.queue.get, None):
+            with self._lock:  # pylint:disable=not-context-manager
+                if self.closed.is_set():
+                    return
+            if not self._send(line):
                 return
+            duration = len(line) / self.rate if self.rate else 0
+            self.closed.wait(duration + self.delay)
 
-            self.handler(line)
+    def _send(self, line):
+        """Send ``line``, on error report it and close writer."""
+        try:
+            self.send(line)
+            return True
+        except Exception:  # pylint:disable=broad-except
+            error = common.traceback_error()
+            self.close()
+            if self.error_cb is not None:
+                self.error_cb(error)
+            return False
 
-        self.data = b''
+    def close(self):
+        """Drop queued lines and stop thread.
+
+        Does not wait for the thread, it may be blocked in ``send`` by the
+        caller.
+        """
+        with self._lock:  # pylint:disable=not-context-manager
+            self.closed.set()
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put(None)
 
 
 class SerialConnection(asyncconnection.NodeConnection):
@@ -275,20 +1498,40 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
     :type closed_cb: Callable[[Node], None]
     :param error_cb: callback for asynchronous errors
     :type error_cb: Callable[[Node, str], None]
+    :param capture: node lines capture, records lines from the connection
+        in 'line' and 'capture' modes
     """
 
-    STATES = ('closed', 'linestarting', 'line')
+    STATES = ('closed', 'linestarting', 'line', 'rawstarting', 'raw',
+              'capturestarting', 'capture')
+    # Starting state to started mode
+    STARTING = {'linestarting': 'line', 'rawstarting': 'raw',
+                'capturestarting': 'capture'}
+    # Concurrent expect scripts
+    MAX_EXPECTS = 4
 
     def __init__(self, archi, num,  # pylint:disable=too-many-arguments
-                 closed_cb, error_cb, asyncoreservice=None):
+                 closed_cb, error_cb, asyncoreservice=None, capture=None):
         self.host = self.hostname(archi, num)
         self.closed_cb = closed_cb
         self.error_cb = error_cb
 
         self.state = 'closed'
         self.reply_publisher = None
+        self.stats = {}
+        # Queues watching node lines
+        self.line_queues = []
+        self.expects = 0
+        # Paced line input writer
+        self.writer = None
         self.connection = SerialConnection(archi, num, self.conn_event_handler,
                                            service=asyncoreservice)
+        # Lines recorder, 'line' mode keeps the connection when capturing
+        self.recorder = None
+        self.capturing = False
+        if capture is not None:
+            self.recorder = serialcapture.LineRecorder(None, capture,
+                                                       self.recv_time)
 
         # Required Rlock, connection socket errors calls event_handler('close')
         self._rlock = threading.RLock()
@@ -332,12 +1575,30 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
     def _close(self):
         """Set 'closed' state, resets data_handler and call ``closed_cb``."""
         previous_state = self.state
+        self._close_writer()
         self.connection.close()
-        self.connection.data_handler = None
+        self._close_data_handler()
+        self.capturing = False
         self.state = 'closed'
         self.closed_cb(self)
         return previous_state
 
+    def recv_time(self):
+        """Current line receive time."""
+        return self.connection.recv_time
+
+    def _close_data_handler(self):
+        """Remove connection data_handler and close it if supported."""
+        handler = self.connection.data_handler
+        self.connection.data_handler = None
+        common.close_handler(handler)
+
+    def _close_writer(self):
+        """Stop paced writer if any."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
     @common.synchronized('_rlock')
     def conn_event_handler(self, event):
         """Handler for connection events."""
@@ -349,8 +1610,8 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
         return event_handler[event]()
 
     def _event_connect(self):
-        if self.state == 'linestarting':
-            self._reply_request('', newstate='line')
+        if self.state in self.STARTING:
+            self._reply_request('', newstate=self.STARTING[self.state])
             return
 
         raise Exception('Got connect event in invalid state %s' % self.state)
@@ -360,7 +1621,7 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
         error = common.traceback_error()
         previous_state = self._close()
 
-        if previous_state == 'linestarting':
+        if previous_state in self.STARTING:
             self._reply_request('Connection failed: %s' % error)
             return
 
@@ -371,19 +1632,107 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
         raise Exception('Connection closed in state %s' % self.state)
 
     @common.synchronized('_rlock')
-    def req_linestart(self, reply_publisher, line_handler):
-        """Request to start line."""
+    def req_linestart(self, reply_publisher, line_handler, rate=0, delay=0):
+        """Request to start line.
+
+        ``line_handler`` returns the lines handler, it is only called if
+        the start is accepted.
+        With ``rate`` bytes per second or ``delay`` between lines,
+        line input is paced.
+        In 'capture' mode, lines are published without reconnecting.
+        """
+        writer = None
+        if rate or delay:
+            writer = PacedWriter(self.connection.send, rate, delay,
+                                 self._writer_error)
+        if self.state == 'capture':
+            return self._capture_linestart(line_handler, writer)
+
+        data_handler = functools.partial(self._line_data_handler,
+                                         line_handler)
+        return self._req_start('line', reply_publisher, data_handler, writer)
+
+    def _writer_error(self, error):
+        """Report paced line input failure."""
+        self.error_cb(self, 'Line input failed: %s' % error)
+
+    def _capture_linestart(self, line_handler, writer):
+        """Start 'line' mode on the already recording connection."""
+        self.recorder.handler = line_handler()
+        self.writer = writer
+        if writer is not None:
+            writer.start()
+        self.state = 'line'
+        return b''
+
+    def _line_data_handler(self, line_handler=None):
+        """Return data handler calling ``line_handler()`` on lines.
+
+        With capture, lines are recorded first.
+        """
+        handler = None if line_handler is None else line_handler()
+        if self.recorder is None:
+            return LineHandler(handler)
+        self.recorder.handler = handler
+        return LineHandler(self.recorder)
+
+    @common.synchronized('_rlock')
+    def req_capture(self, reply_publisher):
+        """Request to record node lines, keeping the connection.
+
+        Started 'line' mode goes back to 'capture' on 'line' stop.
+        """
+        if self.recorder is None:
+            return b'Error: lines capture disabled'
+        if self.state in ('line', 'capture'):
+            self.capturing = True
+            return b''
+
+        ret = self._req_start('capture', reply_publisher,
+                              self._line_data_handler)
+        self.capturing = ret is None
+        return ret
+
+    @common.synchronized('_rlock')
+    def req_linestop(self):
+        """Request to stop line, go back to 'capture' if capturing."""
+        if not (self.capturing and self.state == 'line'):
+            return self.close()
+
+        self._close_writer()
+        handler, self.recorder.handler = self.recorder.handler, None
+        common.close_handler(handler)
+        self.state = 'capture'
+        return b''
+
+    def req_rawstart(self, reply_publisher, raw_handler):
+        """Request to start raw.
+
+        ``raw_handler`` returns the data handler, like for 'line'.
+        """
+        return self._req_start('raw', reply_publisher, raw_handler)
+
+    @common.synchronized('_rlock')
+    def _req_start(self, mode, reply_publisher, data_handler, writer=None):
+        """Request to start ``mode`` with ``data_handler()`` and ``writer``.
+
+        Handler is created once the request is accepted, so a refused or
+        already done start keeps current handler and counters.
+        """
 
-        if self.state == 'line':
+        if self.state == mode:
             return b''
 
         if self.state != 'closed':
-            err = "Error: 'linestart' in mode %s. Wait or stop it first"
-            return (err % self.state).encode('utf-8')
+            err = "Error: '%sstart' in mode %s. Wait or stop it first"
+            return (err % (mode, self.state)).encode('utf-8')
 
-        # Start line mode and register 'line_handler'
-        self.state = 'linestarting'
-        self.connection.data_handler = line_handler
+        # Start mode and register 'data_handler'
+        self.state = mode + 'starting'
+        self.connection.data_handler = data_handler()
+        self.writer = writer
+        if writer is not None:
+            writer.start()
 
         # Async answer
         self.reply_publisher = reply_publisher
@@ -391,13 +1740,65 @@ class Node(object):  # pylint:disable=too-many-instance-attributes
         return None
 
     @common.synchronized('_rlock')
-    def lineinput(self, payload):
-        """Send ``payload`` with a newline to the node connection."""
+    def req_expect(self, reply_publisher, steps):
+        """Request to run expect script ``steps`` in a thread.
+
+        Reply is sent at the script end.
+        """
         if self.state != 'line':
-            raise ValueError("lineinput while not in 'line' mode")
+            return b"Error: 'expect' while not in 'line' mode"
+        if self.expects >= self.MAX_EXPECTS:
+            err = "Error: already %u 'expect' running" % self.MAX_EXPECTS
+            return err.encode('utf-8')
+
+        expect = LineExpect(steps, self.lineinput, self.line_queues)
+        self.expects += 1
+        thread = threading.Thread(target=self._thr_expect,
+                                  args=(expect, reply_publisher))
+        thread.daemon = True
+        thread.start()
+        return None
+
+    def _thr_expect(self, expect, reply_publisher):
+        """Run ``expect`` and reply its result."""
+        try:
+            reply_publisher(expect.run())
+        finally:
+            with self._rlock:
+                self.expects -= 1
+
+    @common.synchronized('_rlock')
+    def req_stats(self):
+        """Return node state and handlers counters as json."""
+        stats = dict(self.stats, state=self.state)
+        if self.writer is not None:
+            stats['input_queue'] = self.writer.depth()
+        return json.dumps(stats, sort_keys=True).encode('utf-8')
+
+    @common.synchronized('_rlock')
+    def lineinput(self, payload):
+        """Send ``payload`` with a newline to the node connection.
+
+        With paced input, ``payload`` lines are queued to be sent one by one.
+        """
+        if self.writer is None or self.state != 'line':
+            self._input('line', payload + b'\n')
+            return
+
+        for line in payload.splitlines() or [b'']:
+            self.writer.write(line + b'\n')
 
-        line = payload + b'\n'
-        self.connection.send(line)
+    def rawinput(self, payload):
+        """Send ``payload`` unchanged to the node connection."""
+        self._input('raw', payload)
+
+    @common.synchronized('_rlock')
+    def _input(self, mode, data):
+        """Send ``data`` to the node connection if in ``mode``."""
+        if self.state != mode:
+            raise ValueError("%sinput while not in '%s' mode" % (mode, mode))
+
+        self.connection.send(data)
 
 
 class MQTTAggregator(object):
@@ -407,17 +1808,50 @@ class MQTTAggregator(object):
     TOPICS = {
         'node': '{archi}/{num}',
         'line': '{archi}/{num}/line',
+        'raw': '{archi}/{num}/raw',
+        'replay': '{archi}/{num}/line/replay',
+        'metrics': '{archi}/{num}/line/metrics',
+        'merged': 'line',
     }
 
     HOSTNAME = common.hostname()
 
-    def __init__(self, client, prefix=''):
+    # Group input 'num' for all nodes
+    ALL_NODES = 'all'
+
+    # 'line/ctl/start' options and default values
+    LINE_OPTIONS = {'filter': None, 'ratelimit': None, 'metrics': None,
+                    'pace': None}
+    # 'ratelimit' line option values, per second
+    RATELIMIT_OPTIONS = {'lines': 0, 'bytes': 0}
+    # 'pace' line option values, bytes per second and seconds between lines
+    PACE_OPTIONS = {'rate': 0, 'delay': 0}
+    # 'raw/ctl/start' options and default values
+    RAW_OPTIONS = {'size': 0, 'delay': 0}
+    # Raw batches delay when only 'size' is given
+    RAW_DEFAULT_DELAY = 1.0
+    # 'line/ctl/replay' options and default values
+    REPLAY_OPTIONS = {'start': 0, 'end': 0, 'rate': 0}
+    # Concurrent replays
+    MAX_REPLAYS = 4
+
+    def __init__(self, client,  # pylint:disable=too-many-arguments
+                 prefix='', envelope=False, capture=None,
+                 ratelimit=None, agent_ratelimit=None, merged=None,
+                 pace=None):
         super().__init__()
 
         staticfmt = {'site': self.HOSTNAME}
         _topics = mqttcommon.generate_topics_dict(self.TOPICS, prefix,
                                                   self.AGENTTOPIC, staticfmt)
 
+        self.envelope = envelope
+        self.capture = capture
+        self.replays = threading.Semaphore(self.MAX_REPLAYS)
+        self.ratelimit = dict(self.RATELIMIT_OPTIONS, **(ratelimit or {}))
+        self.pace = dict(self.PACE_OPTIONS, **(pace or {}))
+        # Agent limits shared by all nodes, handlers run in asyncore thread
+        self.agent_limits = LineRateLimiter.limits(**(agent_ratelimit or {}))
         self.nodes = {}
         self.asyncore = asyncconnection.AsyncoreService()
 
@@ -428,13 +1862,38 @@ class MQTTAggregator(object):
             'linestart': mqttcommon.RequestServer(
                 _topics['line'], 'start', callback=self.cb_linestart),
             'linestop': mqttcommon.RequestServer(
-                _topics['line'], 'stop', callback=self.cb_stop),
+                _topics['line'], 'stop', callback=self.cb_linestop),
+            'linecapture': mqttcommon.RequestServer(
+                _topics['line'], 'capture', callback=self.cb_linecapture),
+            'lineexpect': mqttcommon.RequestServer(
+                _topics['line'], 'expect', callback=self.cb_lineexpect),
+            'linereplay': mqttcommon.RequestServer(
+                _topics['line'], 'replay', callback=self.cb_linereplay),
+            'replay': mqttcommon.OutputChannelServer(_topics['replay']),
+            'metrics': mqttcommon.OutputChannelServer(_topics['metrics']),
+
+            'raw': mqttcommon.ChannelServer(_topics['raw'],
+                                            callback=self.cb_rawinput),
+            'rawstart': mqttcommon.RequestServer(
+                _topics['raw'], 'start', callback=self.cb_rawstart),
+            'rawstop': mqttcommon.RequestServer(
+                _topics['raw'], 'stop', callback=self.cb_stop),
 
             'stop': mqttcommon.RequestServer(
                 _topics['node'], 'stop', callback=self.cb_stop),
+            'stats': mqttcommon.RequestServer(
+                _topics['node'], 'stats', callback=self.cb_stats),
 
             'stopall': mqttcommon.RequestServer(
                 _topics['agenttopic'], 'stopall', callback=self.cb_stopall),
+            'bulklinestart': mqttcommon.RequestServer(
+                _topics['agenttopic'], 'linestart',
+                callback=self.cb_bulklinestart),
+            'bulklinestop': mqttcommon.RequestServer(
+                _topics['agenttopic'], 'linestop',
+                callback=self.cb_bulklinestop),
+
+            'merged': mqttcommon.OutputChannelServer(_topics['merged']),
 
             'error': mqttcommon.ErrorServer(_topics['agenttopic']),
         }
@@ -442,6 +1901,11 @@ class MQTTAggregator(object):
         self.client = client
         self.client.topics = list(self.topics.values())
 
+        self.merged = None
+        if merged is not None:
+            publisher = self.topics['merged'].output_publisher(self.client)
+            self.merged = MergedLines(publisher, **merged)
+
     def error(self, topic, message):
         """Publish error that happend on topic."""
         self.topics['error'].publish_error(self.client, topic,
@@ -453,39 +1917,361 @@ class MQTTAggregator(object):
         self.error(topic, message)
 
     def cb_lineinput(self, message, archi, num):
-        """Write message to node."""
-        host = Node.hostname(archi, num)
+        """Write message to node.
+
+        ``num`` can also be 'all' or a nodeset to write to multiple nodes.
+        """
+        if self._is_group(num):
+            self._group_lineinput(message, archi, num)
+        else:
+            self._node_input(message, archi, num, 'line')
+
+    def cb_rawinput(self, message, archi, num):
+        """Write message to node without adding newline."""
+        self._node_input(message, archi, num, 'raw')
+
+    def _node_input(self, message, archi, num, mode):
+        """Write message to node in ``mode``."""
+        error = self._node_input_error(message.payload, archi, num, mode)
+        if error:
+            self.error(message.topic, error)
+
+    def _node_input_error(self, payload, archi, num, mode):
+        """Write ``payload`` to node in ``mode``, return error message."""
         try:
-            self.nodes[host].lineinput(message.payload)
+            node = self.nodes[Node.hostname(archi, num)]
         except KeyError:
-            self.error(message.topic, 'Non connected node {}'.format(
-                Node.host_str(archi, num)))
+            return 'Non connected node {}'.format(Node.host_str(archi, num))
+
+        try:
+            getattr(node, mode + 'input')(payload)
+        except ValueError as err:
+            return '%s' % err
+        return None
+
+    @classmethod
+    def _is_group(cls, num):
+        """Return if ``num`` is a nodes group, 'all' or a nodeset."""
+        return num == cls.ALL_NODES or any(c in num for c in ',-')
+
+    def _group_lineinput(self, message, archi, num):
+        """Write message to group nodes in 'line' mode.
+
+        Errors are published as a json object with nodes errors.
+        """
+        try:
+            nums = self._group_nums(archi, num)
+        except ValueError as err:
+            self.error(message.topic, '%s' % err)
+            return
+
+        errors = {n: self._node_input_error(message.payload, archi, n, 'line')
+                  for n in nums}
+        errors = {n: error for n, error in errors.items() if error}
+        if errors:
+            self.error(message.topic, json.dumps(errors, sort_keys=True))
+
+    def _group_nums(self, archi, num):
+        """Return group nodes nums, 'all' selects nodes in 'line' mode."""
+        if num != self.ALL_NODES:
+            return [str(n) for n in common.expand_nodeset(num)]
+
+        return [n for (a, n), node in list(self.nodes.items())
+                if a == archi and node.state == 'line']
+
+    def _node(self, archi, num):
+        """Return node for ``archi``, ``num``.
+
+        Create a new node if it does not currently exists.
+        """
+        host = Node.hostname(archi, num)
+        if host in self.nodes:
+            return self.nodes[host]
+
+        capture = None
+        if self.capture is not None:
+            capture = self.capture.node(archi, num)
+        new_node = Node(archi, num, self._node_closed_cb, self._node_error,
+                        asyncoreservice=self.asyncore, capture=capture)
+        return self.nodes.setdefault(host, new_node)
 
     def cb_linestart(self, message, archi, num):
         """Start node redirection in 'line' mode.
 
         Create a new node if it does not currently exists.
         """
-        new_node = Node(archi, num, self._node_closed_cb, self._node_error,
-                        asyncoreservice=self.asyncore)
-        node = self.nodes.setdefault(Node.hostname(archi, num), new_node)
+        try:
+            opts = self._line_options(message.payload)
+        except ValueError as err:
+            return str(err).encode('utf-8')
+
+        node = self._node(archi, num)
+        return self._req_linestart(node, message.reply_publisher, opts)
+
+    def cb_bulklinestart(self, message):
+        """Start nodes redirection in 'line' mode.
+
+        Payload is 'ARCHI NODESET' optionally followed by json options.
+        Reply is sent when all nodes have replied.
+        """
+        try:
+            archi, nums, payload = self._bulk_payload(message.payload)
+            opts = self._line_options(payload)
+        except (UnicodeError, ValueError) as err:
+            return str(err).encode('utf-8')
+
+        bulk_reply = common.BulkReply(message.reply_publisher, nums)
+        for num in nums:
+            node = self._node(archi, str(num))
+            reply_publisher = bulk_reply.publisher(num)
+            ret = self._req_linestart(node, reply_publisher, opts)
+            if ret is not None:
+                reply_publisher(ret)
+        return None
 
-        line_handler = self._line_handler(archi, num)
-        return node.req_linestart(message.reply_publisher, line_handler)
+    def _req_linestart(self, node, reply_publisher, opts):
+        """Request ``node`` line start with line start ``opts``."""
+        opts = dict(opts)
+        pace = opts.pop('pace')
+        line_handler = functools.partial(self._line_handler, node, **opts)
+        return node.req_linestart(reply_publisher, line_handler, **pace)
 
-    def _line_handler(self, archi, num):
-        """Line handler for node ``archi``, ``num``.
+    def cb_bulklinestop(self, message):
+        """Stop nodes redirection.
 
-        Publish the message to the correct topic for ``archi``, ``num``.
+        Payload is 'ARCHI NODESET'.
         """
+        try:
+            archi, nums, _ = self._bulk_payload(message.payload)
+        except (UnicodeError, ValueError) as err:
+            return str(err).encode('utf-8')
+
+        result = {str(num): self.cb_linestop(message, archi, str(num))
+                  for num in nums}
+        result = {num: ret.decode('utf-8') for num, ret in result.items()}
+        return json.dumps(result, sort_keys=True).encode('utf-8')
+
+    @staticmethod
+    def _bulk_payload(payload):
+        """Return archi, nums and remaining payload from bulk ``payload``."""
+        parts = payload.decode('utf-8').split(None, 2)
+        archi, nums = common.nodes_from_str(' '.join(parts[:2]))
+        remaining = parts[2] if len(parts) > 2 else ''
+        return archi, nums, remaining.encode('utf-8')
+
+    def _line_options(self, payload):
+        """Return 'line/ctl/start' options from ``payload``.
+
+        Filter specification is converted to a match function.
+        Rate limit and pace values default to the agent configured ones.
+        """
+        opts = options_from_payload(payload, self.LINE_OPTIONS)
+        if opts['filter'] is not None:
+            opts['filter'] = LineFilter.matcher(opts['filter'])
+        if opts['metrics'] is not None:
+            opts['metrics'] = LineMetrics.options(opts['metrics'])
+        opts['ratelimit'] = self._ratelimit_option(opts['ratelimit'])
+        opts['pace'] = _dict_option(
+            opts['pace'], self.pace,
+            "Invalid pace, should be "
+            "{'rate': bytes_per_s, 'delay': line_delay_s}")
+        return opts
+
+    def _ratelimit_option(self, value):
+        """Return 'ratelimit' option ``value`` within agent node limits.
+
+        Agent limits are the default and maximum values.
+        """
+        ratelimit = _dict_option(
+            value, self.ratelimit,
+            "Invalid ratelimit, should be "
+            "{'lines': lines_per_s, 'bytes': bytes_per_s}")
+
+        for name, limit in self.ratelimit.items():
+            if not limit:
+                continue
+            if not ratelimit[name]:
+                raise ValueError("Invalid ratelimit, '%s' is limited to %g "
+                                 "by the agent" % (name, limit))
+            ratelimit[name] = min(ratelimit[name], limit)
+        return ratelimit
+
+    def cb_rawstart(self, message, archi, num):
+        """Start node redirection in 'raw' mode.
+
+        Create a new node if it does not currently exists.
+        """
+        try:
+            opts = options_from_payload(message.payload, self.RAW_OPTIONS)
+        except ValueError as err:
+            return str(err).encode('utf-8')
+
+        node = self._node(archi, num)
+
+        raw_handler = functools.partial(self._raw_handler, archi, num, **opts)
+        return node.req_rawstart(message.reply_publisher, raw_handler)
+
+    def _line_handler(self, node, filter=None,  # pylint:disable=W0622
+                      ratelimit=None, metrics=None):
+        """Line handler for ``node``.
+
+        Publish the message to the correct topic for node ``archi``, ``num``.
+        With ``filter``, only publish matching lines.
+        With ``metrics``, publish fields aggregates, and lines if configured.
+        With capture enabled, the node records all lines before filtering.
+        Lines are numbered before filtering for the envelope.
+        """
+        archi, num = node.host
+        clock = node.recv_time
+        counter = LineCounter()
+
+        handler = self._line_output(node, clock, counter, ratelimit or {})
+        if metrics is not None:
+            channel = self.topics['metrics']
+            publish = channel.output_publisher(self.client,
+                                               archi=archi, num=num)
+            handler = LineMetrics(handler, publish, **metrics)
+        if filter is not None:
+            handler = LineFilter(handler, filter, node.stats)
+        counter.handler = LineWatcher(handler, node.line_queues)
+        return counter
+
+    def _line_output(self, node, clock, counter, ratelimit):
+        """Lines publisher for ``node``.
+
+        In envelope mode, lines are prefixed with receive time and
+        ``counter`` seqno.
+        Published lines are limited by node ``ratelimit`` and agent limits.
+        With merged output enabled, lines are also added to merged batches.
+        """
+        archi, num = node.host
         channel = self.topics['line']
+        handler = channel.output_publisher(self.client, archi=archi, num=num)
+        if self.envelope:
+            handler = LineEnvelope(handler, clock, counter)
+        handler = self._merged(handler, node, clock)
+        return self._ratelimited(handler, node, **ratelimit)
+
+    def _merged(self, handler, node, clock):
+        """Also add ``handler`` lines to merged output if enabled."""
+        if self.merged is None:
+            return handler
+
+        tee = functools.partial(self.merged.add, Node.host_str(*node.host),
+                                clock)
+        return LineTee(handler, tee)
+
+    def _ratelimited(self, handler, node, **ratelimit):
+        """Limit ``handler`` lines with node ``ratelimit`` and agent limits.
+
+        Dropped lines summaries are published on the error topic.
+        """
+        limits = LineRateLimiter.limits(**ratelimit) + self.agent_limits
+        if not limits:
+            return handler
+
+        notify = functools.partial(self._node_error, node)
+        return LineRateLimiter(handler, limits, notify, node.stats)
+
+    def _raw_handler(self, archi, num, size=0, delay=0):
+        """Raw handler for node ``archi``, ``num``.
+
+        Publish received data, batched by ``size`` and ``delay``.
+        With only ``size``, ``RAW_DEFAULT_DELAY`` is used.
+        """
+        if size and not delay:
+            delay = self.RAW_DEFAULT_DELAY
+        channel = self.topics['raw']
+        publisher = channel.output_publisher(self.client, archi=archi, num=num)
+        return common.DataBatcher(publisher, size=size, delay=delay)
+
+    def cb_lineexpect(self, message, archi, num):
+        """Run expect script on node in 'line' mode."""
+        try:
+            steps = LineExpect.steps(message.payload)
+            node = self.nodes[Node.hostname(archi, num)]
+        except ValueError as err:
+            return str(err).encode('utf-8')
+        except KeyError:
+            err = 'Non connected node {}'.format(Node.host_str(archi, num))
+            return err.encode('utf-8')
+
+        return node.req_expect(message.reply_publisher, steps)
+
+    def cb_linecapture(self, message, archi, num):
+        """Record node lines from the connection without publishing them.
+
+        Create a new node if it does not currently exists.
+        """
+        if self.capture is None:
+            return b'Error: lines capture disabled, no --capture-dir'
+        return self._node(archi, num).req_capture(message.reply_publisher)
+
+    def cb_linereplay(self, message, archi, num):
+        """Replay node captured lines in a thread.
+
+        Lines are published enveloped on 'line/replay' channel,
+        an empty message marks the replay end.
+        """
+        if self.capture is None:
+            return b'Error: lines capture disabled, no --capture-dir'
+
+        try:
+            opts = options_from_payload(message.payload, self.REPLAY_OPTIONS)
+        except ValueError as err:
+            return str(err).encode('utf-8')
+
+        capture = self.capture.find(archi, num)
+        if capture is None:
+            return b'Error: no captured lines for node'
+        return self._start_replay(capture, archi, num, opts)
+
+    def _start_replay(self, capture, archi, num, opts):
+        """Start ``capture`` replay thread if under replays limit."""
+        if not self.replays.acquire(False):
+            err = 'Error: already %u replays running' % self.MAX_REPLAYS
+            return err.encode('utf-8')
+
+        records = capture.records(opts['start'], opts['end'] or None)
+        channel = self.topics['replay']
         publisher = channel.output_publisher(self.client, archi=archi, num=num)
-        return LineHandler(publisher)
+
+        topic = self.topics['node'].topic.format(archi=archi, num=num)
+
+        thread = threading.Thread(target=self._replay,
+                                  args=(publisher, records, opts['rate'],
+                                        topic))
+        thread.daemon = True
+        thread.start()
+        return b''
+
+    def _replay(self, publisher, records, rate, topic):
+        """Publish enveloped ``records`` then an empty end message.
+
+        Errors are published on error topic, the end message is still sent.
+        """
+        def _publish(timestamp, seqno, line):
+            publisher(LineEnvelope.encode(timestamp, seqno, line))
+
+        try:
+            serialcapture.replay(records, _publish, rate)
+        except Exception:  # pylint:disable=broad-except
+            self.error(topic, 'Replay failed: %s' % common.traceback_error())
+        finally:
+            self.replays.release()
+        publisher(b'')
 
     def _node_closed_cb(self, node):
         """Remove closed node."""
         self.nodes.pop(node.host, None)
 
+    def cb_linestop(self, message, archi, num):
+        """Stop node 'line' redirection, capturing node keeps recording."""
+        try:
+            return self.nodes[Node.hostname(archi, num)].req_linestop()
+        except KeyError:
+            return b''
+
     def cb_stop(self, message, archi, num):
         """Stop node redirection."""
         try:
@@ -493,6 +2279,14 @@ class MQTTAggregator(object):
         except KeyError:
             return b''
 
+    def cb_stats(self, message, archi, num):
+        """Return node statistics."""
+        try:
+            return self.nodes[Node.hostname(archi, num)].req_stats()
+        except KeyError:
+            err = 'Non connected node {}'.format(Node.host_str(archi, num))
+            return err.encode('utf-8')
+
     def cb_stopall(self, message):
         """Stop nodes redirection."""
         self._stop_all_nodes()
@@ -512,12 +2306,18 @@ class MQTTAggregator(object):
         """Start Agent."""
         self.asyncore.start()
         self.client.start()
+        if self.capture is not None:
+            self.capture.start()
 
     def stop(self):
         """Stop agent."""
         self.client.stop()
         self._stop_all_nodes()
         self.asyncore.stop()
+        if self.capture is not None:
+            self.capture.close()
+        if self.merged is not None:
+            self.merged.close()
 
     def _stop_all_nodes(self):
         """Close all nodes connections."""
@@ -525,10 +2325,44 @@ class MQTTAggregator(object):
             node.close()
 
     @classmethod
-    def from_opts_dict(cls, prefix, **kwargs):
+    def from_opts_dict(cls, prefix,  # pylint:disable=too-many-arguments
+                       line_envelope=False, capture_dir=None,
+                       capture_segment_size=1 << 22, capture_max_size=0,
+                       capture_max_age=0, **kwargs):
         """Create class from argparse entries."""
         client = mqttcommon.MQTTClient.from_opts_dict(**kwargs)
-        return cls(client, prefix)
+        capture = None
+        if capture_dir is not None:
+            capture = serialcapture.LineCapture(
+                capture_dir, capture_segment_size,
+                capture_max_size, capture_max_age)
+        ratelimit, agent_ratelimit = cls._ratelimits_from_opts(**kwargs)
+        return cls(client, prefix, envelope=line_envelope, capture=capture,
+                   ratelimit=ratelimit, agent_ratelimit=agent_ratelimit,
+                   merged=cls._merged_from_opts(**kwargs),
+                   pace=cls._pace_from_opts(**kwargs))
+
+    @staticmethod
+    def _pace_from_opts(input_rate=0, input_line_delay=0, **_):
+        """Return line input pace from argparse entries."""
+        return {'rate': input_rate, 'delay': input_line_delay}
+
+    @staticmethod
+    def _merged_from_opts(merged_interval=0, merged_size=0, **_):
+        """Return merged output options from argparse entries."""
+        if not merged_interval:
+            return None
+        return {'interval': merged_interval, 'size': merged_size}
+
+    @staticmethod
+    def _ratelimits_from_opts(rate_limit_lines=0, rate_limit_bytes=0,
+                              agent_rate_limit_lines=0,
+                              agent_rate_limit_bytes=0, **_):
+        """Return node and agent rate limits from argparse entries."""
+        ratelimit = {'lines': rate_limit_lines, 'bytes': rate_limit_bytes}
+        agent_ratelimit = {'lines': agent_rate_limit_lines,
+                           'bytes': agent_rate_limit_bytes}
+        return ratelimit, agent_ratelimit
 
 
 def main():
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+"""Serial lines capture to rolling segment files.
+
+Each node lines are recorded in its own directory as segment files.
+
+Segment file ``{first_time_us}.seg`` contains records as network endian: ::
+
+   :8 bytes: Receive time, seconds since epoch as a double
+   :4 bytes: Sequence number
+   :4 bytes: Line length
+   :N bytes: Line
+
+And its time index ``{first_time_us}.idx`` one entry every ``INDEX_INTERVAL``
+seconds of records: ::
+
+   :8 bytes: Record time
+   :8 bytes: Record offset in segment file
+
+A new segment is started when the current one reaches ``segment_size``.
+Oldest segments are then removed when the node capture is bigger than
+``max_size`` or when all their records are older than ``max_age``.
+Too old segments are also removed every ``EVICT_INTERVAL`` seconds, also
+for nodes not sending lines anymore.
+
+Captured lines can then be replayed, with their original receive time and
+sequence number, for a time range.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+import os
+import time
+import mmap
+import bisect
+import struct
+import threading
+
+from . import common
+
+
+class NodeCapture(object):  # pylint:disable=too-many-instance-attributes
+    """Record one node lines to rolling segment files.
+
+    :param directory: node capture directory
+    :param segment_size: segment size in bytes before starting a new one
+    :param max_size: node capture maximum size in bytes, 0 to disable
+    :param max_age: records maximum age in seconds, 0 to disable
+    """
+    RECORD = struct.Struct(b'!dLL')
+    INDEX = struct.Struct(b'!dQ')
+    INDEX_INTERVAL = 1.0
+
+    SEGMENT_EXT = '.seg'
+    INDEX_EXT = '.idx'
+
+    def __init__(self, directory, segment_size, max_size=0, max_age=0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self._segment = None
+        self._index = None
+        self._path = None
+        self._next_index = 0
+        # Last record time
+        self._last = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @common.synchronized('_lock')
+    def record(self, timestamp, seqno, line):
+        """Record ``line`` received at ``timestamp`` with ``seqno``."""
+        if self._segment is None or self._segment.tell() >= self.segment_size:
+            self._roll(timestamp)
+
+        if timestamp >= self._next_index:
+            offset = self._segment.tell()
+            self._index.write(self.INDEX.pack(timestamp, offset))
+            self._next_index = timestamp + self.INDEX_INTERVAL
+
+        self._segment.write(self.RECORD.pack(timestamp, seqno, len(line)))
+        self._segment.write(line)
+        self._last = timestamp
+
+    def _roll(self, timestamp):
+        """Evict old segments and start a new one at ``timestamp``."""
+        self._close()
+        self._evict(time.time())
+
+        path = os.path.join(self.directory, '%020d' % (timestamp * 1e6))
+        self._segment = open(path + self.SEGMENT_EXT, 'ab')
+        self._index = open(path + self.INDEX_EXT, 'ab')
+        self._path = path
+        self._next_index = 0
+
+    @common.synchronized('_lock')
+    def evict(self):
+        """Remove segments over limits, even without new records."""
+        self._evict(time.time())
+
+    def _evict(self, now):
+        """Remove oldest segments over limits.
+
+        Current segment is only removed when its records are too old.
+        """
+        segments = self._segments()
+        total = sum(self._segment_size(path) for path, _ in segments)
+
+        for i, (path, _) in enumerate(segments):
+            too_big = self.max_size and total > self.max_size
+            too_big = too_big and i + 1 < len(segments)
+            end = self._segment_end(segments, i)
+            too_old = self.max_age and end < now - self.max_age
+            if not (too_big or too_old):
+                break
+
+            total -= self._segment_size(path)
+            self._remove_segment(path)
+
+    def _segment_end(self, segments, idx):
+        """Time after segment ``idx`` records in ``segments``.
+
+        Records are older than next segment first record. For the last
+        segment, it is the last record time if it is the current one, else
+        its modification time.
+        """
+        try:
+            return segments[idx + 1][1]
+        except IndexError:
+            path = segments[idx][0]
+            if path == self._path:
+                return self._last
+            return os.path.getmtime(path + self.SEGMENT_EXT)
+
+    def _segments(self):
+        """Return sorted list of (path, start time) for node segments."""
+        names = (name for name in os.listdir(self.directory)
+                 if name.endswith(self.SEGMENT_EXT))
+        paths = (os.path.join(self.directory, name[:-len(self.SEGMENT_EXT)])
+                 for name in names)
+        return sorted((path, int(os.path.basename(path)) / 1e6)
+                      for path in paths)
+
+    def _segment_size(self, path):
+        """Segment and index size on disk."""
+        return sum(os.path.getsize(path + ext)
+                   for ext in (self.SEGMENT_EXT, self.INDEX_EXT))
+
+    def _remove_segment(self, path):
+        """Remove segment and index files, closing current one."""
+        if path == self._path:
+            self._close()
+        for ext in (self.SEGMENT_EXT, self.INDEX_EXT):
+            os.remove(path + ext)
+
+    @common.synchronized('_lock')
+    def close(self):
+        """Close current segment, next record starts a new one."""
+        self._close()
+
+    def _close(self):
+        for segfile in (self._segment, self._index):
+            if segfile is not None:
+                segfile.close()
+        self._segment = None
+        self._index = None
+        self._path = None
+
+    def records(self, start=0, end=None):
+        """Iterate over (timestamp, seqno, line) recorded in [start, end].
+
+        ``end`` None means up to now.
+        Segments are read using memory-mapped files.
+        """
+        end = time.time() if end is None else end
+        for path, size, seg_start, seg_end in self._snapshot():
+            if seg_start > end:
+                break
+            if seg_end < start:
+                continue
+            for record in self._segment_records(path, size, start, end):
+                yield record
+
+    def _snapshot(self):
+        """Flush current segment and return segments as list of
+        (path, size, start time, next segment start time).
+        """
+        with self._lock:  # pylint:disable=not-context-manager
+            if self._segment is not None:
+                self._segment.flush()
+                self._index.flush()
+            segments = self._segments()
+            sizes = [os.path.getsize(path + self.SEGMENT_EXT)
+                     for path, _ in segments]
+
+        # Last segment may contain records up to now
+        ends = [seg_start for _, seg_start in segments[1:]] + [float('inf')]
+        return [(path, size, seg_start, seg_end) for
+                (path, seg_start), size, seg_end in zip(segments, sizes, ends)]
+
+    def _segment_records(self, path, size, start, end):
+        """Iterate over segment records in [start, end].
+
+        Segment removed since the snapshot has no records.
+        """
+        opened = self._open_segment(path, start) if size else None
+        if opened is None:
+            return
+
+        offset, segfile = opened
+        with segfile:
+            mem = mmap.mmap(segfile.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for record in self._mmap_records(mem, offset, size,
+                                                 start, end):
+                    yield record
+            finally:
+                mem.close()
+
+    def _open_segment(self, path, start):
+        """Return ``start`` offset and segment file, None if removed."""
+        try:
+            offset = self._index_offset(path, start)
+            return offset, open(path + self.SEGMENT_EXT, 'rb')
+        except (IOError, OSError):
+            return None
+
+    def _mmap_records(  # pylint:disable=too-many-arguments
+            self, mem, offset, size, start, end):
+        """Iterate over ``mem`` records in [start, end] from ``offset``."""
+        while offset + self.RECORD.size <= size:
+            timestamp, seqno, length = self.RECORD.unpack_from(mem, offset)
+            offset += self.RECORD.size
+            if timestamp > end or offset + length > size:
+                return
+            if timestamp >= start:
+                yield timestamp, seqno, mem[offset:offset + length]
+            offset += length
+
+    def _index_offset(self, path, start):
+        """Return offset of the last indexed record before ``start``."""
+        with open(path + self.INDEX_EXT, 'rb') as idxfile:
+            data = idxfile.read()
+
+        count = len(data) // self.INDEX.size
+        entries = [self.INDEX.unpack_from(data, i * self.INDEX.size)
+                   for i in range(count)]
+        times = [timestamp for timestamp, _ in entries]
+
+        idx = bisect.bisect_right(times, start) - 1
+        return entries[idx][1] if idx >= 0 else 0
+
+
+class LineCapture(object):
+    """Nodes lines capture in ``directory``.
+
+    With ``max_age``, ``start`` removes too old segments of all nodes
+    captures every ``EVICT_INTERVAL`` seconds until ``close``.
+
+    :param directory: capture base directory
+    :param segment_size: segment size in bytes before starting a new one
+    :param max_size: node capture maximum size in bytes, 0 to disable
+    :param max_age: records maximum age in seconds, 0 to disable
+    """
+    EVICT_INTERVAL = 60.0
+
+    def __init__(self, directory, segment_size, max_size=0, max_age=0):
+        self.directory = directory
+        self.options = (segment_size, max_size, max_age)
+        self.max_age = max_age
+        self.nodes = {}
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start too old segments removal thread if ``max_age`` is set."""
+        if not self.max_age:
+            return
+        self._closed.clear()
+        thread = threading.Thread(target=self._thr_evict)
+        thread.daemon = True
+        thread.start()
+
+    def _thr_evict(self):
+        while not self._closed.wait(self.EVICT_INTERVAL):
+            self.evict()
+
+    def evict(self):
+        """Remove segments over limits for all nodes in ``directory``.
+
+        Captures from previous runs are also opened.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            archi, _, num = name.rpartition('-')
+            capture = self.find(archi, num)
+            if capture is not None:
+                capture.evict()
+
+    @common.synchronized('_lock')
+    def node(self, archi, num):
+        """Return node ``archi``, ``num`` capture."""
+        host = (archi, num)
+        try:
+            return self.nodes[host]
+        except KeyError:
+            directory = os.path.join(self.directory, '%s-%s' % host)
+            capture = NodeCapture(directory, *self.options)
+            return self.nodes.setdefault(host, capture)
+
+    @common.synchronized('_lock')
+    def find(self, archi, num):
+        """Return node ``archi``, ``num`` capture if it exists, else None.
+
+        Capture directories from previous runs are also opened.
+        """
+        host = (archi, num)
+        capture = self.nodes.get(host)
+        directory = os.path.join(self.directory, '%s-%s' % host)
+        if capture is None and os.path.isdir(directory):
+            capture = NodeCapture(directory, *self.options)
+            self.nodes[host] = capture
+        return capture
+
+    def close(self):
+        """Stop segments removal and close all nodes captures."""
+        self._closed.set()
+        for capture in list(self.nodes.values()):
+            capture.close()
+
+
+class LineRecorder(object):
+    """Record lines to node ``capture`` before calling ``handler``.
+
+    ``handler`` can be changed while recording, None only records lines.
+
+    :param handler: callback for lines, or None
+    :param capture: node capture from ``LineCapture.node``
+    :param clock: function returning line receive time
+    """
+    SEQNO_MASK = 0xffffffff
+
+    def __init__(self, handler, capture, clock):
+        self.handler = handler
+        self.capture = capture
+        self.clock = clock
+        self.seqno = 0
+
+    def __call__(self, line):
+        """Record line and call 'handler'."""
+        self.capture.record(self.clock(), self.seqno, line)
+        self.seqno = (self.seqno + 1) & self.SEQNO_MASK
+        if self.handler is not None:
+            self.handler(line)
+
+    def close(self):
+        """Close current capture segment and handler."""
+        self.capture.close()
+        common.close_handler(self.handler)
+
+
+def replay(records, handler, rate=0):
+    """Call ``handler`` with each (timestamp, seqno, line) ``records``.
+
+    :param rate: maximum number of records per second, 0 for no limit
+    """
+    period = 1.0 / rate if rate else 0
+    for record in records:
+        handler(*record)
+        time.sleep(period)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""Radio sniffer 802.15.4 frames filter.
+
+A filter is an expression on 802.15.4 MAC header fields, compiled once and
+evaluated on each sniffed frame.
+
+Fields: ::
+
+   :type:     frame type, 'beacon', 'data', 'ack', 'cmd' or its number
+   :len:      frame length, including FCS
+   :pan:      destination PAN ID
+   :src_pan:  source PAN ID, destination one with PAN ID compression
+   :dst:      destination short or extended address
+   :src:      source short or extended address
+
+Comparisons are ``field op value`` with ``op`` in
+``== != < <= > >=``, values are decimal or ``0x`` hexadecimal numbers.
+Extended addresses can also be written as ``00:12:4b:00:01:02:03:04``.
+Comparisons on a field not present in the frame are false.
+
+Comparisons are combined with ``and``, ``or``, ``not`` and parentheses:
+
+   type == data and pan == 0xabcd and not (dst == 0xffff)
+
+Expressions are limited to 1024 characters and 32 nested ``not`` and
+parentheses.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+import re
+import struct
+import operator
+
+FRAME_TYPES = {'beacon': 0, 'data': 1, 'ack': 2, 'cmd': 3}
+
+ADDRESS = {
+    2: struct.Struct(b'<H'),  # short
+    3: struct.Struct(b'<Q'),  # extended
+}
+PAN_ID = struct.Struct(b'<H')
+FCF = struct.Struct(b'<H')
+
+OPERATORS = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge,
+}
+FIELDS = ('type', 'len', 'pan', 'src_pan', 'dst', 'src')
+
+MAX_LENGTH = 1024
+MAX_DEPTH = 32
+
+TOKEN_RE = re.compile(r'(?P<op>==|!=|<=|>=|<|>)|(?P<paren>[()])|'
+                      r'(?P<addr>[0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){7})|'
+                      r'(?P<word>\w+)')
+
+
+def decode(frame):
+    """Return ``frame`` MAC header fields dict.
+
+    Missing fields or truncated frame header fields are not set.
+
+    >>> fields = decode(b'\\x41\\x88\\x01\\xcd\\xab\\xff\\xff\\x01\\x00')
+    >>> [hex(fields[name]) for name in FIELDS]
+    ['0x1', '0x9', '0xabcd', '0xabcd', '0xffff', '0x1']
+    """
+    fields = {'len': len(frame)}
+    if len(frame) < FCF.size:
+        return fields
+
+    fcf = FCF.unpack_from(frame)[0]
+    fields['type'] = fcf & 0x7
+    dst_mode = (fcf >> 10) & 0x3
+    src_mode = (fcf >> 14) & 0x3
+    pan_compression = fcf & 0x40
+
+    # Frame control, sequence number
+    offset = FCF.size + 1
+    try:
+        offset = _decode_address(frame, offset, dst_mode, fields,
+                                 ('pan', 'dst'))
+        if pan_compression and 'pan' in fields:
+            fields['src_pan'] = fields['pan']
+        _decode_address(frame, offset, src_mode, fields, ('src_pan', 'src'),
+                        with_pan=not pan_compression)
+    except struct.error:
+        pass
+    return fields
+
+
+def _decode_address(frame, offset,  # pylint:disable=too-many-arguments
+                    mode, fields, names, with_pan=True):
+    """Decode PAN ID and address for address ``mode`` at ``offset``.
+
+    Return offset after address.
+    """
+    if mode not in ADDRESS:
+        return offset
+
+    pan_name, addr_name = names
+    if with_pan:
+        fields[pan_name] = PAN_ID.unpack_from(frame, offset)[0]
+        offset += PAN_ID.size
+
+    address = ADDRESS[mode]
+    fields[addr_name] = address.unpack_from(frame, offset)[0]
+    return offset + address.size
+
+
+def compile_filter(expression):
+    """Compile ``expression`` to a function matching a frame.
+
+    :raises ValueError: on invalid expression
+
+    >>> match = compile_filter('type == data and not (dst == 0xffff)')
+    >>> match(b'\\x41\\x88\\x01\\xcd\\xab\\xff\\xff\\x01\\x00')
+    False
+    >>> match(b'\\x41\\x88\\x01\\xcd\\xab\\x02\\x00\\x01\\x00')
+    True
+    >>> compile_filter('type = data')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid filter: unexpected '=' at 5
+    >>> compile_filter('not ' * 100 + 'len > 0')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid filter: more than 32 nested 'not' or '(' at 128
+    """
+    parser = _Parser(expression)
+    predicate = parser.parse()
+
+    def _match(frame):
+        return predicate(decode(frame))
+    return _match
+
+
+class _Parser(object):  # pylint:disable=too-few-public-methods
+    """Recursive descent parser building predicates on fields dict.
+
+    expr := term ('or' term)*
+    term := factor ('and' factor)*
+    factor := 'not' factor | '(' expr ')' | field op value
+    """
+
+    def __init__(self, expression):
+        if len(expression) > MAX_LENGTH:
+            _error('longer than %u characters' % MAX_LENGTH)
+        self.tokens = self._tokenize(expression)
+        self.pos = 0
+        self.depth = 0
+
+    @staticmethod
+    def _tokenize(expression):
+        """Return list of (kind, value, position) tokens."""
+        tokens = []
+        pos = 0
+        while pos < len(expression):
+            if expression[pos].isspace():
+                pos += 1
+                continue
+            match = TOKEN_RE.match(expression, pos)
+            if match is None:
+                _error('unexpected %r at %u' % (expression[pos], pos))
+            kind = match.lastgroup
+            tokens.append((kind, match.group(kind), pos))
+            pos = match.end()
+        return tokens
+
+    def parse(self):
+        """Return predicate for whole expression."""
+        predicate = self._expr()
+        if self.pos < len(self.tokens):
+            self._unexpected()
+        return predicate
+
+    def _peek(self):
+        try:
+            return self.tokens[self.pos]
+        except IndexError:
+            return (None, None, None)
+
+    def _next(self, kind=None):
+        token = self._peek()
+        if token[0] is None or (kind is not None and token[0] != kind):
+            self._unexpected()
+        self.pos += 1
+        return token[1]
+
+    def _unexpected(self):
+        _kind, value, pos = self._peek()
+        if value is None:
+            _error('unexpected end')
+        _error('unexpected %r at %u' % (value, pos))
+
+    def _accept(self, word):
+        if self._peek()[1] == word:
+            self.pos += 1
+            return True
+        return False
+
+    def _expr(self):
+        predicates = [self._term()]
+        while self._accept('or'):
+            predicates.append(self._term())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda fields: any(pred(fields) for pred in predicates)
+
+    def _term(self):
+        predicates = [self._factor()]
+        while self._accept('and'):
+            predicates.append(self._factor())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda fields: all(pred(fields) for pred in predicates)
+
+    def _factor(self):
+        if self._peek()[1] in ('not', '('):
+            return self._nested()
+        return self._comparison()
+
+    def _nested(self):
+        """Parse 'not' or parentheses factor, limiting nesting depth."""
+        if self.depth >= MAX_DEPTH:
+            _error("more than %u nested 'not' or '(' at %u" %
+                   (MAX_DEPTH, self._peek()[2]))
+        self.depth += 1
+        if self._accept('not'):
+            predicate = self._factor()
+            self.depth -= 1
+            return lambda fields: not predicate(fields)
+        self._next('paren')
+        predicate = self._expr()
+        self._next('paren')
+        self.depth -= 1
+        return predicate
+
+    def _comparison(self):
+        field = self._next('word')
+        if field not in FIELDS:
+            _error('unknown field %r' % field)
+        compare = OPERATORS[self._next('op')]
+        value = self._value(field)
+
+        def _compare(fields):
+            try:
+                return compare(fields[field], value)
+            except KeyError:
+                return False
+        return _compare
+
+    def _value(self, field):
+        kind = self._peek()[0]
+        value = self._next()
+        if kind == 'addr':
+            return int(value.replace(':', ''), 16)
+        if field == 'type' and value in FRAME_TYPES:
+            return FRAME_TYPES[value]
+        try:
+            return int(value, 0)
+        except (TypeError, ValueError):
+            _error('invalid value %r for %s' % (value, field))
+
+
+def _error(message):
+    raise ValueError('Invalid filter: %s' % message)
@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+
+"""Common module tests."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+import mock
+
+from iotlabmqtt import common
+from . import TestCaseImproved
+
+
+class DataBatcherTest(TestCaseImproved):
+    """Test DataBatcher."""
+
+    def test_no_batching(self):
+        """Test data handled as is without size and delay."""
+        handler = mock.Mock()
+        batcher = common.DataBatcher(handler)
+
+        batcher(b'abc')
+        batcher(b'def')
+        handler.assert_has_calls([mock.call(b'abc'), mock.call(b'def')])
+
+    def test_size(self):
+        """Test batching on size."""
+        handler = mock.Mock()
+        batcher = common.DataBatcher(handler, size=4)
+
+        batcher(b'ab')
+        batcher(b'c')
+        self.assertFalse(handler.called)
+
+        batcher(b'def')
+        handler.assert_called_once_with(b'abcdef')
+
+        # Remaining data handled on close
+        handler.reset_mock()
+        batcher(b'gh')
+        batcher.close()
+        handler.assert_called_once_with(b'gh')
+
+        # Nothing to flush
+        handler.reset_mock()
+        batcher.close()
+        self.assertFalse(handler.called)
+
+    def test_delay(self):
+        """Test batching on delay."""
+        handler = mock.Mock()
+        batcher = common.DataBatcher(handler, size=1024, delay=0.1)
+
+        batcher(b'abc')
+        batcher(b'def')
+        self.assertFalse(handler.called)
+
+        self.assertEqualTimeout(lambda: handler.call_args_list,
+                                [mock.call(b'abcdef')], 1, step=0.01)
@@ -310,7 +310,7 @@ class RadioSnifferIntegrationTest(IntegrationTestCase):
 
         # Error raised
         err = ('RADIO SNIFFER ERROR: localhost/30001: '
-               'Connection closed in state raw\n'
+               'Connection closed in state sniffing\n'
                '(Cmd) ')
         self.assertEqualTimeout(stdout.getvalue, err, 2)
         stdout.seek(0)
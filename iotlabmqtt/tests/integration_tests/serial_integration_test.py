@@ -283,7 +283,7 @@ class SerialClientErrorTests(TestCaseImproved):
         hlp = ('Error: Invalid arguments\n'
                'Usage: linewrite ARCHI NUM MESSAGE\n'
                '  ARCHI: m3/a8\n'
-               '  NUM:   node num\n'
+               '  NUM:   node num, nodeset or all\n'
                '  MESSAGE: Message line to send\n')
 
         # Missing message
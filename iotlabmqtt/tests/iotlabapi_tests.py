@@ -11,6 +11,7 @@ except ImportError:
     from io import StringIO
 
 import argparse
+import threading
 
 import mock
 
@@ -258,3 +259,152 @@ class IoTLABAPITest(TestCaseImproved):
         error_start = ("IoT-LAB Request 'update' error: "
                        "'[Errno 2] No such file or directory: ")
         self.assertTrue(error.startswith(error_start))
+
+
+class CommandBatcherTest(TestCaseImproved):
+    """Test CommandBatcher."""
+
+    @staticmethod
+    def _call_all(batcher, calls):
+        """Run ``batcher`` ``calls`` concurrently and return results."""
+        results = [None] * len(calls)
+
+        def _call(idx, args):
+            results[idx] = batcher(*args)
+
+        threads = [threading.Thread(target=_call, args=(idx, args))
+                   for idx, args in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_batches(self):
+        """Test same arguments nodes commands are coalesced."""
+        command = mock.Mock(side_effect=lambda channel, archi, *nums: {
+            str(num): 'err %s' % num if num == 3 else '' for num in nums})
+        batcher = iotlabapi.CommandBatcher(command, window=0.1)
+
+        calls = [(11, 'm3', 1), (11, 'm3', 2), (11, 'm3', 3), (12, 'm3', 4),
+                 (11, 'm3', 1)]
+        results = self._call_all(batcher, calls)
+
+        self.assertEqual(results, [{'1': ''}, {'2': ''}, {'3': 'err 3'},
+                                   {'4': ''}, {'1': ''}])
+        self.assertEqual(command.call_count, 2)
+        calls = sorted(call[0][:2] + tuple(sorted(call[0][2:]))
+                       for call in command.call_args_list)
+        self.assertEqual(calls, [(11, 'm3', 1, 2, 3), (12, 'm3', 4)])
+
+    def test_errors_and_disabled(self):
+        """Test command exception and no window."""
+        command = mock.Mock(side_effect=RuntimeError('API down'))
+        batcher = iotlabapi.CommandBatcher(command, window=0.01)
+        self.assertEqual(self._call_all(batcher, [('m3', 1), ('m3', 2)]),
+                         [{'1': 'API down'}, {'2': 'API down'}])
+
+        command = mock.Mock(return_value={'1': ''})
+        batcher = iotlabapi.CommandBatcher(command, window=0)
+        self.assertEqual(batcher('m3', 1), {'1': ''})
+        command.assert_called_once_with('m3', 1)
+
+    def test_batch_error_bisected(self):
+        """Test a whole batch error is retried in halves to failing nodes."""
+        def _command(archi, *nums):
+            if 3 in nums:
+                return iotlabapi.IoTLABAPI.retval('invalid node 3', *nums)
+            # No result for node 2
+            return {str(num): '' for num in nums if num != 2}
+        command = mock.Mock(side_effect=_command)
+        batcher = iotlabapi.CommandBatcher(command, window=0.1)
+
+        results = self._call_all(batcher, [('m3', 1), ('m3', 2), ('m3', 3)])
+        self.assertEqual(results, [{'1': ''},
+                                   {'2': 'Error: no result for node'},
+                                   {'3': 'invalid node 3'}])
+        self.assertLessEqual(command.call_count, 5)
+
+        # One failing node in a large batch
+        command.reset_mock()
+        result = batcher._run_command(('m3',), tuple(range(1, 101)))
+        self.assertEqual(result['3'], 'invalid node 3')
+        self.assertEqual(result['1'], '')
+        self.assertEqual(result['100'], '')
+        self.assertEqual(command.call_count, 1 + 2 * 7)
+
+    def test_batch_error_all_nodes(self):
+        """Test an error for every node is not retried per node."""
+        command = mock.Mock(side_effect=lambda archi, *nums: (
+            iotlabapi.IoTLABAPI.retval('experiment ended', *nums)))
+        batcher = iotlabapi.CommandBatcher(command, window=0.1)
+        nums = tuple(range(1, 101))
+
+        result = batcher._run_command(('m3',), nums)
+        self.assertEqual(result, iotlabapi.IoTLABAPI.retval(
+            'experiment ended', *nums))
+        # Whole batch then its two halves
+        self.assertEqual(command.call_count, 3)
+
+        command.reset_mock()
+        command.side_effect = RuntimeError('API down')
+        result = batcher._run_command(('m3',), nums)
+        self.assertEqual(result['50'], 'API down')
+        self.assertEqual(command.call_count, 3)
+
+        # Different error in each half, retries are bounded
+        command.reset_mock()
+        command.side_effect = lambda archi, *nums: iotlabapi.IoTLABAPI.retval(
+            'error %s' % (nums,), *nums)
+        batcher._run_command(('m3',), nums)
+        self.assertEqual(command.call_count,
+                         1 + iotlabapi.CommandBatcher.MAX_RETRIES)
+
+    def test_submit(self):
+        """Test non blocking calls results callbacks."""
+        command = mock.Mock(side_effect=lambda archi, *nums: {
+            str(num): '' for num in nums})
+        results = []
+        done = threading.Event()
+
+        def _callback(result):
+            results.append(result)
+            if len(results) == 3:
+                done.set()
+
+        batcher = iotlabapi.CommandBatcher(command, window=0.05)
+        for num in (1, 2, 3):
+            batcher.submit(_callback, 'm3', num)
+        self.assertTrue(done.wait(5))
+
+        command.assert_called_once_with('m3', 1, 2, 3)
+        self.assertEqual(sorted(results, key=lambda ret: list(ret)),
+                         [{'1': ''}, {'2': ''}, {'3': ''}])
+
+        # Disabled window runs command in a thread
+        done.clear()
+        del results[:]
+        batcher = iotlabapi.CommandBatcher(command, window=0)
+        for num in (1, 2, 3):
+            batcher.submit(_callback, 'm3', num)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(command.call_count, 4)
+
+    def test_submit_callback_error(self):
+        """Test a failing callback does not prevent other replies."""
+        command = mock.Mock(side_effect=lambda archi, *nums: {
+            str(num): '' for num in nums})
+        results = []
+        done = threading.Event()
+
+        def _callback(result):
+            if '1' in result:
+                raise KeyError('1')
+            results.append(result)
+            done.set()
+
+        batcher = iotlabapi.CommandBatcher(command, window=0.05)
+        batcher.submit(_callback, 'm3', 1)
+        batcher.submit(_callback, 'm3', 2)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [{'2': ''}])
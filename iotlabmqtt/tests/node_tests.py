@@ -0,0 +1,167 @@
+# -*- coding:utf-8 -*-
+
+"""Node agent tests."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+import json
+import threading
+
+import mock
+
+from iotlabmqtt import node
+from . import TestCaseImproved
+
+
+class CommandQueueTest(TestCaseImproved):
+    """Test CommandQueue."""
+
+    PRIORITIES = node.MQTTNodeAgent.PRIORITIES
+
+    def test_priorities_and_busy_nodes(self):
+        """Test jobs are taken by priority, skipping running nodes."""
+        queue = node.CommandQueue(0, self.PRIORITIES)
+        queue.submit('update', [('m3', 1)], mock.Mock())
+        queue.submit('poweron', [('m3', 2)], mock.Mock())
+        queue.submit('reset', [('m3', 4)], mock.Mock())
+        queue.submit('reset', [('m3', 2), ('m3', 3)], mock.Mock())
+
+        queue.busy = {('m3', 1)}
+        names = [(job['name'], sorted(job['nodes']))
+                 for job in iter(queue._pop_runnable, None)]
+        # 'reset' on m3-2 waits for 'poweron' queued before on m3-2
+        self.assertEqual(names, [('reset', [('m3', 4)]),
+                                 ('poweron', [('m3', 2)]),
+                                 ('reset', [('m3', 2), ('m3', 3)])])
+
+        queue.busy = set()
+        self.assertEqual(queue._pop_runnable()['name'], 'update')
+        self.assertIsNone(queue._pop_runnable())
+
+    def test_same_node_fifo(self):
+        """Test one node commands keep submission order whatever priority."""
+        queue = node.CommandQueue(0, self.PRIORITIES)
+        queue.submit('poweron', [('m3', 1)], mock.Mock())
+        queue.submit('poweroff', [('m3', 1)], mock.Mock())
+        queue.submit('update', [('m3', 1)], mock.Mock())
+        queue.submit('reset', [('m3', 1), ('m3', 2)], mock.Mock())
+        queue.submit('poweroff', [('m3', 2)], mock.Mock())
+
+        names = [job['name'] for job in iter(queue._pop_runnable, None)]
+        self.assertEqual(names, ['poweron', 'poweroff', 'update', 'reset',
+                                 'poweroff'])
+
+    def test_workers(self):
+        """Test node commands are serialized and errors replied."""
+        clock = mock.Mock(return_value=10.0)
+        queue = node.CommandQueue(2, self.PRIORITIES, clock)
+        queue.start()
+        self.addCleanup(queue.stop)
+
+        started = threading.Event()
+        release = threading.Event()
+        done = threading.Event()
+        order = []
+
+        def _command(name):
+            order.append(name)
+            if name == 'first':
+                started.set()
+                release.wait(5)
+            elif name == 'other':
+                done.set()
+
+        queue.submit('update', [('m3', 1)], _command, ('first',))
+        self.assertTrue(started.wait(5))
+        queue.submit('poweroff', [('m3', 1)], _command, ('second',))
+
+        # Other node is not blocked
+        queue.submit('reset', [('m3', 2)], _command, ('other',))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(order, ['first', 'other'])
+
+        error_cb = mock.Mock(side_effect=lambda msg: done.set())
+        done.clear()
+        queue.submit('poweroff', [('m3', 1)],
+                     mock.Mock(side_effect=RuntimeError('error')),
+                     error_cb=error_cb)
+        clock.return_value = 12.0
+        release.set()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(order, ['first', 'other', 'second'])
+        error_cb.assert_called_once_with('Error: error')
+
+        stats = queue.get_stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['wait']['poweroff'],
+                         {'count': 2, 'mean': 2.0, 'max': 2.0})
+        self.assertEqual(stats['wait']['reset']['count'], 1)
+
+    def test_stop_replies_errors(self):
+        """Test queued jobs get an error when stopping."""
+        queue = node.CommandQueue(0, self.PRIORITIES)
+        error_cb = mock.Mock()
+        command = mock.Mock()
+        queue.submit('reset', [('m3', 1)], command, error_cb=error_cb)
+        queue.submit('update', [('m3', 1)], command)
+        queue.stop()
+        error_cb.assert_called_once_with('Error: node agent stopped')
+
+        queue.submit('reset', [('m3', 1)], command, error_cb=error_cb)
+        self.assertEqual(error_cb.call_count, 2)
+        self.assertFalse(command.called)
+
+    def test_queue_full(self):
+        """Test commands are rejected when the queue is full."""
+        queue = node.CommandQueue(0, self.PRIORITIES, max_queued=2)
+        error_cb = mock.Mock()
+        queue.submit('update', [('m3', 1)], mock.Mock())
+        queue.submit('update', [('m3', 2)], mock.Mock())
+        queue.submit('update', [('m3', 3)], mock.Mock(), error_cb=error_cb)
+        error_cb.assert_called_once_with('Error: commands queue full')
+
+        stats = queue.get_stats()
+        self.assertEqual((stats['queued'], stats['rejected']), (2, 1))
+
+        queue._pop_runnable()
+        queue.submit('update', [('m3', 3)], mock.Mock(), error_cb=error_cb)
+        self.assertEqual(error_cb.call_count, 1)
+        self.assertEqual(queue.get_stats()['queued'], 2)
+
+
+class MQTTNodeAgentTest(TestCaseImproved):
+    """Test MQTTNodeAgent."""
+
+    def test_stats(self):
+        """Test commands queue stats request."""
+        agent = node.MQTTNodeAgent(mock.Mock(), iotlab_api=mock.Mock(),
+                                   workers=3, max_queued=10)
+        stats = json.loads(agent.cb_stats(mock.Mock()).decode('utf-8'))
+        self.assertEqual(stats, {'queued': 0, 'running': 0, 'workers': 3,
+                                 'max_queued': 10, 'rejected': 0,
+                                 'wait': {}})
+
+    def test_batch_queued_as_job(self):
+        """Test batched commands run as queue jobs replying to each node."""
+        api = mock.Mock()
+        api.reset.return_value = {'1': '', '2': 'Error'}
+        agent = node.MQTTNodeAgent(mock.Mock(), iotlab_api=api, workers=0,
+                                   api_batch_window=0)
+        replies = [mock.Mock(), mock.Mock()]
+        for num, reply in zip((1, 2), replies):
+            msg = mock.Mock(reply_publisher=reply)
+            self.assertIsNone(agent.cb_reset(msg, 'm3', num))
+
+        self.assertEqual(len(agent.queue.queue), 2)
+        for job in iter(agent.queue._pop_runnable, None):
+            agent.queue._run_job(job)
+        replies[0].assert_called_once_with(b'')
+        replies[1].assert_called_once_with(b'Error')
+
+        msg = mock.Mock()
+        agent.cb_poweron(msg, 'm3', 3)
+        agent.stop()
+        msg.reply_publisher.assert_called_once_with(
+            b'Error: node agent stopped')
@@ -0,0 +1,775 @@
+# -*- coding:utf-8 -*-
+
+"""Radio sniffer agent tests."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+import binascii
+import io
+import json
+import struct
+import threading
+
+import mock
+
+from iotlabmqtt import radiosniffer
+from iotlabmqtt.clients import radiosniffer as radiosnifferclient
+from . import TestCaseImproved
+
+
+# Node sniffer ZEP packet: channel 26, LQI 255, NTP time, seqno 7,
+# RSSI -62 dBm in the first reserved byte, 802.15.4 frame from 0x5 with FCS
+SNIFFER_PACKET = binascii.unhexlify(
+    b'455802011a000100ffdd12ad808000000000000007c20000000000000000000d'
+    b'41882acdabffff05006869e5f4')
+
+
+def zep_packet(payload, seqno=1, timestamp=0.5, rssi=0):
+    """Return a ZEP packet with ``payload``."""
+    header = bytearray(b'EX\x02\x01\x0b\x00\x01\x00\xff')
+    # NTP time, 0x83aa7e80 is 1970
+    header += struct.pack('!LL', 0x83aa7e80 + int(timestamp),
+                          int(timestamp % 1 * (1 << 32)))
+    header += bytearray([0, 0, 0, seqno])
+    # Reserved, node sniffer RSSI in first byte
+    header += bytearray([rssi & 0xff]) + bytearray(9)
+    header += bytearray([len(payload)])
+    return bytes(header + payload)
+
+
+class ZepToPcapTest(TestCaseImproved):
+    """Test ZepToPcap."""
+
+    def test_raw_mode(self):
+        """Test RAW mode pcap records."""
+        encoder = radiosniffer.ZepToPcap('RAW')
+        pkt = zep_packet(b'abc')
+
+        record = encoder.convert(pkt)
+        # 0x83aa7e80 is NTP_JAN_1970, 0x80000000 is half a second
+        self.assertEqual(struct.unpack_from('=LLLL', record),
+                         (0, 500000, 3, 3))
+        self.assertEqual(record[16:], b'abc')
+
+        pkt2 = zep_packet(b'defgh', 2)
+        self.assertEqual(encoder.convert_many([pkt, memoryview(pkt2)]),
+                         record + encoder.convert(pkt2))
+        self.assertEqual(encoder.convert_many([]), b'')
+
+    def test_zep_mode(self):
+        """Test ZEP mode encapsulation and batch conversion."""
+        encoder = radiosniffer.ZepToPcap('ZEP')
+        pkt = zep_packet(b'abc')
+
+        record = encoder.convert(pkt)
+        self.assertEqual(len(record), 16 + 14 + 20 + 8 + len(pkt))
+        self.assertEqual(struct.unpack_from('=LLLL', record)[2:],
+                         (len(record) - 16, len(record) - 16))
+        self.assertEqual(record[-len(pkt):], pkt)
+
+        # Valid IP checksum, UDP length
+        ip_hdr = bytes(record[30:50])
+        csum = sum(struct.unpack('!10H', ip_hdr))
+        self.assertEqual((csum & 0xffff) + (csum >> 16), 0xffff)
+        self.assertEqual(struct.unpack_from('!HHH', record, 50),
+                         (17754, 17754, 8 + len(pkt)))
+
+        pkt2 = zep_packet(b'defgh', 2)
+        self.assertEqual(encoder.convert_many([pkt, memoryview(pkt2)]),
+                         record + encoder.convert(pkt2))
+        self.assertEqual(encoder.convert_many([]), bytearray())
+
+
+class ZepToPcapngTest(TestCaseImproved):
+    """Test ZepToPcapng."""
+
+    def test_blocks(self):
+        """Test section, interface and packet blocks."""
+        encoder = radiosniffer.ZepToPcapng('RAW')
+
+        self.assertEqual(struct.unpack('<LLLHHqL', encoder.header),
+                         (0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+
+        idb = encoder.interface('m3-1', 11)
+        self.assertEqual(struct.unpack_from('<LLHHL', idb),
+                         (1, len(idb), 195, 0, 0xffff))
+        self.assertEqual(len(idb) % 4, 0)
+        self.assertIn(b'\x02\x00\x04\x00m3-1', idb)
+        self.assertIn(b'\x03\x00\x0a\x00channel 11\x00\x00', idb)
+        self.assertIn(b'\x09\x00\x01\x00\x09\x00\x00\x00', idb)
+
+        pkt = zep_packet(b'abc')
+        block = encoder.convert(pkt, interface_id=2)
+        self.assertEqual(len(block), 28 + 4 + 4)
+        # Half a second after epoch in nanoseconds
+        self.assertEqual(struct.unpack_from('<LLLLLLL', block),
+                         (6, 36, 2, 0, 500000000, 3, 3))
+        self.assertEqual(block[28:], b'abc\x00\x24\x00\x00\x00')
+
+        pkt2 = zep_packet(b'defgh', 2)
+        self.assertEqual(encoder.convert_many([pkt, memoryview(pkt2)], 2),
+                         block + encoder.convert(pkt2, 2))
+
+        # 'ZEP' blocks are written in one buffer
+        encoder = radiosniffer.ZepToPcapng('ZEP')
+        block = encoder.convert(pkt, 1)
+        self.assertEqual(struct.unpack_from('<LL', block, 20),
+                         (42 + len(pkt), 42 + len(pkt)))
+        self.assertEqual(block[28 + 42:28 + 42 + len(pkt)], pkt)
+        self.assertEqual(encoder.convert_many([pkt, pkt2], 1),
+                         block + encoder.convert(pkt2, 1))
+
+    def test_comment(self):
+        """Test Enhanced Packet Block with comment option."""
+        encoder = radiosniffer.ZepToPcapng('RAW')
+        pkt = zep_packet(b'abc')
+        block = encoder.convert(pkt, 1, comment='heard')
+        base = encoder.convert(pkt, 1)
+
+        # comment option padded, end of options
+        length = len(base) + 4 + 8 + 4
+        self.assertEqual(len(block), length)
+        self.assertEqual(struct.unpack_from('<L', block, 4)[0], length)
+        self.assertEqual(struct.unpack_from('<L', block, length - 4)[0],
+                         length)
+        self.assertEqual(block[len(base) - 4:length - 4],
+                         b'\x01\x00\x05\x00heard\x00\x00\x00'
+                         b'\x00\x00\x00\x00')
+
+
+def pcapng_blocks(data):
+    """Return (type, interface id, timestamp ns) for pcapng ``data``."""
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        block_type, length, iface, t_high, t_low = struct.unpack_from(
+            '<LLLLL', data, offset)
+        blocks.append((block_type, iface, (t_high << 32) + t_low))
+        offset += length
+    return blocks
+
+
+class PacketsMergerTest(TestCaseImproved):
+    """Test PacketsMerger."""
+
+    def setUp(self):
+        self.now = 100.0
+        self.publish = mock.Mock()
+        self.merger = radiosniffer.PacketsMerger(self.publish, window=1.0,
+                                                 clock=lambda: self.now)
+        self.addCleanup(self.merger.close)
+
+    def _published(self):
+        blocks = []
+        for call in self.publish.call_args_list:
+            blocks.extend(pcapng_blocks(bytes(call[0][0])))
+        self.publish.reset_mock()
+        return [(iface, int(round(ts / 1e7))) for btype, iface, ts in blocks
+                if btype == 6]
+
+    def test_merge(self):
+        """Test packets are published ordered after the window."""
+        node1 = self.merger.output('m3-1', 11)
+        node2 = self.merger.output('m3-2', 11)
+        self.assertEqual(self.merger.output('m3-1', 11).__name__, '_push')
+
+        # Interfaces added with first packets only
+        self.publish.assert_not_called()
+        self.assertEqual([b[0] for b in pcapng_blocks(self.merger.header)],
+                         [0x0A0D0D0A])
+
+        node1([zep_packet(b'a', timestamp=10.0),
+               zep_packet(b'b', timestamp=10.5)])
+        node2([zep_packet(b'c', timestamp=10.2)])
+        node1([])
+        # Interfaces published once, and in header
+        self.assertEqual(self.publish.call_count, 2)
+        self.assertEqual([b[0] for b in pcapng_blocks(self.merger.header)],
+                         [0x0A0D0D0A, 1, 1])
+        self.assertEqual(self._published(), [])
+
+        self.now = 100.6
+        node2([zep_packet(b'd', timestamp=11.2)])
+        self.assertEqual(self._published(), [(0, 1000), (1, 1020)])
+
+        # Late packet
+        node1([zep_packet(b'e', timestamp=10.1)])
+        self.assertEqual(self._published(), [(0, 1010)])
+
+        # Window advanced by time
+        self.now = 102.0
+        self.merger.flush()
+        self.assertEqual(self._published(), [(0, 1050), (1, 1120)])
+
+        self.assertEqual(self.merger.get_stats(),
+                         {'packets': 5, 'pending': 0, 'late': {'m3-1': 1}})
+
+    def test_dedup(self):
+        """Test frames heard by several nodes are published once."""
+        merger = radiosniffer.PacketsMerger(self.publish, window=1.0,
+                                            clock=lambda: self.now,
+                                            dedup=0.01)
+        self.addCleanup(merger.close)
+        node1 = merger.output('m3-1', 11)
+        node2 = merger.output('m3-2', 11)
+        self.publish.reset_mock()
+
+        node1([zep_packet(b'a', timestamp=10.0, rssi=-70),
+               zep_packet(b'b', timestamp=10.1, rssi=-70)])
+        # Duplicate, then same frame out of dedup window
+        node2([zep_packet(b'a', timestamp=10.005, rssi=-81),
+               zep_packet(b'b', timestamp=10.5, rssi=-81)])
+        # Retransmission from the same node
+        node1([zep_packet(b'a', timestamp=10.006, rssi=-70)])
+        merger.close()
+
+        data = b''.join(bytes(call[0][0])
+                        for call in self.publish.call_args_list)
+        blocks = [block[0] for block in pcapng_blocks(data)]
+        self.assertEqual(blocks.count(6), 4)
+        self.assertIn(b'heard by m3-1 (-70 dBm), m3-2 (-81 dBm)\0', data)
+        self.assertEqual(data.count(b'heard by m3-1 (-70 dBm)\0'), 2)
+        self.assertEqual(data.count(b'heard by m3-2 (-81 dBm)\0'), 1)
+        self.assertEqual(merger.get_stats()['duplicates'], 1)
+
+    def test_close(self):
+        """Test close publishes pending packets."""
+        node1 = self.merger.output('m3-1', 11)
+        self.publish.reset_mock()
+
+        node1([zep_packet(b'b', timestamp=10.5),
+               zep_packet(b'a', timestamp=10.0)])
+        self.assertIsNotNone(self.merger._timer)
+
+        self.merger.close()
+        self.assertIsNone(self.merger._timer)
+        self.assertEqual(self._published(), [(0, 1000), (0, 1050)])
+
+    @mock.patch('threading.Timer')
+    def test_timer_rescheduled(self, timer):
+        """Test release timer is moved earlier for an older head packet."""
+        node1 = self.merger.output('m3-1', 11)
+        node2 = self.merger.output('m3-2', 11)
+
+        node1([zep_packet(b'a', timestamp=10.5)])
+        self.assertEqual(timer.call_args[0][0], 1.0)
+
+        # Older head packet moves timer, same deadline does not
+        node2([zep_packet(b'b', timestamp=10.2)])
+        self.assertEqual(timer.call_count, 2)
+        self.assertEqual(round(timer.call_args[0][0], 6), 0.7)
+        timer.return_value.cancel.assert_called_once_with()
+        node1([zep_packet(b'c', timestamp=10.5)])
+        self.assertEqual(timer.call_count, 2)
+
+
+class PacketsStatsTest(TestCaseImproved):
+    """Test PacketsStats."""
+
+    @staticmethod
+    def _packet(frame, lqi, rssi):
+        pkt = bytearray(zep_packet(frame, rssi=rssi))
+        pkt[8] = lqi
+        return bytes(pkt)
+
+    @mock.patch('threading.Timer')
+    def test_summary(self, timer):
+        """Test statistics summary."""
+        publish = mock.Mock()
+        stats = radiosniffer.PacketsStats(publish, window=10)
+
+        src_1 = b'\x41\x88\x01\xcd\xab\xff\xff\x01\x00'
+        src_2 = b'\x41\x88\x01\xcd\xab\xff\xff\x02\x00\xaa\xbb'
+        stats([self._packet(src_1, 200, -70), self._packet(src_1, 100, -80)])
+        stats([self._packet(src_2, 255, -90), self._packet(b'a', 0, 10)])
+        self.assertEqual(timer.call_count, 1)
+        publish.assert_not_called()
+
+        # Window end, a new one is started
+        stats.summary()
+        self.assertEqual(timer.call_count, 2)
+        summary = json.loads(publish.call_args[0][0].decode('utf-8'))
+        self.assertEqual(summary['window'], 10)
+        self.assertEqual(summary['channel'], 11)
+        self.assertEqual(summary['packets'], 4)
+        self.assertEqual(summary['bytes'], 9 + 9 + 11 + 1)
+        self.assertEqual(summary['rssi'], {
+            'min': -90, 'max': 10, 'mean': -57.5,
+            'histogram': {'-90': 1, '-80': 1, '-70': 1, '10': 1}})
+        self.assertEqual(summary['length']['histogram'],
+                         {'1': 1, '9': 2, '11': 1})
+        self.assertEqual(summary['lqi']['min'], 0)
+        self.assertEqual(summary['sources'], {
+            '0x1': {'packets': 2, 'lqi': 150.0, 'rssi': -75.0},
+            '0x2': {'packets': 1, 'lqi': 255.0, 'rssi': -90.0},
+        })
+
+        # Empty window is also published, not restarted after close
+        stats.close()
+        self.assertEqual(timer.call_count, 2)
+        self.assertEqual(publish.call_count, 2)
+        summary = json.loads(publish.call_args[0][0].decode('utf-8'))
+        self.assertEqual(summary['packets'], 0)
+        self.assertIsNone(summary['lqi'])
+        self.assertIsNone(summary['rssi'])
+
+        stats.close()
+        stats([self._packet(src_1, 200, -70)])
+        self.assertEqual(timer.call_count, 2)
+        self.assertEqual(publish.call_count, 2)
+
+    @mock.patch('threading.Timer', mock.Mock())
+    def test_sniffer_packet(self):
+        """Test statistics of a node sniffer packet."""
+        publish = mock.Mock()
+        stats = radiosniffer.PacketsStats(publish)
+        stats([SNIFFER_PACKET])
+        stats.close()
+
+        summary = json.loads(publish.call_args[0][0].decode('utf-8'))
+        self.assertEqual(summary['channel'], 26)
+        self.assertEqual(summary['bytes'], 13)
+        self.assertEqual(summary['lqi']['mean'], 255)
+        self.assertEqual(summary['rssi']['histogram'], {'-62': 1})
+        self.assertEqual(summary['sources'], {
+            '0x5': {'packets': 1, 'lqi': 255.0, 'rssi': -62.0}})
+
+
+class PacketsRingTest(TestCaseImproved):
+    """Test PacketsRing."""
+
+    def test_ring(self):
+        """Test packets are kept up to size and by reception time."""
+        clock = mock.Mock(return_value=100.0)
+        overhead = radiosniffer.PacketsRing.ENTRY_OVERHEAD
+        entry_size = len(zep_packet(b'a')) + overhead
+        ring = radiosniffer.PacketsRing(3 * entry_size, clock)
+
+        buf = bytearray(zep_packet(b'a', seqno=1))
+        ring([memoryview(buf)])
+        buf[:] = zep_packet(b'a', seqno=2)  # stored packets are copies
+        clock.return_value = 105.0
+        ring([zep_packet(b'a', seqno=3), zep_packet(b'a', seqno=4)])
+
+        clock.return_value = 110.0
+        self.assertEqual(ring.last(60), [zep_packet(b'a', seqno=1),
+                                         zep_packet(b'a', seqno=3),
+                                         zep_packet(b'a', seqno=4)])
+        self.assertEqual(ring.last(5), [zep_packet(b'a', seqno=3),
+                                        zep_packet(b'a', seqno=4)])
+        self.assertEqual(ring.last(1), [])
+
+        # Oldest dropped
+        ring([zep_packet(b'a', seqno=5)])
+        self.assertEqual(len(ring.last(60)), 3)
+        self.assertEqual(ring.last(60)[0], zep_packet(b'a', seqno=3))
+
+
+class PacketsOutputTest(TestCaseImproved):
+    """Test PacketsOutput."""
+
+    def test_output(self):
+        """Test one message per packet or batches."""
+        encoder = radiosniffer.ZepToPcap('RAW')
+        packets = [zep_packet(b'abc'), zep_packet(b'defgh', 2)]
+        records = [encoder.convert(pkt) for pkt in packets]
+
+        publish = mock.Mock()
+        output = radiosniffer.PacketsOutput(publish, encoder)
+        output(packets)
+        publish.assert_has_calls([mock.call(records[0]),
+                                  mock.call(records[1])])
+        output.close()
+
+        # Batches by size, remaining published on close
+        publish = mock.Mock()
+        output = radiosniffer.PacketsOutput(publish, encoder, size=40)
+        self.assertEqual(output.batcher.delay,
+                         radiosniffer.PacketsOutput.DEFAULT_DELAY)
+        output(packets[:1])
+        output(packets[1:])
+        output(packets[:1])
+        publish.assert_called_once_with(records[0] + records[1])
+
+        output.close()
+        publish.assert_called_with(records[0])
+
+
+class ZEPHandlerTest(TestCaseImproved):
+    """Test ZEPHandler."""
+
+    def test_zep_handler(self):
+        """Test packets split over reads are given in batches."""
+        pkt1 = zep_packet(b'abc', 1)
+        pkt2 = zep_packet(b'defgh', 2)
+        pkt3 = zep_packet(b'i' * 127, 3)
+
+        batches = []
+        handler = radiosniffer.ZEPHandler(
+            lambda pkts: batches.append([bytes(pkt) for pkt in pkts]))
+
+        stream = b'garbage' + pkt1 + pkt2 + b'E' + pkt3
+        handler(stream[:50])
+        handler(stream[50:90])
+        handler(stream[90:])
+
+        self.assertEqual(batches, [[pkt1], [pkt2], [pkt3]])
+        self.assertEqual(handler.buffer, bytearray())
+
+        # All packets in one read
+        batches[:] = []
+        handler(stream)
+        self.assertEqual(batches, [[pkt1, pkt2, pkt3]])
+
+    def test_zep_handler_kept_view(self):
+        """Test buffer compaction when handler keeps packets views."""
+        kept = []
+        handler = radiosniffer.ZEPHandler(kept.extend)
+
+        pkt = zep_packet(b'abc')
+        handler(pkt + pkt[:10])
+        handler(pkt[10:])
+
+        self.assertEqual([bytes(view) for view in kept], [pkt, pkt])
+        self.assertEqual(handler.buffer, bytearray())
+
+
+class SnifferProfilesTest(TestCaseImproved):
+    """Test SnifferProfiles."""
+
+    def setUp(self):
+        self.sniffer_channel = mock.Mock(return_value={'1': ''})
+        self.profiles = radiosniffer.SnifferProfiles(self.sniffer_channel)
+
+    def test_skip_loaded_profile(self):
+        """Test profile is only loaded when channel changed."""
+        self.assertEqual(self.profiles(11, 'm3', '1'), {'1': ''})
+        self.assertEqual(self.profiles(11, 'm3', '1'), {'1': ''})
+        self.sniffer_channel.assert_called_once_with(11, 'm3', '1')
+
+        self.profiles(12, 'm3', '1')
+        self.sniffer_channel.assert_called_with(12, 'm3', '1')
+        self.assertEqual(self.sniffer_channel.call_count, 2)
+
+        # Reloaded after invalidate
+        self.profiles.invalidate('m3', '1')
+        self.profiles(12, 'm3', '1')
+        self.assertEqual(self.sniffer_channel.call_count, 3)
+
+    def test_failed_load(self):
+        """Test failed profile load is not saved."""
+        self.sniffer_channel.return_value = {'1': 'Execution failed on node'}
+        self.assertEqual(self.profiles(11, 'm3', '1'),
+                         {'1': 'Execution failed on node'})
+        self.profiles(11, 'm3', '1')
+        self.assertEqual(self.sniffer_channel.call_count, 2)
+        self.assertEqual(self.profiles.loaded, {})
+
+    def test_invalidate_while_loading(self):
+        """Test profile invalidated while loading is not saved."""
+        def _reset_during_load(channel, archi, num):
+            self.profiles.invalidate(archi, num)
+            return {num: ''}
+        self.sniffer_channel.side_effect = _reset_during_load
+
+        self.profiles(11, 'm3', '1')
+        self.assertEqual(self.profiles.loaded, {})
+
+
+class MQTTRadioSnifferAggregatorTest(TestCaseImproved):
+    """Test MQTTRadioSnifferAggregator."""
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.aggr = radiosniffer.MQTTRadioSnifferAggregator(
+            self.client, iotlab_api=mock.Mock())
+
+    def test_raw_output(self):
+        """Test raw output publishes pcap packets."""
+        output = self.aggr._output('RAW', 'm3', 1, 11)
+        output([zep_packet(b'abc')])
+
+        self.client.publisher.assert_called_with(
+            'iot-lab/radiosniffer/{site}/m3/1/raw/data/out'.format(
+                site=self.aggr.HOSTNAME))
+        publish = self.client.publisher.return_value
+        pcap = publish.call_args[0][0]
+        self.assertEqual(pcap[8:], b'\x03\x00\x00\x00\x03\x00\x00\x00abc')
+
+    @mock.patch('threading.Thread', mock.Mock())
+    def test_raw_and_zep_outputs(self):
+        """Test one packets read is published on raw and zep outputs."""
+        message = mock.Mock(payload=b'11')
+        self.assertIsNone(self.aggr.cb_rawstart(message, 'm3', 1))
+
+        node = self.aggr.nodes[('m3', 1)]
+        node.state = 'sniffing'
+
+        # Same channel only
+        self.assertEqual(self.aggr.cb_zepstart(mock.Mock(payload=b'12'),
+                                               'm3', 1),
+                         b'Already started, stop before start to '
+                         b'change channel')
+        self.assertEqual(self.aggr.cb_zepstart(message, 'm3', 1), b'')
+        self.assertEqual(sorted(node.outputs), ['RAW', 'ZEP'])
+
+        pkt = zep_packet(b'abc')
+        node.connection.data_handler(pkt + pkt)
+
+        publish = self.client.publisher.return_value
+        self.assertEqual(publish.call_count, 4)
+        lengths = sorted(len(call[0][0]) for call in publish.call_args_list)
+        self.assertEqual(lengths, [16 + 3, 16 + 3,
+                                   16 + 42 + len(pkt), 16 + 42 + len(pkt)])
+
+        self.aggr.cb_stop(message, 'm3', 1)
+        self.assertEqual(node.outputs, {})
+        self.assertEqual(self.aggr.nodes, {})
+
+    @mock.patch('threading.Thread', mock.Mock())
+    def test_stop_one_mode(self):
+        """Test stopping one mode keeps the other modes running."""
+        message = mock.Mock(payload=b'11')
+        self.assertIsNone(self.aggr.cb_rawstart(message, 'm3', 1))
+        node = self.aggr.nodes[('m3', 1)]
+        node.state = 'sniffing'
+        self.assertEqual(self.aggr.cb_zepstart(message, 'm3', 1), b'')
+
+        # Not started mode
+        self.assertEqual(self.aggr.cb_statsstop(message, 'm3', 1), b'')
+        self.assertEqual(self.aggr.cb_zepstop(message, 'm3', 1), b'')
+        self.assertEqual(list(node.outputs), ['RAW'])
+        self.assertEqual(node.state, 'sniffing')
+
+        node.connection.data_handler(zep_packet(b'abc'))
+        publish = self.client.publisher.return_value
+        publish.assert_called_once_with(mock.ANY)
+        self.assertEqual(len(publish.call_args[0][0]), 16 + 3)
+
+        # Zep can be started again
+        self.assertEqual(self.aggr.cb_zepstart(message, 'm3', 1), b'')
+        self.assertEqual(sorted(node.outputs), ['RAW', 'ZEP'])
+        self.aggr.cb_zepstop(message, 'm3', 1)
+
+        # Last output closes the node
+        self.assertEqual(self.aggr.cb_rawstop(message, 'm3', 1), b'')
+        self.assertEqual(node.state, 'closed')
+        self.assertEqual(self.aggr.nodes, {})
+        self.assertEqual(self.aggr.cb_rawstop(message, 'm3', 1), b'')
+
+    @mock.patch('threading.Thread', mock.Mock())
+    def test_dump(self):
+        """Test dump node ring buffer as pcap."""
+        message = mock.Mock(payload=b'60')
+        self.assertEqual(self.aggr.cb_dump(message, 'm3', 1),
+                         b'Error: no ring buffer for node')
+
+        self.aggr.ring_buffer_size = 1000
+        self.assertIsNone(self.aggr.cb_rawstart(mock.Mock(payload=b'11'),
+                                                'm3', 1))
+        node = self.aggr.nodes[('m3', 1)]
+        node.state = 'sniffing'
+        node.connection.data_handler(zep_packet(b'abc') + zep_packet(b'de'))
+
+        # Kept after stop
+        self.aggr.cb_stop(message, 'm3', 1)
+        pcap = self.aggr.cb_dump(message, 'm3', 1)
+        self.assertEqual(pcap[:24], radiosniffer.ZepToPcap('RAW').header)
+        self.assertEqual(len(pcap), 24 + 16 + 3 + 16 + 2)
+
+        message.payload = b'60 zep'
+        pcap = self.aggr.cb_dump(message, 'm3', 1)
+        self.assertEqual(pcap[:24], radiosniffer.ZepToPcap('ZEP').header)
+
+        for payload in (b'', b'0', b'a', b'60 pcapng', b'60 raw 1'):
+            message.payload = payload
+            self.assertEqual(self.aggr.cb_dump(message, 'm3', 1),
+                             b'Invalid dump value, should be '
+                             b'"SECONDS [raw|zep]"')
+
+        # Removed on stopall
+        self.aggr.cb_stopall(message)
+        message.payload = b'60'
+        self.assertEqual(self.aggr.cb_dump(message, 'm3', 1),
+                         b'Error: no ring buffer for node')
+
+    def test_ring_only(self):
+        """Test ring mode fills the ring buffer without outputs."""
+        message = mock.Mock(payload=b'11')
+        self.assertEqual(self.aggr.cb_ringstart(message, 'm3', 1),
+                         b'Error: ring buffer disabled')
+
+        self.aggr.ring_buffer_size = 1000
+        message.payload = b'11 type == data'
+        self.assertEqual(self.aggr.cb_ringstart(message, 'm3', 1),
+                         b'Error: ring mode has no frames filter')
+
+        message.payload = b'11'
+        self.client.publisher.reset_mock()
+        self.assertIsNone(self.aggr.cb_ringstart(message, 'm3', 1))
+        node = self.aggr.nodes[('m3', 1)]
+        node.state = 'sniffing'
+        node.connection.data_handler(zep_packet(b'abc'))
+        self.assertFalse(self.client.publisher.called)
+
+        message.payload = b'60'
+        pcap = self.aggr.cb_dump(message, 'm3', 1)
+        self.assertEqual(len(pcap), 24 + 16 + 3)
+
+        # Other modes are kept when stopping ring
+        self.assertEqual(self.aggr.cb_rawstart(mock.Mock(payload=b'11'),
+                                               'm3', 1), b'')
+        self.assertEqual(self.aggr.cb_ringstop(message, 'm3', 1), b'')
+        self.assertEqual(list(node.outputs), ['RAW'])
+        self.assertEqual(self.aggr.cb_rawstop(message, 'm3', 1), b'')
+        self.assertEqual(node.state, 'closed')
+
+    @mock.patch.object(radiosniffer.Node, 'req_start')
+    def test_merged_bulk_start(self, req_start):
+        """Test merged start of a nodes set adds interfaces before reply."""
+        req_start.side_effect = [b'', None, b'Already started']
+        message = mock.Mock(payload=b'm3 1-3 11 type == data')
+
+        self.assertIsNone(self.aggr.cb_mergedbulkstart(message))
+        blocks = pcapng_blocks(self.aggr.cb_mergedheader(None))
+        self.assertEqual([block[0] for block in blocks], [0x0a0d0d0a, 1, 1, 1])
+        self.assertEqual(sorted(self.aggr.nodes),
+                         [('m3', '1'), ('m3', '2'), ('m3', '3')])
+
+        # Reply once all nodes replied, nodes outputs are filtered
+        self.assertFalse(message.reply_publisher.called)
+        reply, mode, output, channel = req_start.call_args_list[1][0]
+        self.assertEqual((mode, channel), ('MERGED', 11))
+        self.assertIsInstance(output, radiosniffer.PacketsFilter)
+        reply(b'')
+        message.reply_publisher.assert_called_once_with(
+            b'{"1": "", "2": "", "3": "Already started"}')
+
+        # Same nodes keep their interfaces
+        req_start.side_effect = None
+        req_start.return_value = b''
+        self.aggr.cb_mergedbulkstart(mock.Mock(payload=b'm3 2-3 11'))
+        self.assertEqual(len(pcapng_blocks(self.aggr.cb_mergedheader(None))),
+                         4)
+
+        for payload in (b'm3', b'm3 1-2', b'm3 1-2 10'):
+            message.payload = payload
+            self.assertIn(b'Invalid', self.aggr.cb_mergedbulkstart(message))
+
+    @mock.patch.object(radiosniffer.Node, 'req_stop')
+    def test_merged_bulk_stop(self, req_stop):
+        """Test merged stop of a nodes set."""
+        req_stop.return_value = b''
+        self.aggr.nodes[('m3', '1')] = radiosniffer.Node(
+            'm3', '1', mock.Mock(), mock.Mock(), mock.Mock())
+
+        message = mock.Mock(payload=b'm3 1-2')
+        self.assertEqual(self.aggr.cb_mergedbulkstop(message),
+                         b'{"1": "", "2": ""}')
+        req_stop.assert_called_once_with('MERGED')
+
+        message.payload = b'm3 a'
+        self.assertEqual(self.aggr.cb_mergedbulkstop(message),
+                         b"Invalid nodes 'm3 a', should be 'ARCHI NODESET'")
+
+    def test_nodeagent_command_invalidate_profile(self):
+        """Test node agent reset/update/poweroff invalidate sniffer profile."""
+        topic = self.aggr.topics['nodeagentcommand']
+        self.assertEqual(
+            topic.subscribe_topic,
+            'iot-lab/node/{site}/+/+/ctl/+/request/+/+'.format(
+                site=self.aggr.HOSTNAME))
+
+        self.aggr.sniffer_channel.loaded[('m3', '1')] = 11
+        self.aggr.sniffer_channel.loaded[('m3', '2')] = 11
+
+        msg = mock.Mock(topic=topic.topic.format(
+            archi='m3', num='1', command='poweron', clientid='c',
+            requestid='r'))
+        topic.callback(None, None, msg)
+        self.assertEqual(len(self.aggr.sniffer_channel.loaded), 2)
+
+        msg.topic = msg.topic.replace('poweron', 'reset')
+        topic.callback(None, None, msg)
+        self.assertEqual(self.aggr.sniffer_channel.loaded, {('m3', '2'): 11})
+
+    @mock.patch('threading.Thread', mock.Mock())
+    def test_start_filter(self):
+        """Test start with a frames filter."""
+        ret = self.aggr.cb_rawstart(mock.Mock(payload=b'11 type == dat'),
+                                    'm3', 1)
+        self.assertEqual(ret, b"Invalid filter: invalid value 'dat' for type")
+        ret = self.aggr.cb_rawstart(mock.Mock(payload=b'27 type == data'),
+                                    'm3', 1)
+        self.assertEqual(ret, b'Invalid channel value, should be in [11, 26]')
+
+        message = mock.Mock(payload=b'11 type == data and len > 4')
+        self.assertIsNone(self.aggr.cb_rawstart(message, 'm3', 1))
+
+        data = zep_packet(b'\x41\x88\x01\xcd\xab\xff\xff\x01\x00')
+        ack = zep_packet(b'\x02\x00\x01\x00\x00')
+        node = self.aggr.nodes[('m3', 1)]
+        node.connection.data_handler(ack + data + data[:-1])
+        node.connection.data_handler(data[-1:] + ack)
+
+        publish = self.client.publisher.return_value
+        self.assertEqual([call[0][0][16:] for call in publish.call_args_list],
+                         [data[32:], data[32:]])
+
+    @mock.patch('threading.Thread', mock.Mock())
+    def test_pcapng_interface(self):
+        """Test pcapng interface request."""
+        message = mock.Mock(payload=b'')
+        err = b'Error: pcapng sniffer not started'
+        self.assertEqual(self.aggr.cb_pcapnginterface(message, 'm3', 1), err)
+
+        self.aggr.cb_rawstart(mock.Mock(payload=b'11'), 'm3', 1)
+        self.assertEqual(self.aggr.cb_pcapnginterface(message, 'm3', 1), err)
+        self.aggr.nodes[('m3', 1)].state = 'sniffing'
+        self.aggr.cb_pcapngstart(mock.Mock(payload=b'11'), 'm3', 1)
+
+        encoder = radiosniffer.ZepToPcapng('RAW')
+        self.assertEqual(self.aggr.cb_pcapnginterface(message, 'm3', 1),
+                         encoder.interface('m3-1', 11))
+
+
+class PcapFilesTest(TestCaseImproved):
+    """Test client PcapFiles."""
+
+    def test_pcapng(self):
+        """Test nodes interfaces ids in pcapng file."""
+        pcap_files = radiosnifferclient.PcapFiles()
+        encoder = radiosniffer.ZepToPcapng('RAW')
+        block = encoder.convert(zep_packet(b'abc'))
+
+        # No file
+        pcap_files.add_interface('pcapng', ('m3', 1), b'IDB1')
+        pcap_files.write_block('pcapng', ('m3', 1), block)
+
+        pcapfd = io.BytesIO()
+        pcapfd.close = mock.Mock()
+        pcap_files.set('pcapng', pcapfd, b'SHB')
+
+        pcap_files.add_interface('pcapng', ('m3', 1), b'IDB1')
+        pcap_files.add_interface('pcapng', ('m3', 2), b'IDB2')
+        pcap_files.add_interface('pcapng', ('m3', 1), b'IDB1')
+        pcap_files.write_block('pcapng', ('m3', 2), block)
+        pcap_files.write_block('pcapng', ('m3', 1), block)
+        # No interface
+        pcap_files.write_block('pcapng', ('m3', 3), block)
+        # Batch
+        batch = encoder.convert_many([zep_packet(b'a'), zep_packet(b'bcdef')])
+        pcap_files.write_block('pcapng', ('m3', 2), batch)
+
+        expected = b''.join([b'SHB', b'IDB1', b'IDB2',
+                             encoder.convert(zep_packet(b'abc'), 1),
+                             encoder.convert(zep_packet(b'abc'), 0),
+                             encoder.convert_many([zep_packet(b'a'),
+                                                   zep_packet(b'bcdef')], 1)])
+        self.assertEqual(pcapfd.getvalue(), expected)
+
+        # Clearing removes interfaces
+        pcap_files.clear('pcapng')
+        self.assertEqual(pcap_files.interfaces, {})
@@ -7,8 +7,13 @@ from __future__ import (absolute_import, division, print_function,
 from builtins import *  # pylint:disable=W0401,W0614,W0622
 
 
+import json
+import time
+import functools
+
 import mock
 
+from iotlabmqtt import common
 from iotlabmqtt import serial
 from . import TestCaseImproved
 
@@ -43,3 +48,630 @@ class LineHandlerTest(TestCaseImproved):
         http://stackoverflow.com/a/14267935/395687
         """
         return [bytes_str[i:i + 1] for i in range(len(bytes_str))]
+
+
+class LineFilterTest(TestCaseImproved):
+    """Test LineFilter."""
+    def test_line_filter(self):
+        """Test filtering lines and counters."""
+        callback = mock.Mock()
+        stats = {}
+        match = serial.LineFilter.matcher({'prefix': ['RESULT:'],
+                                           'regex': '^ERROR [0-9]+$'})
+        line_handler = serial.LineHandler(
+            serial.LineFilter(callback, match, stats))
+
+        line_handler(b'boot\nRESULT: 1\nERROR 12\nERROR none\nRESULT: 2\n')
+
+        callback.assert_has_calls([mock.call(b'RESULT: 1'),
+                                   mock.call(b'ERROR 12'),
+                                   mock.call(b'RESULT: 2')])
+        self.assertEqual(callback.call_count, 3)
+        self.assertEqual(stats, {'filter_matched': 3, 'filter_dropped': 2})
+
+    def test_line_filter_invalid_spec(self):
+        """Test invalid filter specifications."""
+        invalid = [
+            {},
+            {'prefixes': ['a']},
+            {'prefix': 'a'},
+            {'prefix': [1]},
+            {'regex': '('},
+            {'regex': 12},
+            ['prefix'],
+        ]
+        for spec in invalid:
+            self.assertRaises(ValueError, serial.LineFilter.matcher, spec)
+
+
+class LineEnvelopeTest(TestCaseImproved):
+    """Test LineEnvelope."""
+    def test_line_envelope(self):
+        """Test lines timestamp and seqno."""
+        callback = mock.Mock()
+        clock = mock.Mock(side_effect=[10.5, 11.25])
+        line_handler = serial.LineHandler(serial.LineEnvelope(callback, clock))
+
+        line_handler(b'first\nsec')
+        line_handler(b'ond\n')
+
+        decoded = [serial.LineEnvelope.decode(call[0][0])
+                   for call in callback.call_args_list]
+        self.assertEqual(decoded, [(10.5, 0, b'first'), (11.25, 1, b'second')])
+
+        # Seqno wraps on 32 bits
+        envelope = serial.LineEnvelope(callback, lambda: 0.0)
+        envelope.seqno = 0xffffffff
+        envelope(b'line')
+        self.assertEqual(envelope.seqno, 0)
+
+    def test_seqno_before_filter(self):
+        """Test filtered lines still use a seqno."""
+        client = mock.Mock()
+        aggr = serial.MQTTAggregator(client, envelope=True)
+        node = serial.Node('localhost', 20000, mock.Mock(), mock.Mock())
+        node.connection = mock.Mock(recv_time=1.0)
+
+        match = serial.LineFilter.matcher({'prefix': ['R']})
+        handler = serial.LineHandler(aggr._line_handler(node, filter=match))
+        handler(b'R1\nother\nR2\n')
+
+        publish = client.publisher.return_value
+        decoded = [serial.LineEnvelope.decode(call[0][0])
+                   for call in publish.call_args_list]
+        self.assertEqual(decoded, [(1.0, 0, b'R1'), (1.0, 2, b'R2')])
+        self.assertEqual(node.stats['filter_dropped'], 1)
+
+
+class LineRateLimiterTest(TestCaseImproved):
+    """Test LineRateLimiter."""
+    def test_rate_limiter(self):
+        """Test lines over node and agent limits are dropped and notified."""
+        callback = mock.Mock()
+        notify = mock.Mock()
+        stats = {}
+        now = [0.0]
+
+        def clock():
+            return now[0]
+
+        limits = [(common.TokenBucket(2, clock=clock), lambda line: 1),
+                  (common.TokenBucket(10, clock=clock), len)]
+        limiter = serial.LineRateLimiter(callback, limits, notify, stats,
+                                         interval=60)
+
+        # 'lines' limit
+        for line in (b'a', b'b', b'c'):
+            limiter(line)
+        callback.assert_has_calls([mock.call(b'a'), mock.call(b'b')])
+        self.assertEqual(callback.call_count, 2)
+
+        # 'bytes' limit, tokens refilled
+        now[0] = 1.0
+        limiter(b'0123456789')
+        limiter(b'd')
+        self.assertEqual(callback.call_count, 3)
+        self.assertEqual(stats, {'ratelimit_dropped': 2})
+
+        self.assertFalse(notify.called)
+        limiter.close()
+        notify.assert_called_once_with('dropped 2 lines in 60s')
+
+    def test_ratelimit_option(self):
+        """Test 'ratelimit' line option defaults and errors."""
+        aggr = serial.MQTTAggregator(mock.Mock(), ratelimit={'lines': 10})
+
+        opts = aggr._line_options(b'')
+        self.assertEqual(opts['ratelimit'], {'lines': 10, 'bytes': 0})
+        opts = aggr._line_options(b'{"ratelimit": {"bytes": 100}}')
+        self.assertEqual(opts['ratelimit'], {'lines': 10, 'bytes': 100})
+
+        # Agent limit is the maximum
+        opts = aggr._line_options(b'{"ratelimit": {"lines": 5}}')
+        self.assertEqual(opts['ratelimit'], {'lines': 5, 'bytes': 0})
+        opts = aggr._line_options(b'{"ratelimit": {"lines": 50}}')
+        self.assertEqual(opts['ratelimit'], {'lines': 10, 'bytes': 0})
+        with self.assertRaises(ValueError) as context:
+            aggr._line_options(b'{"ratelimit": {"lines": 0}}')
+        self.assertEqual(str(context.exception),
+                         "Invalid ratelimit, 'lines' is limited to 10 "
+                         "by the agent")
+
+        self.assertRaises(ValueError, aggr._line_options,
+                          b'{"ratelimit": 10}')
+        self.assertRaises(ValueError, aggr._line_options,
+                          b'{"ratelimit": {"lines": -1}}')
+
+
+class MergedLinesTest(TestCaseImproved):
+    """Test MergedLines."""
+    def test_merged_lines(self):
+        """Test nodes lines are merged in one tagged batch."""
+        callback = mock.Mock()
+        merged = serial.MergedLines(callback, interval=60)
+
+        node1 = mock.Mock()
+        node2 = mock.Mock()
+        handler1 = serial.LineHandler(serial.LineTee(
+            node1, functools.partial(merged.add, 'm3-1', lambda: 10.5)))
+        handler2 = serial.LineHandler(serial.LineTee(
+            node2, functools.partial(merged.add, 'm3-2', lambda: 11.0)))
+
+        handler1(b'a\nb\n')
+        handler2(b'c;d\n')
+        node1.assert_has_calls([mock.call(b'a'), mock.call(b'b')])
+        node2.assert_called_once_with(b'c;d')
+        self.assertFalse(callback.called)
+
+        merged.close()
+        batch = callback.call_args[0][0]
+        self.assertEqual(batch, (b'10.500000;m3-1;a\n10.500000;m3-1;b\n'
+                                 b'11.000000;m3-2;c;d'))
+        self.assertEqual(serial.MergedLines.decode(batch)[2],
+                         (11.0, 'm3-2', b'c;d'))
+
+
+class LineMetricsTest(TestCaseImproved):
+    """Test LineMetrics."""
+    def test_line_metrics(self):
+        """Test fields aggregates and lines forwarding."""
+        callback = mock.Mock()
+        publish = mock.Mock()
+        opts = serial.LineMetrics.options({'keys': [], 'window': 60})
+        metrics = serial.LineMetrics(callback, publish, **opts)
+
+        metrics(b'temp=20 rssi=-70')
+        metrics(b'temp=24.5 rssi=1e999')
+        metrics(b'no values')
+        metrics(b'temp=21.5 rssi=-80')
+        self.assertFalse(callback.called)
+        self.assertFalse(publish.called)
+
+        metrics.close()
+        result = json.loads(publish.call_args[0][0].decode('utf-8'))
+        self.assertEqual(result['window'], 60)
+        self.assertEqual(result['fields'], {
+            'temp': {'count': 3, 'min': 20, 'max': 24.5, 'mean': 22.0,
+                     'last': 21.5},
+            'rssi': {'count': 2, 'min': -80, 'max': -70, 'mean': -75.0,
+                     'last': -80},
+        })
+
+        # Nothing published for empty windows, lines forwarded
+        opts = serial.LineMetrics.options({'keys': ['temp'], 'lines': True})
+        metrics = serial.LineMetrics(callback, publish, **opts)
+        metrics(b'rssi=-70')
+        metrics.close()
+        callback.assert_called_once_with(b'rssi=-70')
+        self.assertEqual(publish.call_count, 1)
+
+    def test_line_metrics_invalid_spec(self):
+        """Test invalid metrics specifications."""
+        for spec in ({}, {'keys': 'temp'}, {'regex': 'no groups'},
+                     {'regex': '('}, {'keys': [], 'window': -1},
+                     {'keys': [], 'window': 0},
+                     {'keys': [], 'other': 1}, 'temp'):
+            self.assertRaises(ValueError, serial.LineMetrics.options, spec)
+
+
+class LineExpectTest(TestCaseImproved):
+    """Test LineExpect."""
+    def test_expect_script(self):
+        """Test script steps matches and timeout."""
+        queues = []
+        handler = serial.LineHandler(serial.LineWatcher(mock.Mock(), queues))
+
+        def _send(line):
+            # Node echoes the line and answers
+            handler(b'> ' + line + b'\n')
+            handler(b'answer=42\n')
+
+        steps = serial.LineExpect.steps(
+            b'[{"send": "help"}, {"expect": "^> (\\\\w+)"},'
+            b' {"expect": "answer=([0-9]+)", "timeout": 1},'
+            b' {"expect": "never", "timeout": 0.01},'
+            b' {"send": "not sent"}]')
+        expect = serial.LineExpect(steps, _send, queues)
+        self.assertEqual(len(queues), 1)
+
+        result = json.loads(expect.run().decode('utf-8'))
+        self.assertEqual(queues, [])
+
+        self.assertIsNone(result['error'])
+        steps = result['steps']
+        self.assertEqual(len(steps), 4)
+        self.assertEqual(steps[0]['send'], 'help')
+        self.assertEqual(steps[1]['line'], '> help')
+        self.assertEqual(steps[1]['groups'], ['help'])
+        self.assertEqual(steps[2]['groups'], ['42'])
+        self.assertTrue(steps[3]['timeout'])
+
+    def test_expect_errors(self):
+        """Test invalid scripts and send errors."""
+        for payload in (b'{}', b'[1]', b'[{"send": 1}]', b'[{"expect": "("}]',
+                        b'[{"expect": "a", "timeout": -1}]', b'[{"a": 1}]',
+                        b'[{"expect": "a", "timeout": 301}]'):
+            self.assertRaises(ValueError, serial.LineExpect.steps, payload)
+
+        send = mock.Mock(side_effect=ValueError('lineinput error'))
+        steps = serial.LineExpect.steps(b'[{"send": "help"}]')
+        result = serial.LineExpect(steps, send, []).run()
+        self.assertEqual(json.loads(result.decode('utf-8')),
+                         {'steps': [], 'error': 'lineinput error'})
+
+
+class NodeTest(TestCaseImproved):
+    """Test serial Node."""
+
+    def setUp(self):
+        self.closed_cb = mock.Mock()
+        self.error_cb = mock.Mock()
+        self.node = serial.Node('localhost', 20000,
+                                self.closed_cb, self.error_cb)
+        self.node.connection = mock.Mock()
+        self.node.connection.data_handler = None
+
+    def test_raw_mode(self):
+        """Test starting raw mode and writing raw data."""
+        reply = mock.Mock()
+        handler = mock.Mock()
+
+        ret = self.node.req_rawstart(reply, lambda: handler)
+        self.assertIsNone(ret)
+        self.assertEqual(self.node.state, 'rawstarting')
+        self.assertEqual(self.node.connection.data_handler, handler)
+        self.assertTrue(self.node.connection.start.called)
+
+        self.node.conn_event_handler('connect')
+        self.assertEqual(self.node.state, 'raw')
+        reply.assert_called_with(b'')
+
+        # Already started, handler kept and factories not called
+        factory = mock.Mock()
+        self.assertEqual(self.node.req_rawstart(reply, factory), b'')
+        self.assertEqual(self.node.connection.data_handler, handler)
+
+        # Cannot start line mode
+        ret = self.node.req_linestart(reply, factory)
+        self.assertEqual(ret, (b"Error: 'linestart' in mode raw. "
+                               b"Wait or stop it first"))
+        self.assertFalse(factory.called)
+
+        # Data is sent unchanged
+        self.node.rawinput(b'\x00abc')
+        self.node.connection.send.assert_called_with(b'\x00abc')
+        self.assertRaises(ValueError, self.node.lineinput, b'abc')
+
+        # Node statistics
+        self.node.stats['filter_dropped'] = 3
+        self.assertEqual(self.node.req_stats(),
+                         b'{"filter_dropped": 3, "state": "raw"}')
+
+        # Close also closes data handler
+        self.assertEqual(self.node.close(), b'')
+        self.assertEqual(self.node.state, 'closed')
+        self.assertTrue(handler.close.called)
+        self.closed_cb.assert_called_with(self.node)
+
+    def test_capture_mode(self):
+        """Test capturing lines with and without 'line' mode."""
+        capture = mock.Mock()
+        node = serial.Node('localhost', 20000, self.closed_cb, self.error_cb,
+                           capture=capture)
+        node.connection = mock.Mock(recv_time=10.0)
+        node.connection.data_handler = None
+        reply = mock.Mock()
+
+        self.assertIsNone(node.req_capture(reply))
+        self.assertEqual(node.state, 'capturestarting')
+        node.conn_event_handler('connect')
+        self.assertEqual(node.state, 'capture')
+        reply.assert_called_with(b'')
+
+        # Lines only recorded
+        node.connection.data_handler(b'a\n')
+        capture.record.assert_called_with(10.0, 0, b'a')
+
+        # Line mode uses the same connection
+        handler = mock.Mock()
+        node.connection.start.reset_mock()
+        self.assertEqual(node.req_linestart(reply, lambda: handler), b'')
+        self.assertEqual(node.state, 'line')
+        self.assertFalse(node.connection.start.called)
+        node.connection.data_handler(b'b\n')
+        capture.record.assert_called_with(10.0, 1, b'b')
+        handler.assert_called_once_with(b'b')
+
+        # Stopping line goes back to capture
+        self.assertEqual(node.req_linestop(), b'')
+        self.assertEqual(node.state, 'capture')
+        self.assertTrue(handler.close.called)
+        node.connection.data_handler(b'c\n')
+        self.assertEqual(handler.call_count, 1)
+        self.assertFalse(self.closed_cb.called)
+
+        # Stopping the node ends capture
+        self.assertEqual(node.close(), b'')
+        self.assertEqual(node.state, 'closed')
+        self.closed_cb.assert_called_with(node)
+
+    def test_capture_disabled(self):
+        """Test capture request without capture."""
+        self.assertEqual(self.node.req_capture(mock.Mock()),
+                         b'Error: lines capture disabled')
+
+    def test_line_mode_connection_error(self):
+        """Test connection failure when starting line mode."""
+        reply = mock.Mock()
+
+        ret = self.node.req_linestart(
+            reply, lambda: serial.LineHandler(mock.Mock()))
+        self.assertIsNone(ret)
+
+        try:
+            raise IOError('Connection refused')
+        except IOError:
+            self.node.conn_event_handler('error')
+
+        reply.assert_called_with(b'Connection failed: Connection refused')
+        self.assertEqual(self.node.state, 'closed')
+        self.assertFalse(self.error_cb.called)
+        self.assertRaises(ValueError, self.node.lineinput, b'abc')
+
+    def test_line_mode_paced_input(self):
+        """Test paced line input is queued and sent line by line."""
+        sent = []
+        self.node.connection.send.side_effect = sent.append
+
+        ret = self.node.req_linestart(mock.Mock(), mock.Mock(),
+                                      rate=10000, delay=0.05)
+        self.assertIsNone(ret)
+        self.node.conn_event_handler('connect')
+
+        self.node.lineinput(b'first\nsecond\nthird')
+        stats = json.loads(self.node.req_stats().decode('utf-8'))
+        self.assertGreaterEqual(stats['input_queue'], 1)
+
+        self._wait_lines(sent, 3)
+        self.assertEqual(sent, [b'first\n', b'second\n', b'third\n'])
+
+        # Queued lines are dropped on close, writer is stopped
+        writer = self.node.writer
+        self.node.lineinput(b'1\n2\n3')
+        self.node.close()
+        writer.thread.join(5)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertLess(len(sent), 6)
+
+        # Old writer does not send in a new session
+        count = len(sent)
+        self.node.req_linestart(mock.Mock(), mock.Mock())
+        self.node.conn_event_handler('connect')
+        writer.queue.queue.clear()
+        writer.write(b'old\n')
+        writer._thr_write()
+        self.assertEqual(len(sent), count)
+
+    def test_line_mode_paced_input_errors(self):
+        """Test paced line input send errors."""
+        # Send failure is reported and stops writer
+        self.node.connection.send.side_effect = IOError('Broken pipe')
+        self.node.req_linestart(mock.Mock(), mock.Mock(), delay=0.01)
+        self.node.conn_event_handler('connect')
+        writer = self.node.writer
+
+        self.node.lineinput(b'first\nsecond')
+        writer.thread.join(5)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(self.node.connection.send.call_count, 1)
+        node, error = self.error_cb.call_args[0]
+        self.assertIs(node, self.node)
+        self.assertTrue(error.startswith('Line input failed: Broken pipe'))
+        self.node.close()
+
+        # Connection closed while sending, closes node from writer thread
+        def _send(_):
+            try:
+                raise IOError('Connection reset')
+            except IOError:
+                self.node.conn_event_handler('error')
+
+        self.node.connection.send.side_effect = _send
+        self.node.req_linestart(mock.Mock(), mock.Mock(), delay=0.01)
+        self.node.conn_event_handler('connect')
+        writer = self.node.writer
+
+        self.node.lineinput(b'first\nsecond')
+        writer.thread.join(5)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(self.node.state, 'closed')
+        self.assertEqual(self.node.connection.send.call_count, 2)
+
+    @mock.patch('threading.Thread', mock.Mock())
+    def test_expect_limit(self):
+        """Test concurrent expect scripts are limited."""
+        self.assertIsNone(self.node.req_linestart(mock.Mock(), mock.Mock()))
+        self.node.conn_event_handler('connect')
+
+        steps = serial.LineExpect.steps(b'[{"expect": "a"}]')
+        for _ in range(serial.Node.MAX_EXPECTS):
+            self.assertIsNone(self.node.req_expect(mock.Mock(), steps))
+        self.assertEqual(self.node.req_expect(mock.Mock(), steps),
+                         b"Error: already 4 'expect' running")
+
+        # Finished script frees its slot
+        reply = mock.Mock()
+        expect = mock.Mock()
+        self.node._thr_expect(expect, reply)
+        reply.assert_called_once_with(expect.run.return_value)
+        self.assertIsNone(self.node.req_expect(mock.Mock(), steps))
+
+    def _wait_lines(self, sent, count):
+        """Wait until ``count`` lines are sent."""
+        for _ in range(100):
+            if len(sent) >= count:
+                return
+            time.sleep(0.01)
+        self.fail('Lines not sent: %r' % sent)
+
+
+class MQTTAggregatorReplayTest(TestCaseImproved):
+    """Test MQTTAggregator line replay."""
+
+    @mock.patch('threading.Thread', mock.Mock())
+    def test_replay_limits(self):
+        """Test replay only existing captures, with concurrent limit."""
+        capture = mock.Mock()
+        capture.find.side_effect = lambda archi, num: (
+            mock.Mock() if num == '1' else None)
+        aggr = serial.MQTTAggregator(mock.Mock(), capture=capture)
+        message = mock.Mock(payload=b'')
+
+        self.assertEqual(aggr.cb_linereplay(message, 'm3', '2'),
+                         b'Error: no captured lines for node')
+        for _ in range(serial.MQTTAggregator.MAX_REPLAYS):
+            self.assertEqual(aggr.cb_linereplay(message, 'm3', '1'), b'')
+        self.assertEqual(aggr.cb_linereplay(message, 'm3', '1'),
+                         b'Error: already 4 replays running')
+
+        # Finished replay frees its slot
+        publisher = mock.Mock()
+        aggr._replay(publisher, [], 0, 'm3/1')
+        publisher.assert_called_once_with(b'')
+        self.assertEqual(aggr.cb_linereplay(message, 'm3', '1'), b'')
+
+    def test_replay_error(self):
+        """Test replay failure is reported and still ends replay."""
+        def _records():
+            yield (1.0, 0, b'line')
+            raise OSError(2, 'No such file or directory')
+
+        aggr = serial.MQTTAggregator(mock.Mock(), capture=mock.Mock())
+        aggr.error = mock.Mock()
+        aggr.replays.acquire()
+        publisher = mock.Mock()
+
+        aggr._replay(publisher, _records(), 0, 'm3/1')
+        self.assertEqual(publisher.call_args_list[-1], mock.call(b''))
+        self.assertEqual(publisher.call_count, 2)
+        topic, msg = aggr.error.call_args[0]
+        self.assertEqual(topic, 'm3/1')
+        self.assertTrue(msg.startswith('Replay failed: '))
+
+
+class MQTTAggregatorRawTest(TestCaseImproved):
+    """Test MQTTAggregator raw mode."""
+
+    def test_raw_batch_delay(self):
+        """Test raw batches with only a size also have a delay."""
+        aggr = serial.MQTTAggregator(mock.Mock())
+        self.assertEqual(aggr._raw_handler('m3', '1').delay, 0)
+        self.assertEqual(aggr._raw_handler('m3', '1', size=64).delay,
+                         serial.MQTTAggregator.RAW_DEFAULT_DELAY)
+        self.assertEqual(aggr._raw_handler('m3', '1', size=64,
+                                           delay=0.1).delay, 0.1)
+
+
+class MQTTAggregatorBulkTest(TestCaseImproved):
+    """Test MQTTAggregator bulk requests."""
+
+    def setUp(self):
+        self.aggr = serial.MQTTAggregator(mock.Mock())
+        self.message = mock.Mock()
+        self.req_linestart = mock.patch.object(serial.Node,
+                                               'req_linestart').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_bulk_linestart(self):
+        """Test bulk linestart replies once with all nodes results."""
+        # node 1 answers directly, 2 and 3 later
+        self.req_linestart.side_effect = [b'', None, None]
+        self.message.payload = b'm3 1-3 {"filter": {"prefix": ["R"]}}'
+
+        ret = self.aggr.cb_bulklinestart(self.message)
+        self.assertIsNone(ret)
+        self.assertEqual(sorted(self.aggr.nodes),
+                         [('m3', '1'), ('m3', '2'), ('m3', '3')])
+
+        publishers = [c[0][0] for c in self.req_linestart.call_args_list]
+        publishers[2](b'Connection failed: error')
+        self.assertFalse(self.message.reply_publisher.called)
+
+        publishers[1](b'')
+        self.message.reply_publisher.assert_called_once_with(
+            b'{"1": "", "2": "", "3": "Connection failed: error"}')
+
+    def test_bulk_errors(self):
+        """Test bulk requests invalid payloads."""
+        self.message.payload = b'm3'
+        self.assertEqual(self.aggr.cb_bulklinestart(self.message),
+                         b"Invalid nodes 'm3', should be 'ARCHI NODESET'")
+
+        self.message.payload = b'm3 1-2 {"unknown": 1}'
+        self.assertEqual(self.aggr.cb_bulklinestart(self.message),
+                         b"Invalid options, unknown option 'unknown'")
+        self.assertFalse(self.req_linestart.called)
+
+        self.message.payload = b'm3 1-a'
+        self.assertEqual(self.aggr.cb_bulklinestop(self.message),
+                         b"Invalid nodes 'm3 1-a', should be 'ARCHI NODESET'")
+
+    def test_bulk_linestop(self):
+        """Test bulk linestop."""
+        self.req_linestart.return_value = None
+        self.message.payload = b'm3 1-2'
+        self.aggr.cb_bulklinestart(self.message)
+
+        self.message.payload = b'm3 2-3'
+        ret = self.aggr.cb_bulklinestop(self.message)
+        self.assertEqual(ret, b'{"2": "", "3": ""}')
+        self.assertEqual(list(self.aggr.nodes), [('m3', '1')])
+
+
+class MQTTAggregatorGroupInputTest(TestCaseImproved):
+    """Test MQTTAggregator group line input."""
+
+    def setUp(self):
+        self.aggr = serial.MQTTAggregator(mock.Mock())
+        self.aggr.error = mock.Mock()
+        for num, state in (('1', 'line'), ('2', 'line'), ('3', 'raw')):
+            node = self.aggr._node('m3', num)  # pylint:disable=W0212
+            node.connection = mock.Mock()
+            node.state = state
+
+        self.message = mock.Mock()
+        self.message.payload = b'reboot'
+        self.message.topic = 'm3/all/line/data/in'
+
+    def _sent(self, num):
+        """Data sent to node ``num``."""
+        node = self.aggr.nodes[('m3', num)]
+        return [c[0][0] for c in node.connection.send.call_args_list]
+
+    def test_group_all(self):
+        """Test writing to all nodes in line mode."""
+        self.aggr.cb_lineinput(self.message, 'm3', 'all')
+
+        self.assertEqual(self._sent('1'), [b'reboot\n'])
+        self.assertEqual(self._sent('2'), [b'reboot\n'])
+        self.assertEqual(self._sent('3'), [])
+        self.assertFalse(self.aggr.error.called)
+
+    def test_group_nodeset(self):
+        """Test writing to a nodeset with errors summary."""
+        self.message.topic = 'm3/2-4/line/data/in'
+        self.aggr.cb_lineinput(self.message, 'm3', '2-4')
+
+        self.assertEqual(self._sent('1'), [])
+        self.assertEqual(self._sent('2'), [b'reboot\n'])
+        self.aggr.error.assert_called_once_with(
+            'm3/2-4/line/data/in',
+            ('{"3": "lineinput while not in \'line\' mode", '
+             '"4": "Non connected node m3-4"}'))
+
+        self.aggr.error.reset_mock()
+        self.aggr.cb_lineinput(self.message, 'm3', '1-a')
+        self.aggr.error.assert_called_once_with('m3/2-4/line/data/in',
+                                                "Invalid nodeset '1-a'")
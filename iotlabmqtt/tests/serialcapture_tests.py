@@ -0,0 +1,181 @@
+# -*- coding:utf-8 -*-
+
+"""Serial capture tests."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from iotlabmqtt import serialcapture
+from . import TestCaseImproved
+
+
+class NodeCaptureTest(TestCaseImproved):
+    """Test NodeCapture."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _capture(self, **kwargs):
+        path = os.path.join(self.directory, 'm3-1')
+        capture = serialcapture.NodeCapture(path, **kwargs)
+        self.addCleanup(capture.close)
+        return capture
+
+    @staticmethod
+    def _lines(records):
+        return [bytes(line) for _, _, line in records]
+
+    def test_records(self):
+        """Test recording and reading a time range."""
+        capture = self._capture(segment_size=64)
+
+        for i in range(20):
+            capture.record(1000.0 + i * 0.5, i, b'line %d' % i)
+
+        # Multiple segments were created
+        segments = [n for n in os.listdir(capture.directory)
+                    if n.endswith('.seg')]
+        self.assertGreater(len(segments), 1)
+
+        records = list(capture.records())
+        self.assertEqual(len(records), 20)
+        self.assertEqual(records[3][:2], (1001.5, 3))
+        self.assertEqual(self._lines(records)[3], b'line 3')
+
+        records = list(capture.records(1003.0, 1004.0))
+        self.assertEqual(self._lines(records),
+                         [b'line 6', b'line 7', b'line 8'])
+
+        self.assertEqual(list(capture.records(2000.0)), [])
+
+    def test_eviction(self):
+        """Test old segments are removed on max_size and max_age."""
+        capture = self._capture(segment_size=64, max_size=300)
+
+        for i in range(50):
+            capture.record(1000.0 + i, i, b'line %d' % i)
+
+        records = list(capture.records())
+        self.assertEqual(records[-1][1], 49)
+        self.assertLess(len(records), 50)
+        self.assertGreater(records[0][1], 0)
+
+        capture = self._capture(segment_size=64, max_age=10)
+        with mock.patch('time.time', return_value=1049.0):
+            for i in range(50):
+                capture.record(1000.0 + i, i, b'line %d' % i)
+
+        records = list(capture.records())
+        self.assertGreaterEqual(records[0][0], 1049.0 - 10 - 5)
+
+    def test_eviction_without_records(self):
+        """Test evict removes a quiet node segments on max_age."""
+        capture = self._capture(segment_size=64, max_age=10)
+        with mock.patch('time.time', return_value=1019.0):
+            for i in range(20):
+                capture.record(1000.0 + i, i, b'line %d' % i)
+
+        with mock.patch('time.time', return_value=1015.0):
+            capture.evict()
+        self.assertEqual(list(capture.records())[-1][1], 19)
+
+        with mock.patch('time.time', return_value=1100.0):
+            capture.evict()
+        self.assertEqual(list(capture.records()), [])
+
+        # Next record starts a new segment
+        capture.record(1100.0, 20, b'line 20')
+        self.assertEqual(self._lines(capture.records()), [b'line 20'])
+
+    def test_records_evicted_segment(self):
+        """Test records skips segments removed while reading."""
+        capture = self._capture(segment_size=64)
+        for i in range(20):
+            capture.record(1000.0 + i, i, b'line %d' % i)
+
+        records = capture.records()
+        self.assertEqual(next(records)[1], 0)
+        for path, _ in capture._segments()[1:-1]:
+            capture._remove_segment(path)
+
+        seqnos = [record[1] for record in records]
+        self.assertEqual(seqnos[-1], 19)
+        self.assertLess(len(seqnos), 19)
+
+    def test_line_recorder(self):
+        """Test LineRecorder records lines and closes segment."""
+        capture = self._capture(segment_size=1024)
+        handler = mock.Mock()
+        recorder = serialcapture.LineRecorder(handler, capture, lambda: 10.0)
+
+        recorder(b'a')
+        recorder(b'b')
+        handler.assert_has_calls([mock.call(b'a'), mock.call(b'b')])
+
+        # Without handler, lines are only recorded
+        recorder.handler = None
+        recorder(b'c')
+        self.assertEqual(handler.call_count, 2)
+
+        recorder.close()
+        self.assertEqual(list(capture.records()),
+                         [(10.0, 0, b'a'), (10.0, 1, b'b'),
+                          (10.0, 2, b'c')])
+
+        publish = mock.Mock()
+        serialcapture.replay(capture.records(), publish)
+        publish.assert_has_calls([mock.call(10.0, 0, b'a'),
+                                  mock.call(10.0, 1, b'b')])
+
+    def test_find(self):
+        """Test LineCapture.find only returns existing captures."""
+        capture = serialcapture.LineCapture(self.directory, 1024)
+        self.addCleanup(capture.close)
+        self.assertIsNone(capture.find('m3', '1'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+        node = capture.node('m3', '1')
+        self.assertIs(capture.find('m3', '1'), node)
+
+        # Capture from a previous run
+        other = serialcapture.LineCapture(self.directory, 1024)
+        self.addCleanup(other.close)
+        self.assertIsNotNone(other.find('m3', '1'))
+
+    def test_evict_all_nodes(self):
+        """Test LineCapture.evict also cleans previous runs captures."""
+        capture = serialcapture.LineCapture(self.directory, 64, max_age=10)
+        self.addCleanup(capture.close)
+        node = capture.node('m3', '1')
+        node.record(1000.0, 0, b'line')
+        node.close()
+        # Closed segment age is its modification time
+        for path, _ in node._segments():
+            os.utime(path + node.SEGMENT_EXT, (1000.0, 1000.0))
+
+        other = serialcapture.LineCapture(self.directory, 64, max_age=10)
+        self.addCleanup(other.close)
+        with mock.patch('time.time', return_value=1100.0):
+            other.evict()
+        self.assertEqual(list(capture.find('m3', '1').records()), [])
+
+    @mock.patch('threading.Thread')
+    def test_evict_thread(self, thread):
+        """Test eviction thread only runs with max_age."""
+        capture = serialcapture.LineCapture(self.directory, 64)
+        capture.start()
+        self.assertFalse(thread.called)
+
+        capture = serialcapture.LineCapture(self.directory, 64, max_age=10)
+        capture.start()
+        self.assertTrue(thread.return_value.start.called)
+        capture.close()
+        capture._thr_evict()
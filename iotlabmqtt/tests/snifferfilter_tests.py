@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+
+"""Radio sniffer frames filter tests."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from builtins import *  # pylint:disable=W0401,W0614,W0622
+
+import struct
+
+from iotlabmqtt import snifferfilter
+from . import TestCaseImproved
+
+# Data, no PAN ID compression, extended destination, short source
+DATA_EXT = b''.join((
+    struct.pack('<HB', 0x1 | (3 << 10) | (2 << 14), 1),
+    struct.pack('<HQHH', 0xabcd, 0x00124b0001020304, 0x1234, 0x42),
+    b'payload', b'\0\0'))
+# Ack, no addresses
+ACK = struct.pack('<HB', 0x2, 1) + b'\0\0'
+# Beacon, short source only
+BEACON = struct.pack('<HBHH', 0x0 | (2 << 14), 1, 0x1234, 0x1) + b'\0\0'
+
+
+class DecodeTest(TestCaseImproved):
+    """Test MAC header decoding."""
+
+    def test_decode(self):
+        """Test decoding addressing modes."""
+        self.assertEqual(snifferfilter.decode(DATA_EXT),
+                         {'type': 1, 'len': 26, 'pan': 0xabcd,
+                          'dst': 0x00124b0001020304, 'src_pan': 0x1234,
+                          'src': 0x42})
+        self.assertEqual(snifferfilter.decode(ACK), {'type': 2, 'len': 5})
+        self.assertEqual(snifferfilter.decode(BEACON),
+                         {'type': 0, 'len': 9, 'src_pan': 0x1234, 'src': 1})
+
+        # Truncated
+        self.assertEqual(snifferfilter.decode(b'\x01'), {'len': 1})
+        self.assertEqual(snifferfilter.decode(DATA_EXT[:8]),
+                         {'type': 1, 'len': 8, 'pan': 0xabcd})
+
+
+class CompileFilterTest(TestCaseImproved):
+    """Test filter expressions."""
+
+    def assertMatches(self, expression, frames):  # pylint:disable=invalid-name
+        """Assert ``expression`` matches only ``frames``."""
+        match = snifferfilter.compile_filter(expression)
+        matched = [frame for frame in (DATA_EXT, ACK, BEACON) if match(frame)]
+        self.assertEqual(matched, frames)
+
+    def test_filters(self):
+        """Test filters expressions."""
+        self.assertMatches('type == data', [DATA_EXT])
+        self.assertMatches('type != ack', [DATA_EXT, BEACON])
+        self.assertMatches('type==2', [ACK])
+        self.assertMatches('dst == 00:12:4b:00:01:02:03:04', [DATA_EXT])
+        self.assertMatches('dst == 0x00124b0001020304', [DATA_EXT])
+        self.assertMatches('src_pan == 0x1234 and len < 10', [BEACON])
+        self.assertMatches('type == ack or src == 1', [ACK, BEACON])
+        self.assertMatches('not (type == ack or src == 1)', [DATA_EXT])
+        self.assertMatches('not pan == 0xabcd', [ACK, BEACON])
+        self.assertMatches('((len >= 9))', [DATA_EXT, BEACON])
+
+    def test_invalid(self):
+        """Test invalid expressions errors."""
+        errors = [
+            ('', 'unexpected end'),
+            ('type ==', 'unexpected end'),
+            ('type == data)', "unexpected ')' at 12"),
+            ('(type == data', 'unexpected end'),
+            ('rssi > 3', "unknown field 'rssi'"),
+            ('type == beacons', "invalid value 'beacons' for type"),
+            ('len == 3 && type == 1', "unexpected '&' at 9"),
+            ('len 3', "unexpected '3' at 4"),
+            ('len > 0 or ' * 100 + 'len > 0',
+             'longer than 1024 characters'),
+            ('(' * 33 + 'len > 0' + ')' * 33,
+             "more than 32 nested 'not' or '(' at 32"),
+            ('not (' * 20 + 'len > 0' + ')' * 20,
+             "more than 32 nested 'not' or '(' at 80"),
+        ]
+        for expression, error in errors:
+            with self.assertRaises(ValueError) as context:
+                snifferfilter.compile_filter(expression)
+            self.assertEqual(str(context.exception),
+                             'Invalid filter: %s' % error)
@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+# -*- coding:utf-8 -*-
+"""Benchmark radio sniffer ZEP stream parsing and pcap encoding.
+
+Compare ``radiosniffer.ZEPHandler`` with the previous implementation that
+concatenated and sliced the whole buffer for each packet.
+
+Compare ``radiosniffer.ZepToPcap`` ``convert`` and ``convert_many`` with
+the previous encoder creating structs and packing IP header twice per packet.
+Each run produces the same concatenated records, as published in batches.
+
+Usage: zepbenchmark.py [NUM_PACKETS]
+"""
+
+from __future__ import print_function
+
+import sys
+import struct
+import timeit
+import binascii
+
+from iotlabmqtt import radiosniffer
+
+# pylint:disable=invalid-name
+
+ZEP_HEADER = binascii.a2b_hex(''.join((
+    '45 58 02 01'      # Base Zep header
+    '0B 00 01 00 ff'   # chan | dev_id | dev_id| LQI/CRC_MODE |  LQI
+    '83 aa 7e 80'      # Timestamp msb (Epoch 1/1/1970)
+    '00 00 00 00'      # timestamp lsp
+    '00 00 00 01'      # seqno
+    '00 01 02 03'      # reserved 0-3/10
+    '04 05 16 07'      # reserved 4-7/10
+    '08 09'            # reserved 8-9 / 10
+).split()))
+
+READ_SIZE = 8192
+
+
+class LegacyZEPHandler(object):  # pylint:disable=too-few-public-methods
+    """Previous ZEPHandler implementation, calls handler per packet."""
+    ZEP_HDR_LEN = 32
+    ZEP_START = b'EX\2'
+
+    def __init__(self, handler):
+        self.data = b''
+        self.handler = handler
+
+    def __call__(self, input_data):
+        data = self.data + input_data
+
+        while True:
+            data = self._strip_until_pkt_start(data)
+            if not data.startswith(self.ZEP_START):
+                break
+            if len(data) < self.ZEP_HDR_LEN:
+                break
+
+            full_len = self.ZEP_HDR_LEN + self._payload_len(data)
+            if len(data) < full_len:
+                break
+
+            pkt, data = data[:full_len], data[full_len:]
+            self.handler(pkt)
+
+        self.data = data
+
+    def _payload_len(self, data):
+        return bytearray(data[self.ZEP_HDR_LEN - 1:self.ZEP_HDR_LEN])[0]
+
+    @classmethod
+    def _strip_until_pkt_start(cls, msg):
+        whole_index = msg.find(cls.ZEP_START)
+        if whole_index == 0:
+            return msg
+        if whole_index != -1:
+            return msg[whole_index:]
+        return msg[-2:]
+
+
+class LegacyZepToPcap(object):  # pylint:disable=too-few-public-methods
+    """Previous ZepToPcap 'convert' implementation."""
+    ZEP_PORT = 17754
+    ZEP_HDR_LEN = 32
+    ZEP_TIME_IDX = 9
+    NTP_JAN_1970 = 2208988800
+    NTP_SECONDS_FRAC = 1 << 32
+    ETH_HDR = struct.pack(b'!3H3HH', 0, 0, 0, 0, 0, 0, 0x0800)
+
+    def __init__(self, mode='RAW'):
+        self.convert = {'RAW': self._convert_raw,
+                        'ZEP': self._convert_zep}[mode]
+
+    @classmethod
+    def _convert_raw(cls, packet):
+        timestamp = cls._timestamp(packet)
+        payload = packet[cls.ZEP_HDR_LEN:]
+        length = len(payload)
+        pcap_hdr = cls._pcap_header(length, timestamp[0], timestamp[1])
+        return b''.join((pcap_hdr, payload))
+
+    @classmethod
+    def _convert_zep(cls, packet):
+        timestamp = cls._timestamp(packet)
+        length = len(packet)
+        udp_hdr = cls._udp_header(length)
+        length += len(udp_hdr)
+        ip_hdr = cls._ip_header(length)
+        length += len(ip_hdr)
+        eth_hdr = cls.ETH_HDR
+        length += len(eth_hdr)
+        pcap_hdr = cls._pcap_header(length, timestamp[0], timestamp[1])
+        return b''.join((pcap_hdr, eth_hdr, ip_hdr, udp_hdr, packet))
+
+    @classmethod
+    def _timestamp(cls, packet):
+        ntp_t = struct.unpack_from(b'!LL', packet, cls.ZEP_TIME_IDX)
+        t_s = ntp_t[0] - cls.NTP_JAN_1970
+        t_us = (1000000 * ntp_t[1]) // cls.NTP_SECONDS_FRAC
+        return t_s, t_us
+
+    @classmethod
+    def _udp_header(cls, pkt_len):
+        hdr_struct = struct.Struct(b'!HHHH')
+        udp_len = hdr_struct.size + pkt_len
+        return hdr_struct.pack(cls.ZEP_PORT, cls.ZEP_PORT, udp_len, 0)
+
+    @classmethod
+    def _ip_header(cls, pkt_len):
+        hdr_struct = struct.Struct(b'!BBHHHBBHLL')
+        ip_len = hdr_struct.size + pkt_len
+        ip_hdr_csum = hdr_struct.pack(0x45, 0, ip_len, 0, 0x4000, 0xff, 0x11,
+                                      0, 0x7F000001, 0x7F000001)
+        checksum = cls._ip_checksum(ip_hdr_csum)
+        return hdr_struct.pack(0x45, 0, ip_len, 0, 0x4000, 0xff, 0x11,
+                               checksum, 0x7F000001, 0x7F000001)
+
+    @staticmethod
+    def _ip_checksum(hdr):
+        word_pack = struct.Struct(b'!H')
+        hdr_split = (hdr[i:i + 2] for i in range(0, len(hdr), 2))
+        csum = sum((word_pack.unpack(word)[0] for word in hdr_split))
+        return (csum + (csum >> 16)) & 0xFFFF ^ 0xFFFF
+
+    @staticmethod
+    def _pcap_header(pkt_len, t_s, t_us):
+        hdr_struct = struct.Struct(b'=LLLL')
+        return hdr_struct.pack(t_s, t_us, pkt_len, pkt_len)
+
+
+def zep_stream(num_packets):
+    """Return ``num_packets`` ZEP packets stream with various lengths."""
+    packets = []
+    for i in range(num_packets):
+        payload = bytearray((i + j) & 0xff for j in range(5 + i % 120))
+        packets.append(ZEP_HEADER + bytearray([len(payload)]) + payload)
+    return b''.join(bytes(pkt) for pkt in packets)
+
+
+def reads(stream, size=READ_SIZE):
+    """Split ``stream`` in socket reads of ``size``."""
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def bench(name, handler_class, chunks, num_packets, repeat=5):
+    """Print packets per second for parsing ``chunks``."""
+    count = [0]
+
+    def _count(packets):
+        count[0] += len(packets)
+
+    def _count_one(_):
+        count[0] += 1
+
+    callback = _count_one if handler_class is LegacyZEPHandler else _count
+
+    def _run():
+        handler = handler_class(callback)
+        for chunk in chunks:
+            handler(chunk)
+
+    best = min(timeit.repeat(_run, number=1, repeat=repeat))
+    assert count[0] == num_packets * repeat, count[0]
+    print('%-8s %10.0f packets/s' % (name, num_packets / best))
+    return best
+
+
+def bench_encoder(mode, packets, repeat=5):
+    """Print packets per second for encoding ``packets`` in ``mode``."""
+    legacy = LegacyZepToPcap(mode).convert
+    encoder = radiosniffer.ZepToPcap(mode)
+
+    # Same output
+    expected = b''.join(legacy(pkt) for pkt in packets)
+    assert encoder.convert_many(packets) == expected
+    assert b''.join(encoder.convert(pkt) for pkt in packets) == expected
+
+    runs = [
+        ('legacy', lambda: b''.join([legacy(pkt) for pkt in packets])),
+        ('convert', lambda: b''.join([encoder.convert(pkt)
+                                      for pkt in packets])),
+        ('many', lambda: encoder.convert_many(packets)),
+    ]
+    for name, run in runs:
+        best = min(timeit.repeat(run, number=1, repeat=repeat))
+        print('%s %-8s %10.0f packets/s' % (mode, name, len(packets) / best))
+
+
+def main():
+    """Run benchmark."""
+    try:
+        num_packets = int(sys.argv[1])
+    except (IndexError, ValueError):
+        num_packets = 100000
+
+    stream = zep_stream(num_packets)
+    chunks = reads(stream)
+    print('Parsing %u packets in %u reads of %u bytes' %
+          (num_packets, len(chunks), READ_SIZE))
+
+    legacy = bench('legacy', LegacyZEPHandler, chunks, num_packets)
+    current = bench('current', radiosniffer.ZEPHandler, chunks, num_packets)
+    print('Speedup: %.1fx' % (legacy / current))
+
+    packets = []
+    radiosniffer.ZEPHandler(
+        lambda pkts: packets.extend(bytes(pkt) for pkt in pkts))(stream)
+    print('Encoding %u packets' % num_packets)
+    for mode in ('RAW', 'ZEP'):
+        bench_encoder(mode, packets)
+
+
+if __name__ == '__main__':
+    main()